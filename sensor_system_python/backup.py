@@ -0,0 +1,227 @@
+# backup.py - Резервные копии базы данных без остановки приема
+import os
+import sys
+import gzip
+import time
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+
+PREFIX = 'sensor_data_'
+SUFFIXES = ('.db', '.db.gz')
+
+
+class BackupManager:
+    """Резервное копирование через online backup API SQLite.
+
+    Копирование идет шагами по BACKUP_PAGES_PER_STEP страниц с паузой между
+    шагами, поэтому запись в базу не останавливается. На все время копии
+    исходное подключение держит транзакцию чтения: в режиме WAL это
+    фиксирует снимок базы, и новые коммиты не перезапускают копирование.
+    Готовая копия проверяется (quick_check), при BACKUP_COMPRESS сжимается,
+    старые копии удаляются по правилам хранения.
+    """
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self.config = db_manager.db_config
+        self.backup_dir = self.config.BACKUP_DIR
+        self.last_backup = None
+
+    def backup_files(self):
+        """Готовые копии, новые первыми"""
+        if not os.path.isdir(self.backup_dir):
+            return []
+        names = [name for name in os.listdir(self.backup_dir)
+                 if name.startswith(PREFIX) and name.endswith(SUFFIXES)]
+        return [os.path.join(self.backup_dir, name) for name in sorted(names, reverse=True)]
+
+    def run_backup(self):
+        """Создание копии, возвращает путь к файлу"""
+        cfg = self.config
+        os.makedirs(self.backup_dir, exist_ok=True)
+        started = time.monotonic()
+        name = f"{PREFIX}{datetime.now():%Y%m%d_%H%M%S}.db"
+        path = os.path.join(self.backup_dir, name)
+        partial = path + '.part'
+
+        source = self.db_manager.pool.connect()
+        target = sqlite3.connect(partial)
+        steps = [0]
+
+        def progress(status, remaining, total):
+            steps[0] += 1
+
+        try:
+            # Снимок чтения на все время копирования
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            page_size = source.execute('PRAGMA page_size').fetchone()[0]
+            page_count = source.execute('PRAGMA page_count').fetchone()[0]
+            source.backup(target, pages=cfg.BACKUP_PAGES_PER_STEP, progress=progress,
+                          sleep=cfg.BACKUP_STEP_SLEEP)
+            source.execute('COMMIT')
+
+            check = target.execute('PRAGMA quick_check').fetchone()[0]
+            if check != 'ok':
+                raise sqlite3.DatabaseError(f"Backup failed quick_check: {check}")
+            # Копия - самостоятельный файл без журнала WAL
+            target.execute('PRAGMA journal_mode=DELETE')
+        except Exception:
+            target.close()
+            os.remove(partial)
+            raise
+        finally:
+            self.db_manager.pool.release(source)
+        target.close()
+
+        copied = page_size * page_count
+        if cfg.BACKUP_COMPRESS:
+            with open(partial, 'rb') as raw, gzip.open(path + '.gz', 'wb', compresslevel=6) as packed:
+                shutil.copyfileobj(raw, packed, 1024 * 1024)
+            os.remove(partial)
+            path += '.gz'
+        else:
+            os.replace(partial, path)
+
+        removed = self.rotate()
+        self.last_backup = {
+            'path': path,
+            'bytes_copied': copied,
+            'file_size': os.path.getsize(path),
+            'steps': steps[0],
+            'duration': time.monotonic() - started,
+            'finished_at': datetime.now().isoformat()
+        }
+        logging.info(f"Backup {path}: {copied / 1048576:.1f} MB in {steps[0]} steps, "
+                     f"{self.last_backup['file_size'] / 1048576:.1f} MB on disk, "
+                     f"{self.last_backup['duration']:.1f}s, {len(removed)} old backups removed")
+        return path
+
+    def rotate(self):
+        """Удаление старых копий.
+
+        Хранятся BACKUP_KEEP_LAST последних копий и самая новая копия
+        за каждый из BACKUP_KEEP_DAILY последних дней.
+        """
+        files = self.backup_files()
+        keep = set(files[:self.config.BACKUP_KEEP_LAST])
+        days = set()
+        for path in files:
+            day = os.path.basename(path)[len(PREFIX):len(PREFIX) + 8]
+            if day not in days and len(days) < self.config.BACKUP_KEEP_DAILY:
+                days.add(day)
+                keep.add(path)
+
+        removed = [path for path in files if path not in keep]
+        for path in removed:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.error(f"Error removing old backup {path}: {e}")
+        return removed
+
+
+def open_backup(path, workdir):
+    """Путь к несжатой копии (распаковывается во временный каталог)"""
+    if not path.endswith('.gz'):
+        return path
+    unpacked = os.path.join(workdir, os.path.basename(path)[:-3])
+    with gzip.open(path, 'rb') as packed, open(unpacked, 'wb') as raw:
+        shutil.copyfileobj(packed, raw, 1024 * 1024)
+    return unpacked
+
+
+def restore(path, db_path):
+    """Восстановление копии в файл базы db_path через backup API"""
+    with tempfile.TemporaryDirectory() as workdir:
+        source = sqlite3.connect(open_backup(path, workdir))
+        target = sqlite3.connect(db_path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+
+
+def verify(path):
+    """Пробное восстановление во временный файл и проверка целостности.
+
+    Возвращает сводку: результат integrity_check, версию схемы и число
+    строк в таблицах показаний.
+    """
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory() as workdir:
+        restored = os.path.join(workdir, 'restored.db')
+        restore(path, restored)
+        conn = sqlite3.connect(restored)
+        try:
+            integrity = conn.execute('PRAGMA integrity_check').fetchone()[0]
+            tables = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'sensor_data%'"
+            )]
+            rows = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0] for table in tables}
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+        finally:
+            conn.close()
+    return {
+        'path': path,
+        'integrity': integrity,
+        'schema_version': version,
+        'rows': rows,
+        'duration': time.monotonic() - started
+    }
+
+
+def main():
+    """Командная строка: python backup.py backup|verify|restore"""
+    from config import Config
+    from database import DatabaseManager
+
+    parser = argparse.ArgumentParser(description='Sensor database backups')
+    parser.add_argument('command', choices=['backup', 'verify', 'restore'])
+    parser.add_argument('file', nargs='?', help='backup file (verify/restore; default - newest)')
+    parser.add_argument('--db', default=Config.DATABASE.DB_PATH, help='database file')
+    parser.add_argument('--force', action='store_true', help='restore over an existing database')
+    args = parser.parse_args()
+
+    Config.setup_logging()
+    if args.command == 'backup':
+        db_manager = DatabaseManager(args.db, Config.DATABASE)
+        try:
+            path = BackupManager(db_manager).run_backup()
+            print(f"Backup written to {path} - backup.py:196")
+        finally:
+            db_manager.close()
+        return 0
+
+    path = args.file
+    if path is None:
+        files = [os.path.join(Config.DATABASE.BACKUP_DIR, name)
+                 for name in sorted(os.listdir(Config.DATABASE.BACKUP_DIR), reverse=True)
+                 if name.startswith(PREFIX) and name.endswith(SUFFIXES)]
+        if not files:
+            print("No backups found - backup.py:207")
+            return 1
+        path = files[0]
+
+    if args.command == 'verify':
+        result = verify(path)
+        print(f"{result['path']}: integrity {result['integrity']}, schema v{result['schema_version']}, "
+              f"{sum(result['rows'].values())} readings in {len(result['rows'])} tables, "
+              f"{result['duration']:.1f}s - backup.py:215")
+        return 0 if result['integrity'] == 'ok' else 1
+
+    if os.path.exists(args.db) and not args.force:
+        print(f"{args.db} exists, use --force to overwrite it - backup.py:219")
+        return 1
+    restore(path, args.db)
+    print(f"Restored {path} to {args.db} - backup.py:222")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
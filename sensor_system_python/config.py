@@ -1,6 +1,6 @@
 import os
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 @dataclass
 class ServerConfig:
@@ -8,16 +8,110 @@ class ServerConfig:
     PORT: int = 8080
     BUFFER_SIZE: int = 1024
     MAX_CONNECTIONS: int = 5
+    MODE: str = 'threaded'          # 'threaded' or 'asyncio'
+    BACKLOG: int = 1024             # listen() backlog for asyncio mode
+    MAX_CLIENTS: int = 10000        # concurrent connections in asyncio mode
+    DB_WORKERS: int = 4             # threads for database work in asyncio mode
+    CLIENT_TIMEOUT: float = 30.0    # seconds of client inactivity before disconnect
+    STATS_INTERVAL: int = 60        # seconds between connection stats reports
+    RECV_SIZE: int = 65536          # bytes per socket read
+    MAX_MESSAGE_SIZE: int = 1048576 # largest accepted JSON message / NDJSON line
 
 @dataclass
 class DatabaseConfig:
     DB_PATH: str = 'data/sensor_data.db'
+    BACKEND: str = 'sqlite'               # 'sqlite', 'memory' (per-device ring buffers) or 'sharded'
+    MEMORY_RING_SIZE: int = 10000         # readings kept per device by the memory backend
+    SHARDS: int = 4                       # database files for BACKEND='sharded' (crc32(device_id) % SHARDS)
+    SHARD_DIR: str = 'data/shards'        # shard files and the shards.json layout
+    SHARD_RESHARD_ON_START: bool = True   # redistribute data when SHARDS differs from the layout
+    SHARD_RESHARD_BATCH: int = 5000       # rows copied per transaction while resharding
     BACKUP_DIR: str = 'data/backups'
+    BACKUP_INTERVAL: int = 86400          # seconds between scheduled backups (0 = off)
+    BACKUP_PAGES_PER_STEP: int = 1024     # pages copied per online backup step
+    BACKUP_STEP_SLEEP: float = 0.005      # pause between steps so ingest keeps the lock
+    BACKUP_COMPRESS: bool = True          # gzip finished backups
+    BACKUP_KEEP_LAST: int = 7             # newest backups always kept
+    BACKUP_KEEP_DAILY: int = 30           # plus the newest backup of each of this many days
+    WRITE_BEHIND: bool = True             # single group-commit writer thread for ingest
+    INGEST_MODE: str = 'database'         # 'database' (group commit) or 'segment_log' (fsync'd log first)
+    SEGMENT_DIR: str = 'data/segments'    # segment log files for INGEST_MODE='segment_log'
+    SEGMENT_MAX_BYTES: int = 67108864     # segment is closed and applied after this size
+    SEGMENT_MAX_AGE: float = 1.0          # ... or after this many seconds
+    SEGMENT_FSYNC_INTERVAL_MS: int = 10   # group fsync window, acks wait for it
+    SEGMENT_APPLY_ROWS: int = 50000       # rows per transaction when applying segments
+    SEGMENT_MAX_BACKLOG_BYTES: int = 1073741824  # unapplied log size before producers are throttled
+    WRITER_QUEUE_SIZE: int = 100000       # pending messages before producers block
+    WRITER_BATCH_SIZE: int = 5000         # max rows per commit
+    WRITER_FLUSH_INTERVAL_MS: int = 50    # max wait for more rows after the first one
+    WRITER_RESULT_TIMEOUT: float = 10.0   # seconds a handler waits for its commit
+    JOURNAL_MODE: str = 'WAL'             # readers do not block the writer
+    SYNCHRONOUS: str = 'NORMAL'           # fsync on checkpoint, not on every commit
+    WRITER_SYNCHRONOUS: str = 'FULL'      # writer thread: fsync every commit before acking
+    CACHE_SIZE_KB: int = 65536            # page cache per connection
+    MMAP_SIZE: int = 268435456            # bytes of the file mapped into memory
+    BUSY_TIMEOUT_MS: int = 5000           # wait for locks instead of failing
+    STATEMENT_CACHE_SIZE: int = 256       # prepared statements kept per connection
+    DEVICE_FLUSH_INTERVAL: float = 5.0    # seconds between device registry / counters upserts
+    LAST_VALUES_REFRESH: float = 2.0      # seconds before a non-ingesting process re-reads latest values
+    HOT_TIER_ENABLED: bool = True         # recent readings kept in NumPy columns per device
+    HOT_TIER_WINDOW: int = 3600           # seconds of recent data answered from memory
+    HOT_TIER_CAPACITY: int = 3600         # readings preallocated per device (40 bytes each)
+    HOT_TIER_MAX_DEVICES: int = 1000      # least recently active devices are evicted above this
+    HOT_TIER_REFRESH: float = 1.0         # seconds before a non-ingesting process reads new rows
+    DEADBAND_ENABLED: bool = False        # skip rows whose metrics barely changed (rollups get them, backfill cannot)
+    DEADBAND_THRESHOLDS: dict = field(default_factory=lambda: {
+        'temperature': 0.1, 'humidity': 0.5, 'light_level': 5.0, 'voltage': 0.01
+    })                                    # absolute change per metric that forces a row
+    DEADBAND_DEVICE_THRESHOLDS: dict = field(default_factory=dict)  # {device_id: {metric: threshold}} overrides
+    DEADBAND_HEARTBEAT: float = 300.0     # seconds of reading time after which a row is written anyway
+    STATS_RECONCILE_INTERVAL: int = 3600  # seconds between counter reconciliation scans (0 = off)
+    STATS_MINUTES_RETENTION: int = 1440   # per-minute ingest counters kept
+    PARTITIONING: str = 'none'            # 'none', 'daily' or 'weekly' sensor_data tables
+    RETENTION_PARTITIONS: int = 0         # newest partitions kept, older ones dropped (0 = keep all)
+    PARTITIONS_REFRESH: float = 5.0       # seconds before a non-ingesting process re-reads the partition catalog
+    RETENTION_CHECK_INTERVAL: int = 3600  # seconds between retention checks
+    MIGRATION_BATCH_SIZE: int = 5000      # rows copied per transaction by the schema migration
+    MIGRATION_RETRY_INTERVAL: int = 60    # seconds before an interrupted migration resumes
+    OUTBOX_BATCH_SIZE: int = 1000         # rows per forwarding batch
+    OUTBOX_LEASE_SECONDS: float = 60.0    # claimed batch is re-queued if not acked in time
+    DEDUP_ENABLED: bool = True            # drop re-sent readings via the recent-key cache
+    DEDUP_KEYS_PER_DEVICE: int = 256      # recent (device_id, timestamp) keys kept per device
+    DEDUP_MAX_DEVICES: int = 100000       # devices in the cache before the idlest is evicted
+    DEDUP_SEED_SECONDS: float = 600.0     # cache is seeded with readings this recent at startup
 
 @dataclass
 class EmulatorConfig:
     SEND_INTERVAL: int = 10  # seconds
     NUM_DEVICES: int = 3     # number of emulated devices
+    PERSISTENT_CONNECTION: bool = True  # stream NDJSON over one socket instead of one connection per reading
+
+@dataclass
+class ForwarderConfig:
+    ENABLED: bool = False              # start forwarder.py from run_system.py (BACKEND='sqlite' only)
+    PROTOCOL: str = 'http'             # 'http' or 'tcp'
+    UPSTREAM_HOST: str = 'localhost'
+    UPSTREAM_PORT: int = 9090
+    UPSTREAM_PATH: str = '/ingest'     # HTTP endpoint of the central collector
+    SOURCE_ID: str = 'sensor-gateway'  # identifies this installation upstream
+    GZIP: bool = True                  # compress batch bodies
+    GZIP_LEVEL: int = 6
+    BATCH_SIZE: int = 1000             # readings per batch
+    MAX_IN_FLIGHT: int = 4             # concurrent batches (one connection each)
+    LEASE_SECONDS: float = 60.0        # unacknowledged batch is re-sent after this
+    TIMEOUT: float = 10.0              # socket timeout per request
+    BACKOFF_INITIAL: float = 0.5       # first retry delay, doubled per failure
+    BACKOFF_MAX: float = 60.0          # retry delay cap
+    IDLE_INTERVAL: float = 1.0         # seconds between polls of an empty queue
+    METRICS_INTERVAL: int = 30         # seconds between throughput/lag reports (0 = off)
+
+@dataclass
+class WebConfig:
+    EMBED_SERVER: bool = True          # run the data server inside the web process (push without DB reads);
+                                       # False = separate data_server.py, dashboard polls the DB (REALTIME_POLL)
+    REALTIME_INTERVALS: tuple = (0.5, 1.0, 5.0)  # push intervals a client may choose; first is the default
+    REALTIME_POLL: float = 1.0         # seconds between checks of the latest values when not embedded
+    EXPORT_CHUNK_ROWS: int = 5000      # rows read per page while streaming an export
 
 @dataclass
 class LogConfig:
@@ -29,6 +123,8 @@ class Config:
     SERVER = ServerConfig()
     DATABASE = DatabaseConfig()
     EMULATOR = EmulatorConfig()
+    FORWARDER = ForwarderConfig()
+    WEB = WebConfig()
     LOGGING = LogConfig()
     
     @staticmethod
@@ -1,7 +1,7 @@
 # data_logger.py - Логирование данных системы
 from datetime import datetime
-import sqlite3
 import json
+from db_pool import get_pool
 
 class DataLogger:
     def __init__(self, system_manager):
@@ -12,11 +12,11 @@ class DataLogger:
     def setup_database(self):
         """Настройка базы данных"""
         try:
-            self.conn = sqlite3.connect('drone_system.db', check_same_thread=False)
-            self.cursor = self.conn.cursor()
+            self.pool = get_pool('drone_system.db')
+            cursor = self.pool.connection().cursor()
             
             # Создание таблиц
-            self.cursor.execute('''
+            cursor.execute('''
                 CREATE TABLE IF NOT EXISTS system_logs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     timestamp TEXT,
@@ -25,7 +25,7 @@ class DataLogger:
                 )
             ''')
             
-            self.cursor.execute('''
+            cursor.execute('''
                 CREATE TABLE IF NOT EXISTS flight_data (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     timestamp TEXT,
@@ -36,7 +36,7 @@ class DataLogger:
                 )
             ''')
             
-            self.conn.commit()
+            self.pool.connection().commit()
             self.log("📊 База данных инициализирована")
         except Exception as e:
             print(f"Ошибка базы данных: {e}")
@@ -51,11 +51,11 @@ class DataLogger:
         
         # Сохранение в базу данных
         try:
-            self.cursor.execute(
-                "INSERT INTO system_logs (timestamp, level, message) VALUES (?, ?, ?)",
-                (datetime.now().isoformat(), level, message)
-            )
-            self.conn.commit()
+            with self.pool.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO system_logs (timestamp, level, message) VALUES (?, ?, ?)",
+                    (datetime.now().isoformat(), level, message)
+                )
         except Exception as e:
             print(f"Ошибка записи в лог: {e}")
         
@@ -68,17 +68,17 @@ class DataLogger:
         """Сохранение данных полета"""
         try:
             physics = self.system.physics
-            self.cursor.execute(
-                """INSERT INTO flight_data 
-                (timestamp, position_x, position_y, position_z, battery_level) 
-                VALUES (?, ?, ?, ?, ?)""",
-                (datetime.now().isoformat(), 
-                 physics.drone_position[0],
-                 physics.drone_position[1], 
-                 physics.drone_position[2],
-                 physics.battery_level)
-            )
-            self.conn.commit()
+            with self.pool.transaction() as conn:
+                conn.execute(
+                    """INSERT INTO flight_data 
+                    (timestamp, position_x, position_y, position_z, battery_level) 
+                    VALUES (?, ?, ?, ?, ?)""",
+                    (datetime.now().isoformat(), 
+                     physics.drone_position[0],
+                     physics.drone_position[1], 
+                     physics.drone_position[2],
+                     physics.battery_level)
+                )
         except Exception as e:
             self.log(f"Ошибка сохранения данных полета: {e}", "ERROR")
     
@@ -89,6 +89,6 @@ class DataLogger:
     def close(self):
         """Закрытие соединения с базой данных"""
         try:
-            self.conn.close()
+            self.pool.close_all()
         except:
             pass
\ No newline at end of file
@@ -3,6 +3,9 @@ import socket
 import json
 import threading
 import logging
+import asyncio
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
 import sys
 import os
 from datetime import datetime
@@ -11,29 +14,116 @@ from datetime import datetime
 sys.path.append(os.path.dirname(__file__))
 
 try:
-    from database import DatabaseManager
+    from storage import create_storage
     from config import Config
 except ImportError as e:
     print(f"Import error: {e} - data_server.py:17")
     # Создаем простые заглушки для классов
-    class DatabaseManager:
-        def __init__(self, db_path):
-            self.db_path = db_path
-            print(f"DatabaseManager initialized with {db_path} - data_server.py:22")
+    class StubStorage:
+        async_writes = False
         
-        def save_sensor_data(self, data):
-            print(f"Would save data: {data} - data_server.py:25")
-            return True
+        def write_batch(self, readings, callback=None, block=True):
+            print(f"Would save {len(readings)} readings - data_server.py:31")
+            future = Future()
+            future.set_result([True] * len(readings))
+            return future
+        
+        def start(self):
+            pass
+        
+        def stop(self):
+            pass
+    
+    def create_storage(db_config):
+        print(f"Stub storage initialized with {db_config.DB_PATH} - data_server.py:35")
+        return StubStorage()
     
     class Config:
         class SERVER:
             HOST = 'localhost'
             PORT = 8080
+            MODE = 'threaded'
+            BACKLOG = 1024
+            MAX_CLIENTS = 10000
+            DB_WORKERS = 4
+            CLIENT_TIMEOUT = 30.0
+            STATS_INTERVAL = 60
+            RECV_SIZE = 65536
+            MAX_MESSAGE_SIZE = 1048576
         class DATABASE:
             DB_PATH = 'data/sensor_data.db'
+            WRITE_BEHIND = False
+            WRITER_RESULT_TIMEOUT = 10.0
+
+class MessageFramer:
+    """Разбор входящего потока байт на JSON сообщения.
+    
+    Старые прошивки присылают один JSON объект без перевода строки и ждут
+    ответа, после чего соединение закрывается (режим 'oneshot'). Новые
+    клиенты держат соединение открытым и присылают NDJSON - по одному
+    сообщению на строку (режим 'stream'). Режим определяется по первым
+    полученным данным.
+    """
+    
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.buffer = b''
+        self.mode = None
+    
+    @staticmethod
+    def json_state(data):
+        """'complete', 'partial' или 'invalid' для накопленных данных"""
+        try:
+            json.loads(data)
+            return 'complete'
+        except json.JSONDecodeError as e:
+            # Ошибка в самом конце данных означает, что сообщение еще не дошло
+            if e.pos >= len(data.rstrip()) or e.msg.startswith('Unterminated string'):
+                return 'partial'
+            return 'invalid'
+        except UnicodeDecodeError:
+            return 'partial'
+    
+    def feed(self, chunk):
+        """Добавление данных, возвращает список готовых сообщений"""
+        self.buffer += chunk
+        
+        if self.mode is None:
+            first_line, newline, _ = self.buffer.partition(b'\n')
+            if newline and (not first_line.strip() or
+                            self.json_state(first_line) == 'complete'):
+                self.mode = 'stream'
+            else:
+                state = self.json_state(self.buffer)
+                if state != 'partial':
+                    # Одиночное сообщение (или мусор, на который нужно ответить ошибкой)
+                    self.mode = 'oneshot'
+                    message, self.buffer = self.buffer, b''
+                    return [message]
+        
+        if self.mode == 'stream':
+            *lines, self.buffer = self.buffer.split(b'\n')
+            messages = [line for line in lines if line.strip()]
+            if len(self.buffer) > self.max_size:
+                raise ValueError(f"Message exceeds {self.max_size} bytes")
+            return messages
+        
+        if len(self.buffer) > self.max_size:
+            raise ValueError(f"Message exceeds {self.max_size} bytes")
+        return []
+    
+    def finish(self):
+        """Остаток данных при закрытии соединения клиентом"""
+        message, self.buffer = self.buffer, b''
+        if message.strip() and self.mode != 'oneshot':
+            if self.mode is None:
+                self.mode = 'oneshot'
+            return [message]
+        return []
+
 
 class SensorDataServer:
-    def __init__(self, config):
+    def __init__(self, config, storage=None):
         self.config = config
         self.host = config.SERVER.HOST
         self.port = config.SERVER.PORT
@@ -42,61 +132,197 @@ class SensorDataServer:
         os.makedirs('data', exist_ok=True)
         
         try:
-            self.db_manager = DatabaseManager(config.DATABASE.DB_PATH)
+            # Хранилище передается веб-интерфейсом при встроенном запуске (WEB.EMBED_SERVER)
+            self.storage = storage or create_storage(config.DATABASE)
+            self.storage.start()
             print("Database manager initialized successfully - data_server.py:46")
         except Exception as e:
             print(f"Database initialization error: {e} - data_server.py:48")
-            self.db_manager = None
+            self.storage = None
         
         self.is_running = False
         self.server_socket = None
         
+        # Счетчики подключений
+        self.stats = {'accepted': 0, 'active': 0, 'failed': 0}
+        self.stats_lock = threading.Lock()
+    
+    def update_stats(self, **deltas):
+        """Изменение счетчиков подключений"""
+        with self.stats_lock:
+            for key, delta in deltas.items():
+                self.stats[key] += delta
+    
+    def get_stats(self):
+        """Текущие счетчики подключений"""
+        with self.stats_lock:
+            return dict(self.stats)
+    
+    def error_response(self, message):
+        """Ответ клиенту с ошибкой"""
+        return {
+            'status': 'error',
+            'message': message,
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    def parse_message(self, data):
+        """Разбор JSON сообщения, возвращает (payload, показания, признак пачки).
+        
+        Пачка показаний - JSON массив или конверт {"readings": [...]}; поля
+        конверта, кроме 'readings', используются как значения по умолчанию для
+        каждой записи (например, location шлюза). ValueError - сообщение
+        не удалось разобрать.
+        """
+        try:
+            payload = json.loads(data)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            print(f"JSON decode error: {e} - data_server.py:97")
+            raise ValueError('Invalid JSON data')
+        
+        if isinstance(payload, list):
+            return payload, payload, True
+        
+        if isinstance(payload, dict) and isinstance(payload.get('readings'), list):
+            defaults = {key: value for key, value in payload.items()
+                        if key not in ('readings', 'msg_id')}
+            readings = [{**defaults, **reading} if isinstance(reading, dict) else reading
+                        for reading in payload['readings']]
+            return payload, readings, True
+        
+        if not isinstance(payload, dict):
+            raise ValueError('Expected JSON object')
+        
+        print(f"Parsed data from {payload.get('device_id', 'unknown')}: - data_server.py:190"
+              f"temp={payload.get('temperature')}, "
+              f"humidity={payload.get('humidity')}")
+        return payload, [payload], False
+    
+    def save_readings(self, readings):
+        """Передача показаний в хранилище, возвращает Future со статусами"""
+        if self.storage and readings:
+            return self.storage.write_batch(readings)
+        future = Future()
+        future.set_result([False] * len(readings))
+        return future
+    
+    def wait_statuses(self, future, count):
+        """Ожидание коммита, при ошибке все записи считаются несохраненными"""
+        try:
+            return future.result(timeout=self.config.DATABASE.WRITER_RESULT_TIMEOUT)
+        except Exception as e:
+            print(f"Error saving data: {e} - data_server.py:208")
+            return [False] * count
+    
+    def build_response(self, payload, is_batch, statuses):
+        """Ответ клиенту по результатам сохранения.
+        
+        Для пачки поле 'bitmap' - строка из '1' (сохранено) и '0' (отклонено)
+        в порядке записей.
+        """
+        if is_batch:
+            accepted = sum(statuses)
+            if accepted == len(statuses):
+                status = 'success'
+            elif accepted:
+                status = 'partial'
+            else:
+                status = 'error'
+            print(f"Batch of {len(statuses)} readings: {accepted} saved - data_server.py:225")
+            
+            response = {
+                'status': status,
+                'message': f'{accepted} of {len(statuses)} readings saved',
+                'accepted': accepted,
+                'rejected': len(statuses) - accepted,
+                'bitmap': ''.join('1' if ok else '0' for ok in statuses),
+                'timestamp': datetime.now().isoformat()
+            }
+        else:
+            success = statuses[0]
+            response = {
+                'status': 'success' if success else 'error',
+                'message': 'Data received and saved' if success else 'Error saving data',
+                'timestamp': datetime.now().isoformat()
+            }
+        
+        # Идентификатор сообщения возвращается клиенту для сопоставления подтверждений
+        if isinstance(payload, dict) and 'msg_id' in payload:
+            response['msg_id'] = payload['msg_id']
+        return response
+    
+    def process_message(self, data):
+        """Разбор JSON сообщения и сохранение в базу, возвращает ответ клиенту"""
+        return self.process_messages([data])[0]
+    
+    def process_messages(self, messages, first_seq=None):
+        """Обработка нескольких сообщений: все показания ставятся в очередь
+        записи сразу, затем ожидаются их коммиты (один групповой коммит
+        на всю пачку строк потока)"""
+        pending = []
+        for message in messages:
+            try:
+                payload, readings, is_batch = self.parse_message(message)
+                pending.append((payload, is_batch, self.save_readings(readings), len(readings)))
+            except ValueError as e:
+                pending.append(self.error_response(str(e)))
+        
+        responses = []
+        for seq, item in enumerate(pending, first_seq or 0):
+            if isinstance(item, tuple):
+                payload, is_batch, future, count = item
+                item = self.build_response(payload, is_batch, self.wait_statuses(future, count))
+            if first_seq is not None:
+                item['seq'] = seq
+            responses.append(item)
+        return responses
+    
+    @staticmethod
+    def encode_acks(responses):
+        """Строки подтверждений NDJSON"""
+        return ''.join(json.dumps(response) + '\n' for response in responses).encode('utf-8')
+    
     def handle_client(self, client_socket, address):
         """Обработка клиентского подключения"""
+        self.update_stats(active=1)
         try:
             print(f"Handling connection from {address} - data_server.py:57")
             
-            # Получаем данные
-            data = client_socket.recv(4096).decode('utf-8')
-            if not data:
-                return
-            
-            print(f"Received data from {address}: {data[:100]}... - data_server.py:64")
+            client_socket.settimeout(self.config.SERVER.CLIENT_TIMEOUT)
+            framer = MessageFramer(self.config.SERVER.MAX_MESSAGE_SIZE)
+            seq = 0
             
-            # Парсим JSON
-            try:
-                sensor_data = json.loads(data)
-                print(f"Parsed data from {sensor_data.get('device_id', 'unknown')}: - data_server.py:69"
-                      f"temp={sensor_data.get('temperature')}, "
-                      f"humidity={sensor_data.get('humidity')}")
-                
-                # Сохраняем в базу данных
-                success = False
-                if self.db_manager:
-                    success = self.db_manager.save_sensor_data(sensor_data)
+            while self.is_running:
+                # Получаем данные
+                chunk = client_socket.recv(self.config.SERVER.RECV_SIZE)
+                messages = framer.feed(chunk) if chunk else framer.finish()
                 
-                # Отправляем ответ
-                response = {
-                    'status': 'success' if success else 'error',
-                    'message': 'Data received and saved' if success else 'Error saving data',
-                    'timestamp': datetime.now().isoformat()
-                }
+                if framer.mode == 'stream':
+                    # Подтверждения отправляются по порядку, клиент может не ждать их
+                    if messages:
+                        client_socket.sendall(self.encode_acks(self.process_messages(messages, seq)))
+                        seq += len(messages)
+                elif messages:
+                    data = messages[0].decode('utf-8', errors='replace')
+                    print(f"Received data from {address}: {data[:100]}... - data_server.py:214")
+                    
+                    response = self.process_message(messages[0])
+                    
+                    # Отправляем ответ клиенту
+                    response_json = json.dumps(response)
+                    client_socket.sendall(response_json.encode('utf-8'))
+                    print(f"Sent response: {response_json} - data_server.py:221")
+                    break
                 
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error: {e} - data_server.py:86")
-                response = {
-                    'status': 'error',
-                    'message': 'Invalid JSON data',
-                    'timestamp': datetime.now().isoformat()
-                }
-            
-            # Отправляем ответ клиенту
-            response_json = json.dumps(response)
-            client_socket.send(response_json.encode('utf-8'))
-            print(f"Sent response: {response_json} - data_server.py:96")
+                if not chunk:
+                    break
             
+        except socket.timeout:
+            # Клиент долго молчит - закрываем соединение без ответа
+            print(f"Connection with {address} timed out - data_server.py:229")
         except Exception as e:
             print(f"Error handling client {address}: {e} - data_server.py:99")
+            self.update_stats(failed=1)
             try:
                 error_response = {
                     'status': 'error',
@@ -107,6 +333,7 @@ class SensorDataServer:
             except:
                 pass
         finally:
+            self.update_stats(active=-1)
             client_socket.close()
             print(f"Connection with {address} closed - data_server.py:111")
     
@@ -128,6 +355,7 @@ class SensorDataServer:
                     # Принимаем подключения с таймаутом
                     client_socket, address = self.server_socket.accept()
                     print(f"New connection from {address} - data_server.py:130")
+                    self.update_stats(accepted=1)
                     
                     # Запускаем обработку в отдельном потоке
                     client_thread = threading.Thread(
@@ -162,7 +390,197 @@ class SensorDataServer:
                 print("Server socket closed - data_server.py:162")
             except Exception as e:
                 print(f"Error closing socket: {e} - data_server.py:164")
+        self.stop_writer()
         print("❌ Sensor data server stopped - data_server.py:165")
+    
+    def stop_writer(self):
+        """Дозапись очереди группового коммита и остановка фоновых задач"""
+        if self.storage:
+            self.storage.stop()
+
+
+class AsyncSensorDataServer(SensorDataServer):
+    """Сервер на asyncio: все подключения обслуживаются одним event loop,
+    работа с базой данных выносится в поток записи или пул потоков"""
+    
+    def __init__(self, config, storage=None):
+        super().__init__(config, storage)
+        self.loop = None
+        self.server = None
+        self.db_executor = ThreadPoolExecutor(
+            max_workers=config.SERVER.DB_WORKERS,
+            thread_name_prefix='db-worker'
+        )
+        self.client_limit = None
+        self.stopped = None
+        self.clients = set()
+    
+    async def handle_connection(self, reader, writer):
+        """Обработка клиентского подключения в event loop"""
+        address = writer.get_extra_info('peername')
+        self.update_stats(accepted=1)
+        
+        # Ограничение числа одновременных подключений
+        if self.client_limit.locked():
+            print(f"Connection limit reached, rejecting {address} - data_server.py:219")
+            self.update_stats(failed=1)
+            writer.close()
+            return
+        
+        async with self.client_limit:
+            self.update_stats(active=1)
+            self.clients.add(writer)
+            try:
+                framer = MessageFramer(self.config.SERVER.MAX_MESSAGE_SIZE)
+                seq = 0
+                
+                while self.is_running:
+                    chunk = await asyncio.wait_for(
+                        reader.read(self.config.SERVER.RECV_SIZE),
+                        timeout=self.config.SERVER.CLIENT_TIMEOUT
+                    )
+                    messages = framer.feed(chunk) if chunk else framer.finish()
+                    
+                    if framer.mode == 'stream':
+                        if messages:
+                            responses = await self.handle_messages(messages, seq)
+                            seq += len(messages)
+                            writer.write(self.encode_acks(responses))
+                            await writer.drain()
+                    elif messages:
+                        response = (await self.handle_messages(messages))[0]
+                        writer.write(json.dumps(response).encode('utf-8'))
+                        await writer.drain()
+                        break
+                    
+                    if not chunk:
+                        break
+                
+            except asyncio.TimeoutError:
+                # Клиент долго молчит - закрываем соединение без ответа
+                pass
+            except Exception as e:
+                print(f"Error handling client {address}: {e} - data_server.py:244")
+                self.update_stats(failed=1)
+                try:
+                    error_response = {
+                        'status': 'error',
+                        'message': str(e) or type(e).__name__,
+                        'timestamp': datetime.now().isoformat()
+                    }
+                    writer.write(json.dumps(error_response).encode('utf-8'))
+                    await writer.drain()
+                except Exception:
+                    pass
+            finally:
+                self.update_stats(active=-1)
+                self.clients.discard(writer)
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except Exception:
+                    pass
+    
+    async def handle_messages(self, messages, first_seq=None):
+        """Обработка сообщений без блокировки event loop.
+        
+        С потоком группового коммита показания ставятся в его очередь прямо из
+        event loop, и обработчик ждет Future коммита; без него вся работа
+        с базой данных выполняется в пуле потоков.
+        """
+        if not (self.storage and self.storage.async_writes):
+            return await self.loop.run_in_executor(
+                self.db_executor, self.process_messages, messages, first_seq
+            )
+        
+        pending = []
+        for message in messages:
+            try:
+                payload, readings, is_batch = self.parse_message(message)
+                future = self.storage.write_batch(readings, block=False)
+                pending.append((payload, is_batch, asyncio.wrap_future(future), len(readings)))
+            except ValueError as e:
+                pending.append(self.error_response(str(e)))
+            except queue.Full:
+                pending.append(self.error_response('Server busy, retry later'))
+        
+        responses = []
+        for seq, item in enumerate(pending, first_seq or 0):
+            if isinstance(item, tuple):
+                payload, is_batch, future, count = item
+                try:
+                    statuses = await asyncio.wait_for(
+                        future, timeout=self.config.DATABASE.WRITER_RESULT_TIMEOUT
+                    )
+                except Exception as e:
+                    print(f"Error saving data: {e} - data_server.py:510")
+                    statuses = [False] * count
+                item = self.build_response(payload, is_batch, statuses)
+            if first_seq is not None:
+                item['seq'] = seq
+            responses.append(item)
+        return responses
+    
+    async def report_stats(self):
+        """Периодический вывод счетчиков подключений"""
+        while self.is_running:
+            await asyncio.sleep(self.config.SERVER.STATS_INTERVAL)
+            stats = self.get_stats()
+            logging.info(f"Connections: accepted={stats['accepted']}, "
+                         f"active={stats['active']}, failed={stats['failed']}")
+    
+    async def serve(self):
+        """Запуск asyncio сервера и ожидание остановки"""
+        self.loop = asyncio.get_running_loop()
+        self.client_limit = asyncio.Semaphore(self.config.SERVER.MAX_CLIENTS)
+        self.stopped = asyncio.Event()
+        
+        self.server = await asyncio.start_server(
+            self.handle_connection,
+            self.host,
+            self.port,
+            backlog=self.config.SERVER.BACKLOG,
+            reuse_address=True
+        )
+        self.is_running = True
+        print(f"✅ Async sensor data server started on {self.host}:{self.port} - data_server.py:286")
+        
+        stats_task = asyncio.create_task(self.report_stats())
+        try:
+            async with self.server:
+                await self.stopped.wait()
+                # Закрываем постоянные соединения, чтобы обработчики завершились сами
+                for client in list(self.clients):
+                    client.transport.abort()
+                while self.get_stats()['active']:
+                    await asyncio.sleep(0.01)
+        finally:
+            stats_task.cancel()
+    
+    def start_server(self):
+        """Запуск сервера (блокирующий вызов)"""
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            print(f"Server startup error: {e} - data_server.py:152")
+        finally:
+            self.is_running = False
+            self.db_executor.shutdown(wait=True)
+            self.stop_writer()
+            print("❌ Sensor data server stopped - data_server.py:304")
+    
+    def stop_server(self):
+        """Остановка сервера (потокобезопасно)"""
+        self.is_running = False
+        if self.loop and self.stopped and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+
+def create_server(config, storage=None):
+    """Создание сервера в режиме, заданном Config.SERVER.MODE"""
+    if getattr(config.SERVER, 'MODE', 'threaded') == 'asyncio':
+        return AsyncSensorDataServer(config, storage)
+    return SensorDataServer(config, storage)
 
 def main():
     """Основная функция запуска сервера"""
@@ -173,7 +591,7 @@ def main():
     except:
         config = Config()  # Используем заглушку
     
-    server = SensorDataServer(config)
+    server = create_server(config)
     
     print("Press Ctrl+C to stop the server - data_server.py:178")
     
@@ -1,35 +1,267 @@
 # database.py - исправленная версия
-import sqlite3
 import logging
-from datetime import datetime
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from backup import BackupManager
+from config import DatabaseConfig
+from db_pool import get_pool
+from db_writer import GroupCommitWriter
+from deadband import DeadbandFilter
+from dedup import DedupCache
+from device_registry import DeviceRegistry
+from hot_tier import (EMPTY_SUMMARY, METRICS, HotTier, column_values, finish_summaries,
+                      merge_summaries, summarize)
+from ingest_stats import IngestStatistics, reconcile
+from last_values import LastValueCache, as_record
+from migrations import migrate, pending_tables, prepare
+from outbox import Outbox
+from partitions import LEGACY_TABLE, PartitionManager
+from pubsub import EventBus
+from rollups import RollupManager, backfill, parse_timestamp
+from timeutil import now_ms, to_epoch_ms, to_iso
+from scheduler import PeriodicTask
+from segment_log import SegmentLogWriter
 
 class DatabaseManager:
-    def __init__(self, db_path):
+    def __init__(self, db_path, db_config=None):
         self.db_path = db_path
+        self.db_config = db_config or DatabaseConfig()
+        self.pool = get_pool(db_path, self.db_config)
+        self.writer = None
+        self.tasks = []
+        # Коммит и обновление данных в памяти выполняются атомарно
+        # относительно сверки статистики
+        self.commit_lock = threading.Lock()
+        self.devices = DeviceRegistry()
+        self.stats = IngestStatistics(self.db_config.STATS_MINUTES_RETENTION)
+        self.rollups = RollupManager()
+        self.partitions = PartitionManager(self.db_config.PARTITIONING, self.db_config.RETENTION_PARTITIONS)
+        self.outbox = Outbox(self)
+        self.backups = BackupManager(self)
+        self.dedup = DedupCache(self.db_config.DEDUP_KEYS_PER_DEVICE, self.db_config.DEDUP_MAX_DEVICES)
+        self.last_values = LastValueCache()
+        self.events = EventBus()
+        self.deadband = None
+        if self.db_config.DEADBAND_ENABLED:
+            self.deadband = DeadbandFilter(self.db_config.DEADBAND_THRESHOLDS, self.db_config.DEADBAND_HEARTBEAT,
+                                           self.db_config.DEADBAND_DEVICE_THRESHOLDS)
+        self.hot = None
+        if self.db_config.HOT_TIER_ENABLED:
+            self.hot = HotTier(self.db_config.HOT_TIER_WINDOW, self.db_config.HOT_TIER_CAPACITY,
+                               self.db_config.HOT_TIER_MAX_DEVICES)
+        self.migration_pending = False
+        self.reconcile_needed = False
         self.init_database()
+        self.load_metadata()
+    
+    def load_metadata(self):
+        """Загрузка реестра устройств и счетчиков статистики"""
+        conn = self.pool.connection()
+        self.partitions.load(conn, self.legacy_bounds(conn))
+        self.devices.load(conn)
+        self.stats.load(conn)
+        self.warm_last_values(conn)
+        if self.db_config.DEDUP_SEED_SECONDS > 0:
+            self.dedup.seed(conn, self.data_tables(newest_first=False),
+                            now_ms() - int(self.db_config.DEDUP_SEED_SECONDS * 1000))
+        if self.hot and not self.migration_pending:
+            self.warm_hot_tier()
+        if (not self.stats.initialized or self.reconcile_needed) and not self.migration_pending:
+            # Счетчиков еще нет (новая или обновленная база) - считаем один раз
+            logging.info("Statistics counters missing or stale, reconciling from sensor_data")
+            reconcile(self)
+    
+    def start_writer(self):
+        """Запуск фоновой записи: групповой коммит или журнал сегментов"""
+        cfg = self.db_config
+        if self.writer is None and cfg.INGEST_MODE == 'segment_log':
+            self.writer = SegmentLogWriter(
+                self,
+                cfg.SEGMENT_DIR,
+                segment_bytes=cfg.SEGMENT_MAX_BYTES,
+                segment_age=cfg.SEGMENT_MAX_AGE,
+                fsync_interval=cfg.SEGMENT_FSYNC_INTERVAL_MS / 1000.0,
+                apply_rows=cfg.SEGMENT_APPLY_ROWS,
+                max_backlog_bytes=cfg.SEGMENT_MAX_BACKLOG_BYTES
+            )
+            self.writer.start()
+        elif self.writer is None:
+            self.writer = GroupCommitWriter(
+                self,
+                batch_size=cfg.WRITER_BATCH_SIZE,
+                flush_interval=cfg.WRITER_FLUSH_INTERVAL_MS / 1000.0,
+                queue_size=cfg.WRITER_QUEUE_SIZE
+            )
+            self.writer.start()
+        return self.writer
+    
+    def stop_writer(self):
+        """Остановка потока записи с дозаписью очереди"""
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
+        self.flush_metadata(force=True)
+    
+    def start_maintenance(self):
+        """Запуск периодических фоновых задач"""
+        if self.migration_pending:
+            task = PeriodicTask('schema-migration', self.db_config.MIGRATION_RETRY_INTERVAL,
+                                None, run_immediately=True)
+            task.func = lambda: self.migrate_schema(task.stop_event.is_set)
+            self.tasks.append(task)
+        if self.db_config.STATS_RECONCILE_INTERVAL > 0:
+            self.tasks.append(PeriodicTask(
+                'stats-reconcile', self.db_config.STATS_RECONCILE_INTERVAL, self.reconcile_statistics
+            ))
+        if self.partitions.enabled and self.db_config.RETENTION_PARTITIONS > 0:
+            self.tasks.append(PeriodicTask(
+                'partition-retention', self.db_config.RETENTION_CHECK_INTERVAL,
+                self.drop_expired_partitions, run_immediately=True
+            ))
+        if self.db_config.BACKUP_INTERVAL > 0:
+            self.tasks.append(PeriodicTask('backup', self.db_config.BACKUP_INTERVAL, self.backups.run_backup))
+        for task in self.tasks:
+            task.start()
+    
+    def stop_maintenance(self):
+        """Остановка фоновых задач"""
+        for task in self.tasks:
+            task.stop()
+        self.tasks = []
+    
+    def reconcile_statistics(self):
+        """Сверка счетчиков статистики с sensor_data"""
+        if self.migration_pending:
+            # Часть показаний еще в таблицах старой схемы
+            return 0
+        return reconcile(self)
+    
+    def migrate_schema(self, should_stop=None):
+        """Фоновый перенос показаний из таблиц старой схемы"""
+        if self.migration_pending:
+            migrate(self, self.db_config.MIGRATION_BATCH_SIZE, should_stop)
+    
+    def on_migrated(self):
+        """Завершение переноса: границы разделов и счетчики по всем данным"""
+        self.outbox = Outbox(self)
+        self.backups = BackupManager(self)
+        self.dedup = DedupCache(self.db_config.DEDUP_KEYS_PER_DEVICE, self.db_config.DEDUP_MAX_DEVICES)
+        self.migration_pending = False
+        self.reconcile_needed = False
+        conn = self.pool.connection()
+        self.partitions.load(conn, self.legacy_bounds(conn))
+        self.warm_last_values(conn)
+        if self.hot:
+            self.warm_hot_tier()
+        reconcile(self)
+    
+    def warm_last_values(self, conn=None):
+        """Заполнение кэша последних показаний из базы"""
+        return self.last_values.warm(
+            conn or self.pool.connection(), self.data_tables(),
+            [device['device_id'] for device in self.devices.snapshot()]
+        )
+    
+    def warm_hot_tier(self):
+        """Заполнение окна недавних показаний из базы.
+        
+        Снимок чтения открывается под commit_lock, поэтому показания,
+        закоммиченные после него, попадают в окно через on_committed.
+        """
+        since = now_ms() - self.hot.window_ms
+        metrics = ', '.join(METRICS)
+        last_id = 0
+        conn = self.pool.connect()
+        try:
+            with self.commit_lock:
+                self.hot.clear(since)
+                conn.execute('BEGIN')
+                tables = self.data_tables(since)
+                conn.execute(f'SELECT 1 FROM {tables[0]} LIMIT 1').fetchall() if tables else None
+            for table in tables:
+                self.hot.add_rows(conn.execute(f'''
+                    SELECT id, device_id, timestamp, {metrics} FROM {table}
+                    WHERE timestamp >= ?
+                    ORDER BY timestamp
+                ''', (since,)))
+                last_id = max(last_id, conn.execute(f'SELECT MAX(id) FROM {table}').fetchone()[0] or 0)
+            conn.execute('COMMIT')
+        finally:
+            self.pool.release(conn)
+        self.hot.mark_loaded(last_id)
+        devices, readings = self.hot.size()
+        logging.info(f"Hot tier loaded: {readings} readings of {devices} devices")
+    
+    def refresh_hot_tier(self):
+        """Дочитывание новых строк окна процессом, который сам не пишет показания"""
+        stale = time.monotonic() - self.hot.loaded_at > self.db_config.HOT_TIER_REFRESH
+        if not self.hot.ready or not stale or self.hot.local_updates:
+            return
+        since = now_ms() - self.hot.window_ms
+        metrics = ', '.join(METRICS)
+        conn = self.pool.connection()
+        # Под commit_lock строка не попадет в окно второй раз через on_committed
+        with self.commit_lock:
+            if self.hot.local_updates:
+                return
+            last_id = self.hot.last_id
+            for table in self.data_tables(since):
+                self.hot.add_rows(self.select_rows(conn, f'''
+                    SELECT id, device_id, timestamp, {metrics} FROM {table}
+                    WHERE id > ? AND timestamp >= ?
+                    ORDER BY id
+                ''', (last_id, since)))
+        self.hot.mark_loaded()
+    
+    def writer_tick(self, conn):
+        """Фоновые задачи, выполняемые потоком записи между коммитами"""
+        self.flush_metadata(conn)
+    
+    def flush_metadata(self, conn=None, force=False):
+        """Периодический сброс реестра устройств и счетчиков в базу"""
+        elapsed = time.monotonic() - self.devices.last_flush
+        if not force and elapsed < self.db_config.DEVICE_FLUSH_INTERVAL:
+            return 0
+        
+        with self.devices.lock:
+            pending = list(self.devices.dirty)
+        counters, minutes = [], []
+        try:
+            conn = conn or self.pool.connection()
+            with conn:
+                flushed = self.devices.flush(conn)
+                counters, minutes = self.stats.flush(conn)
+            return flushed
+        except Exception as e:
+            logging.error(f"Error flushing device registry: {e}")
+            self.devices.restore_dirty(pending)
+            self.stats.restore_dirty(counters, minutes)
+            return 0
+    
+    def close(self):
+        """Остановка записи и закрытие подключений"""
+        self.stop_maintenance()
+        self.stop_writer()
+        self.pool.close_all()
     
     def init_database(self):
         """Инициализация базы данных с исправленной схемой"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.pool.connection()
             cursor = conn.cursor()
             
-            # Таблица для данных сенсоров
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sensor_data (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT NOT NULL,
-                    device_type TEXT,
-                    location TEXT,
-                    temperature REAL,
-                    humidity REAL,
-                    light_level INTEGER,
-                    voltage REAL,
-                    timestamp TEXT NOT NULL,
-                    received_at TEXT NOT NULL,
-                    sent INTEGER DEFAULT 0  -- 0 = не отправлено, 1 = отправлено
-                )
-            ''')
+            # Таблица для данных сенсоров (раздел со старыми данными при разбиении)
+            PartitionManager.create_catalog(cursor)
+            conn.commit()
+            _, changed = prepare(conn, self.create_data_table)
+            self.reconcile_needed = changed > 0
+            self.migration_pending = bool(pending_tables(conn))
+            self.create_data_table(cursor, LEGACY_TABLE)
             
             # Таблица для информации об устройствах
             cursor.execute('''
@@ -43,31 +275,247 @@ class DatabaseManager:
                 )
             ''')
             
-            # Индексы для оптимизации
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sensor_device_id ON sensor_data(device_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sensor_timestamp ON sensor_data(timestamp)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sensor_sent ON sensor_data(sent)')
+            # Счетчики статистики и агрегаты по интервалам
+            IngestStatistics.create_tables(cursor)
+            RollupManager.create_tables(cursor)
+            Outbox.create_tables(cursor)
+            SegmentLogWriter.create_tables(cursor)
             
             conn.commit()
-            conn.close()
             logging.info("Database initialized successfully")
             
         except Exception as e:
             logging.error(f"Database initialization error: {e}")
             raise
     
+    @staticmethod
+    def create_data_table(cursor, name):
+        """Создание таблицы показаний (sensor_data или раздела) с индексами.
+        
+        В разделах id назначается явно из общей последовательности, поэтому
+        AUTOINCREMENT нужен только основной таблице.
+        """
+        autoincrement = ' AUTOINCREMENT' if name == LEGACY_TABLE else ''
+        prefix = 'idx_sensor' if name == LEGACY_TABLE else f'idx_{name}'
+        
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {name} (
+                id INTEGER PRIMARY KEY{autoincrement},
+                device_id TEXT NOT NULL,
+                device_type TEXT,
+                location TEXT,
+                temperature REAL,
+                humidity REAL,
+                light_level INTEGER,
+                voltage REAL,
+                timestamp INTEGER NOT NULL,    -- время показания, мс epoch
+                received_at INTEGER NOT NULL,  -- время приема, мс epoch
+                sent INTEGER DEFAULT 0  -- 0 = не отправлено, 1 = отправлено
+            )
+        ''')
+        
+        # Индексы для оптимизации: составной индекс обслуживает и фильтр
+        # по устройству, и сортировку по времени, а его уникальность
+        # отсекает повторно присланные показания
+        cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {prefix}_device_timestamp ON {name}(device_id, timestamp)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {prefix}_timestamp ON {name}(timestamp)')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {prefix}_sent ON {name}(sent)')
+    
+    @staticmethod
+    def legacy_bounds(conn):
+        """Время самого старого и самого нового показания в sensor_data"""
+        oldest, newest = conn.execute(
+            f'SELECT MIN(timestamp), MAX(timestamp) FROM {LEGACY_TABLE}'
+        ).fetchone()
+        oldest, newest = parse_timestamp(oldest), parse_timestamp(newest)
+        if oldest is None or newest is None:
+            return None
+        return oldest, newest
+    
+    def data_tables(self, start=None, end=None, newest_first=True):
+        """Таблицы показаний, пересекающиеся с диапазоном времени.
+        
+        Процесс, который сам не создает разделы, перечитывает каталог не
+        реже раза в PARTITIONS_REFRESH секунд, а также если конец диапазона
+        не покрыт известными разделами.
+        """
+        start_ms = None if start is None else to_epoch_ms(start)
+        end_ms = None if end is None else to_epoch_ms(end)
+        if self.partitions.needs_refresh(end_ms, self.db_config.PARTITIONS_REFRESH):
+            try:
+                self.partitions.refresh(self.pool.connection())
+            except Exception as e:
+                logging.error(f"Error reloading partition catalog: {e}")
+        return self.partitions.tables(start_ms, end_ms, newest_first)
+    
+    def select_rows(self, conn, query, params=()):
+        """Строки запроса к таблице показаний.
+        
+        Раздел, удаленный другим процессом после чтения каталога, считается
+        пустым, а каталог перечитывается при следующем обращении.
+        """
+        try:
+            return conn.execute(query, params).fetchall()
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            logging.warning(f"Partition catalog is stale: {e}")
+            self.partitions.invalidate()
+            return []
+    
     def save_sensor_data(self, data):
         """Сохранение данных сенсора"""
+        return self.save_sensor_data_batch([data])[0]
+    
+    # Самая поздняя метка времени, которую можно перевести в ISO-8601 (9999-12-31)
+    MAX_TIMESTAMP_MS = 253402300799999
+    
+    @classmethod
+    def is_valid_reading(cls, data):
+        """Проверка полей показания перед записью.
+        
+        Обязательны непустой device_id и timestamp; метрики - числа или None,
+        device_type и location - строки или None. Распознанная метка времени
+        должна попадать в [1970, 9999] год; нераспознанная строка заменяется
+        временем приема. Запись с неверными типами отклоняется здесь, а не
+        ошибкой привязки параметров, которая отменила бы всю транзакцию.
+        """
+        if not (isinstance(data, dict)
+                and isinstance(data.get('device_id'), str) and data['device_id'] != ''):
+            return False
+        for metric in METRICS:
+            value = data.get(metric)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                return False
+        for field in ('device_type', 'location'):
+            if data.get(field) is not None and not isinstance(data[field], str):
+                return False
+        timestamp = data.get('timestamp')
+        if isinstance(timestamp, str):
+            ts_ms = parse_timestamp(timestamp)
+            return ts_ms is None or 0 <= ts_ms <= cls.MAX_TIMESTAMP_MS
+        if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+            return False
+        ts_ms = parse_timestamp(timestamp)
+        return ts_ms is not None and 0 <= ts_ms <= cls.MAX_TIMESTAMP_MS
+    
+    def save_sensor_data_batch(self, readings):
+        """Сохранение пачки показаний одной транзакцией.
+        
+        Возвращает список флагов успеха в порядке входных данных:
+        записи, не прошедшие is_valid_reading, отклоняются, остальные
+        вставляются через executemany вместе с одним обновлением на
+        устройство. Если транзакция не удалась, показания повторяются по
+        одному, и отклоняются только те, которые записать нельзя.
+        При запущенном потоке записи ждет группового коммита.
+        """
+        if self.writer:
+            try:
+                return self.save_sensor_data_batch_async(readings).result(
+                    timeout=self.db_config.WRITER_RESULT_TIMEOUT
+                )
+            except Exception as e:
+                logging.error(f"Error saving sensor data: {e}")
+                return [False] * len(readings)
+        
+        statuses = [self.is_valid_reading(data) for data in readings]
+        valid = [data for data, ok in zip(readings, statuses) if ok]
+        if not valid:
+            return statuses
+        
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            with self.commit_lock:
+                with self.pool.transaction() as conn:
+                    received_at, stored, duplicates = self.write_readings(conn.cursor(), valid)
+                self.on_committed(stored, received_at, duplicates)
+            self.flush_metadata()
+            return statuses
             
-            # Сохраняем данные сенсора
-            cursor.execute('''
-                INSERT INTO sensor_data 
-                (device_id, device_type, location, temperature, humidity, light_level, voltage, timestamp, received_at, sent)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-            ''', (
+        except Exception as e:
+            logging.error(f"Error saving sensor data: {e}")
+        
+        # Пачка не записалась: показания повторяются по одному, чтобы
+        # отклонены были только те, которые записать нельзя
+        flags = iter([self.save_reading(data) for data in valid])
+        self.flush_metadata()
+        return [ok and next(flags) for ok in statuses]
+    
+    def save_reading(self, data):
+        """Запись одного проверенного показания отдельной транзакцией"""
+        try:
+            with self.commit_lock:
+                with self.pool.transaction() as conn:
+                    received_at, stored, duplicates = self.write_readings(conn.cursor(), [data])
+                self.on_committed(stored, received_at, duplicates)
+            return True
+        except Exception as e:
+            logging.error(f"Error saving reading of {data.get('device_id')}: {e}")
+            return False
+    
+    def save_sensor_data_batch_async(self, readings, callback=None, block=True):
+        """Асинхронное сохранение пачки показаний.
+        
+        Возвращает Future со списком флагов успеха, который завершается после
+        коммита транзакции потоком записи. Без потока записи данные
+        сохраняются сразу. При block=False и переполненной очереди
+        выбрасывает queue.Full.
+        """
+        result = Future()
+        if callback:
+            result.add_done_callback(callback)
+        
+        statuses = [self.is_valid_reading(data) for data in readings]
+        valid = [data for data, ok in zip(readings, statuses) if ok]
+        
+        if not valid or self.writer is None:
+            result.set_result(self.save_sensor_data_batch(readings) if valid else statuses)
+            return result
+        
+        def committed(future):
+            # Флаги потока записи относятся только к прошедшим проверку показаниям
+            flags = iter(future.result())
+            result.set_result([ok and next(flags) for ok in statuses])
+        
+        self.writer.submit(valid, callback=committed, block=block)
+        return result
+    
+    def write_readings(self, cursor, readings, received=None, deadband=True):
+        """Вставка проверенных показаний.
+        
+        Возвращает время приема, принятые показания - тройки (показание,
+        ключ, записано ли в таблицу) - и отброшенные повторы. Повтором
+        считается показание с уже сохраненной парой (device_id, timestamp):
+        он ищется в кэше недавних ключей, а при промахе кэша отсекается
+        уникальным индексом (INSERT OR IGNORE). Показания, не прошедшие
+        зону нечувствительности (DEADBAND_ENABLED), в таблицу не пишутся, но
+        учитываются в агрегатах. Таблица devices здесь не обновляется:
+        реестр устройств меняется после коммита и сбрасывается в базу
+        периодически.
+        received - время приема каждого показания в мс (по умолчанию текущее).
+        deadband=False отключает фильтр (перенос уже отфильтрованных данных).
+        """
+        received = received or [now_ms()] * len(readings)
+        
+        rows = {}
+        stored, duplicates, suppressed = [], [], []
+        batch_keys = set()
+        deadband_batch = {}
+        first_id = self.partitions.allocate_ids(len(readings)) if self.partitions.enabled else None
+        
+        for index, (data, received_ms) in enumerate(zip(readings, received)):
+            ts_ms = parse_timestamp(data['timestamp'])
+            # Нераспознанное время показания заменяется временем приема
+            key = (data['device_id'], ts_ms if ts_ms is not None else received_ms)
+            if key in batch_keys or (self.db_config.DEDUP_ENABLED and self.dedup.contains(*key)):
+                duplicates.append(data)
+                continue
+            batch_keys.add(key)
+            if (deadband and self.deadband and ts_ms is not None
+                    and not self.deadband.should_store(key, data, deadband_batch)):
+                suppressed.append((data, key, ts_ms))
+                continue
+            
+            row = (
                 data['device_id'],
                 data.get('device_type'),
                 data.get('location'),
@@ -75,56 +523,488 @@ class DatabaseManager:
                 data.get('humidity'),
                 data.get('light_level'),
                 data.get('voltage'),
-                data['timestamp'],
-                datetime.now().isoformat()
-            ))
+                key[1],
+                received_ms
+            )
+            if first_id is None:
+                table = LEGACY_TABLE
+            else:
+                table = self.partitions.ensure(cursor, key[1], self.create_data_table)
+                row = (first_id + index,) + row
+            rows.setdefault(table, []).append((row, data, key, ts_ms))
+        
+        # Сохраняем данные сенсоров
+        for table, table_rows in rows.items():
+            id_column = '' if first_id is None else 'id, '
+            id_value = '' if first_id is None else '?, '
+            last_id = cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+            cursor.executemany(f'''
+                INSERT OR IGNORE INTO {table} 
+                ({id_column}device_id, device_type, location, temperature, humidity, light_level, voltage, timestamp, received_at, sent)
+                VALUES ({id_value}?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+            ''', [item[0] for item in table_rows])
             
-            # Обновляем информацию об устройстве
-            cursor.execute('''
-                INSERT OR REPLACE INTO devices 
-                (device_id, device_type, location, first_seen, last_seen, total_records)
-                VALUES (
-                    ?,
-                    ?,
-                    ?,
-                    COALESCE((SELECT first_seen FROM devices WHERE device_id = ?), ?),
-                    ?,
-                    COALESCE((SELECT total_records FROM devices WHERE device_id = ?), 0) + 1
-                )
-            ''', (
+            if cursor.rowcount == len(table_rows):
+                stored.extend(item[1:] for item in table_rows)
+                continue
+            # Повтор вне кэша: сохранены только строки с id новее last_id
+            inserted = set(cursor.execute(
+                f'SELECT device_id, timestamp FROM {table} WHERE id > ?', (last_id,)
+            ).fetchall())
+            for _, data, key, ts_ms in table_rows:
+                if key in inserted:
+                    stored.append((data, key, ts_ms))
+                else:
+                    duplicates.append(data)
+        
+        # Агрегаты обновляются в той же транзакции по всем новым показаниям,
+        # включая не записанные в таблицу зоной нечувствительности
+        self.rollups.write(cursor, [(data, ts_ms) for data, _, ts_ms in stored + suppressed])
+        
+        accepted = [(data, key, True) for data, key, _ in stored]
+        accepted.extend((data, key, False) for data, key, _ in suppressed)
+        return to_iso(max(received)), accepted, duplicates
+    
+    def on_committed(self, stored, received_at, duplicates=()):
+        """Обновление данных в памяти после успешного коммита.
+        
+        stored - тройки (показание, ключ (device_id, время в мс), записано
+        ли в таблицу) из write_readings.
+        """
+        for data, key, written in stored:
+            self.devices.record(
                 data['device_id'],
                 data.get('device_type'),
                 data.get('location'),
-                data['device_id'],
-                datetime.now().isoformat(),
-                datetime.now().isoformat(),
-                data['device_id']
-            ))
-            
-            conn.commit()
-            conn.close()
-            return True
+                received_at,
+                count=1 if written else 0
+            )
+            self.dedup.add(*key)
+            self.last_values.update(data, key[1], received_at)
+            if written and self.hot:
+                self.hot.add(key[0], key[1], data)
+            if written and self.deadband:
+                self.deadband.commit(key, data)
+        rows = [data for data, _, written in stored if written]
+        self.stats.record(rows)
+        if self.deadband:
+            self.deadband.record(len(stored), len(rows))
+        if self.events.active:
+            self.events.publish([as_record(data, key[1], received_at) for data, key, _ in stored])
+        if duplicates:
+            self.stats.record_duplicates(duplicates)
+    
+    def get_devices(self):
+        """Список устройств из реестра в памяти.
+        
+        Процесс, который сам не пишет показания (например, веб-интерфейс),
+        периодически перечитывает таблицу devices.
+        """
+        stale = time.monotonic() - self.devices.loaded_at > self.db_config.DEVICE_FLUSH_INTERVAL
+        if stale and not self.devices.local_updates:
+            try:
+                self.devices.load(self.pool.connection())
+            except Exception as e:
+                logging.error(f"Error loading devices: {e}")
+        return self.devices.snapshot()
+    
+    def get_statistics(self):
+        """Статистика из счетчиков в памяти, без сканирования sensor_data"""
+        stale = time.monotonic() - self.stats.loaded_at > self.db_config.DEVICE_FLUSH_INTERVAL
+        if stale and not self.devices.local_updates:
+            try:
+                self.stats.load(self.pool.connection())
+            except Exception as e:
+                logging.error(f"Error loading statistics: {e}")
+        summary = self.stats.summary(self.get_devices())
+        if self.deadband:
+            summary['deadband'] = self.deadband.summary()
+        return summary
+    
+    def get_rollup_series(self, device_id, metric, start, end, max_points=500, resolution=None):
+        """Ряд агрегатов за диапазон времени (ISO строки или epoch).
+        
+        Разрешение выбирается автоматически по диапазону и бюджету точек,
+        если не задано явно ('1m', '1h', '1d').
+        """
+        return self.rollups.query(
+            self.pool.connection(), device_id, metric,
+            to_epoch_ms(start), to_epoch_ms(end), max_points, resolution
+        )
+    
+    def backfill_rollups(self, chunk_size=10000):
+        """Пересчет агрегатов по уже сохраненным данным"""
+        return backfill(self, chunk_size)
+    
+    RECORD_COLUMNS = ('id', 'device_id', 'device_type', 'location', 'temperature',
+                      'humidity', 'light_level', 'voltage', 'timestamp', 'received_at')
+    
+    @classmethod
+    def record_from_row(cls, row):
+        """Строка показаний в словарь с метками времени в ISO-8601"""
+        record = dict(zip(cls.RECORD_COLUMNS, row))
+        record['timestamp'] = to_iso(record['timestamp'])
+        record['received_at'] = to_iso(record['received_at'])
+        return record
+    
+    def get_recent_sensor_data(self, device_id=None, limit=50):
+        """Последние показания (всех устройств или одного), новые первыми.
+        
+        Разделы перебираются от нового к старому, пока не набрано limit строк.
+        """
+        columns = ', '.join(self.RECORD_COLUMNS)
+        conn = self.pool.connection()
+        data = []
+        for table in self.data_tables():
+            remaining = limit - len(data)
+            if remaining <= 0:
+                break
+            if device_id:
+                rows = self.select_rows(conn, f'''
+                    SELECT {columns} FROM {table}
+                    WHERE device_id = ?
+                    ORDER BY timestamp DESC
+                    LIMIT ?
+                ''', (device_id, remaining))
+            else:
+                rows = self.select_rows(conn, f'''
+                    SELECT {columns} FROM {table}
+                    ORDER BY timestamp DESC
+                    LIMIT ?
+                ''', (remaining,))
+            data.extend(self.record_from_row(row) for row in rows)
+        return data
+    
+    @classmethod
+    def check_columns(cls, columns):
+        """Столбцы проекции запроса (по умолчанию все RECORD_COLUMNS)"""
+        columns = list(columns or cls.RECORD_COLUMNS)
+        unknown = [column for column in columns if column not in cls.RECORD_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown column: {', '.join(unknown)}")
+        return columns
+    
+    @classmethod
+    def project(cls, row, columns):
+        """Строка показаний в словарь только с запрошенными столбцами"""
+        record = cls.record_from_row(row)
+        return {column: record[column] for column in columns}
+    
+    def get_history_rows(self, start, end, device_id=None, location=None, after=None, limit=1000):
+        """Строки RECORD_COLUMNS за [start, end] по возрастанию (timestamp, id).
+        
+        after - ключ (время в мс, id) последней строки предыдущей страницы.
+        Страница начинается сразу за ним по индексу timestamp (для одного
+        устройства - device_id, timestamp), к индексу добавлен rowid, поэтому
+        сортировка не нужна и стоимость страницы не зависит от ее номера.
+        """
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        filters, params = [], []
+        if device_id:
+            filters.append('AND device_id = ?')
+            params.append(device_id)
+        if location:
+            filters.append('AND location = ?')
+            params.append(location)
+        if after:
+            start_ms = max(start_ms, after[0])
+            filters.append('AND (timestamp > ? OR id > ?)')
+            params.extend(after)
+        columns = ', '.join(self.RECORD_COLUMNS)
+        conn = self.pool.connection()
+        rows = []
+        for table in self.data_tables(start_ms, end_ms, newest_first=False):
+            remaining = limit - len(rows)
+            if remaining <= 0:
+                break
+            rows.extend(self.select_rows(conn, f'''
+                SELECT {columns} FROM {table}
+                WHERE timestamp >= ? AND timestamp <= ? {' '.join(filters)}
+                ORDER BY timestamp, id
+                LIMIT ?
+            ''', [start_ms, end_ms] + params + [remaining]))
+        return rows
+    
+    def get_history(self, start, end, device_id=None, location=None, columns=None, after=None, limit=1000):
+        """Страница показаний за [start, end] с проекцией столбцов.
+        
+        Возвращает {'data', 'next'}: next - ключ (время в мс, id) для
+        следующей страницы или None, если страница последняя.
+        """
+        columns = self.check_columns(columns)
+        rows = self.get_history_rows(start, end, device_id, location, after, limit + 1)
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (rows[-1][8], rows[-1][0])
+        return {'data': [self.project(row, columns) for row in rows], 'next': next_key}
+    
+    def get_latest_readings(self, device_id=None):
+        """Последнее показание каждого устройства (или одного) из кэша.
+        
+        Процесс, который сам не пишет показания, перезаполняет кэш не чаще
+        раза в LAST_VALUES_REFRESH секунд.
+        """
+        stale = time.monotonic() - self.last_values.loaded_at > self.db_config.LAST_VALUES_REFRESH
+        if stale and not self.last_values.local_updates:
+            try:
+                self.get_devices()
+                self.warm_last_values()
+            except Exception as e:
+                logging.error(f"Error loading latest readings: {e}")
+        return self.last_values.get(device_id)
+    
+    def get_sensor_data_range(self, start, end, device_id=None, limit=10000):
+        """Показания за диапазон времени [start, end] по возрастанию времени.
+        
+        Запрос выполняется только по разделам, пересекающимся с диапазоном.
+        """
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        columns = ', '.join(self.RECORD_COLUMNS)
+        device_filter = 'AND device_id = ?' if device_id else ''
+        conn = self.pool.connection()
+        data = []
+        for table in self.data_tables(start_ms, end_ms, newest_first=False):
+            remaining = limit - len(data)
+            if remaining <= 0:
+                break
+            params = (start_ms, end_ms) + ((device_id,) if device_id else ()) + (remaining,)
+            rows = self.select_rows(conn, f'''
+                SELECT {columns} FROM {table}
+                WHERE timestamp >= ? AND timestamp <= ? {device_filter}
+                ORDER BY timestamp
+                LIMIT ?
+            ''', params)
+            data.extend(self.record_from_row(row) for row in rows)
+        return data
+    
+    def hot_split(self, device_id, start_ms, end_ms):
+        """Начало части диапазона, которая читается из окна в памяти (None - все из базы)"""
+        if not self.hot or not device_id:
+            return None
+        try:
+            self.refresh_hot_tier()
+        except Exception as e:
+            logging.error(f"Error refreshing hot tier: {e}")
+        covered = self.hot.coverage(device_id)
+        if covered is None or covered > end_ms:
+            return None
+        return max(start_ms, covered)
+    
+    @staticmethod
+    def check_metrics(metrics):
+        """Список метрик запроса (по умолчанию все)"""
+        metrics = list(metrics or METRICS)
+        unknown = [metric for metric in metrics if metric not in METRICS]
+        if unknown:
+            raise ValueError(f"Unknown metric: {', '.join(unknown)}")
+        return metrics
+    
+    def get_series(self, device_id, start, end, metrics=None, limit=10000):
+        """Значения метрик устройства за [start, end] по возрастанию времени.
+        
+        Недавняя часть диапазона берется из окна в памяти (HotTier), более
+        старая - из базы. source - 'memory', 'database' или 'mixed'.
+        """
+        metrics = self.check_metrics(metrics)
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        memory_from = self.hot_split(device_id, start_ms, end_ms)
+        db_end = end_ms if memory_from is None else memory_from - 1
+        
+        timestamps, values = [], {metric: [] for metric in metrics}
+        if start_ms <= db_end:
+            columns = ', '.join(metrics)
+            conn = self.pool.connection()
+            for table in self.data_tables(start_ms, db_end, newest_first=False):
+                remaining = limit - len(timestamps)
+                if remaining <= 0:
+                    break
+                rows = self.select_rows(conn, f'''
+                    SELECT timestamp, {columns} FROM {table}
+                    WHERE device_id = ? AND timestamp >= ? AND timestamp <= ?
+                    ORDER BY timestamp
+                    LIMIT ?
+                ''', (device_id, start_ms, db_end, remaining))
+                for row in rows:
+                    timestamps.append(row[0])
+                    for metric, value in zip(metrics, row[1:]):
+                        values[metric].append(value)
+        from_database = len(timestamps)
+        
+        if memory_from is not None and len(timestamps) < limit:
+            times, columns = self.hot.select(device_id, memory_from, end_ms)
+            times = times[:limit - len(timestamps)]
+            timestamps.extend(times.tolist())
+            for metric in metrics:
+                values[metric].extend(column_values(columns[METRICS.index(metric)][:len(times)]))
+        
+        if memory_from is None:
+            source = 'database'
+        else:
+            source = 'mixed' if from_database else 'memory'
+        return {
+            'device_id': device_id,
+            'count': len(timestamps),
+            'source': source,
+            'timestamp': [to_iso(timestamp) for timestamp in timestamps],
+            'values': values
+        }
+    
+    def iter_series_chunks(self, device_id, start, end, metrics=None, chunk_rows=100000):
+        """Значения метрик устройства за [start, end] пачками столбцов NumPy.
+        
+        Пачка - (метки времени int64 в мс, {метрика: float64, NaN - нет
+        значения}) не длиннее chunk_rows. Пачки читаются по индексу
+        (device_id, timestamp) с продолжением после последней метки, без
+        словарей и ISO-строк на каждую строку.
+        """
+        metrics = self.check_metrics(metrics)
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        columns = ', '.join(['timestamp'] + metrics)
+        conn = self.pool.connection()
+        for table in self.data_tables(start_ms, end_ms, newest_first=False):
+            after = start_ms - 1
+            while True:
+                rows = self.select_rows(conn, f'''
+                    SELECT {columns} FROM {table}
+                    WHERE device_id = ? AND timestamp > ? AND timestamp <= ?
+                    ORDER BY timestamp
+                    LIMIT ?
+                ''', (device_id, after, end_ms, chunk_rows))
+                if not rows:
+                    break
+                block = np.array(rows, dtype=np.float64)
+                yield block[:, 0].astype(np.int64), {metric: block[:, index + 1]
+                                                     for index, metric in enumerate(metrics)}
+                if len(rows) < chunk_rows:
+                    break
+                after = rows[-1][0]
+    
+    def get_aggregates(self, device_id, start, end, metrics=None):
+        """Число значений, минимум, максимум и среднее метрик устройства за [start, end]"""
+        metrics = self.check_metrics(metrics)
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        memory_from = self.hot_split(device_id, start_ms, end_ms)
+        db_end = end_ms if memory_from is None else memory_from - 1
+        summaries = {metric: dict(EMPTY_SUMMARY) for metric in metrics}
+        
+        if start_ms <= db_end:
+            columns = ', '.join(f'COUNT({metric}), MIN({metric}), MAX({metric}), SUM({metric})'
+                                for metric in metrics)
+            conn = self.pool.connection()
+            for table in self.data_tables(start_ms, db_end):
+                rows = self.select_rows(conn, f'''
+                    SELECT {columns} FROM {table}
+                    WHERE device_id = ? AND timestamp >= ? AND timestamp <= ?
+                ''', (device_id, start_ms, db_end))
+                if not rows:
+                    continue
+                row = rows[0]
+                for index, metric in enumerate(metrics):
+                    count, low, high, total = row[index * 4:index * 4 + 4]
+                    summaries[metric] = merge_summaries(
+                        summaries[metric], {'count': count, 'min': low, 'max': high, 'sum': total or 0.0}
+                    )
+        
+        if memory_from is not None:
+            _, columns = self.hot.select(device_id, memory_from, end_ms)
+            for metric in metrics:
+                summaries[metric] = merge_summaries(summaries[metric],
+                                                    summarize(columns[METRICS.index(metric)]))
+        
+        if memory_from is None:
+            source = 'database'
+        else:
+            source = 'memory' if memory_from <= start_ms else 'mixed'
+        return {
+            'device_id': device_id,
+            'source': source,
+            'metrics': finish_summaries(summaries)
+        }
+    
+    def drop_expired_partitions(self):
+        """Удаление самых старых разделов сверх DatabaseConfig.RETENTION_PARTITIONS.
+        
+        DROP TABLE освобождает страницы целиком без построчного DELETE и
+        VACUUM; освобожденные страницы переиспользуются новыми разделами.
+        Счетчики статистики уменьшаются на число удаленных строк.
+        """
+        dropped = []
+        for table in self.partitions.expired():
+            started = time.monotonic()
+            conn = self.pool.connection()
+            with self.commit_lock:
+                with conn:
+                    by_device = dict(conn.execute(
+                        f'SELECT device_id, COUNT(*) FROM {table} GROUP BY device_id'
+                    ).fetchall())
+                    by_location = {}
+                    for location, count in conn.execute(
+                            f'SELECT location, COUNT(*) FROM {table} GROUP BY location'):
+                        by_location[location or ''] = by_location.get(location or '', 0) + count
+                    
+                    conn.execute(f'DROP TABLE {table}')
+                    if table == LEGACY_TABLE:
+                        self.create_data_table(conn.cursor(), LEGACY_TABLE)
+                    self.partitions.forget(conn.cursor(), table)
+                
+                removed = sum(by_device.values())
+                self.stats.apply_drift(-removed, {key: -count for key, count in by_location.items()})
+                self.devices.apply_drift({key: -count for key, count in by_device.items()})
             
+            logging.info(f"Dropped partition {table} ({removed} rows) "
+                         f"in {time.monotonic() - started:.2f}s")
+            dropped.append(table)
+        
+        if dropped:
+            self.flush_metadata(force=True)
+        return dropped
+    
+    def claim_batch(self, consumer=None, limit=None, lease_seconds=None):
+        """Аренда пачки неотправленных показаний (см. Outbox.claim)"""
+        return self.outbox.claim(
+            consumer,
+            limit or self.db_config.OUTBOX_BATCH_SIZE,
+            lease_seconds or self.db_config.OUTBOX_LEASE_SECONDS
+        )
+    
+    def ack_batch(self, lease):
+        """Подтверждение отправки пачки, возвращает число помеченных строк"""
+        try:
+            return self.outbox.ack(lease)
         except Exception as e:
-            logging.error(f"Error saving sensor data: {e}")
-            return False
+            logging.error(f"Error acknowledging outbox batch: {e}")
+            return 0
+    
+    def release_batch(self, lease):
+        """Возврат пачки в очередь без подтверждения"""
+        try:
+            self.outbox.release(lease)
+        except Exception as e:
+            logging.error(f"Error releasing outbox batch: {e}")
+    
+    def get_outbox_status(self):
+        """Глубина очереди на пересылку и возраст самой старой записи"""
+        return self.outbox.status()
     
     def get_unsent_data(self, limit=10):
         """Получение неотправленных данных"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            cursor = self.pool.connection().cursor()
+            data = []
+            for table in self.data_tables(newest_first=False):
+                remaining = limit - len(data)
+                if remaining <= 0:
+                    break
+                cursor.execute(f'''
+                    SELECT id, device_id, temperature, humidity, light_level, timestamp 
+                    FROM {table} 
+                    WHERE sent = 0 
+                    ORDER BY id 
+                    LIMIT ?
+                ''', (remaining,))
+                data.extend(row[:5] + (to_iso(row[5]),) for row in cursor.fetchall())
             
-            cursor.execute('''
-                SELECT id, device_id, temperature, humidity, light_level, timestamp 
-                FROM sensor_data 
-                WHERE sent = 0 
-                ORDER BY timestamp 
-                LIMIT ?
-            ''', (limit,))
-            
-            data = cursor.fetchall()
-            conn.close()
             return data
             
         except Exception as e:
@@ -134,12 +1014,9 @@ class DatabaseManager:
     def mark_as_sent(self, record_id):
         """Пометить запись как отправленную"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            cursor.execute('UPDATE sensor_data SET sent = 1 WHERE id = ?', (record_id,))
-            conn.commit()
-            conn.close()
+            with self.pool.transaction() as conn:
+                for table in self.data_tables():
+                    conn.execute(f'UPDATE {table} SET sent = 1 WHERE id = ?', (record_id,))
             return True
             
         except Exception as e:
@@ -0,0 +1,129 @@
+# db_pool.py - Общие подключения к SQLite с настроенными PRAGMA
+import os
+import sqlite3
+import threading
+import logging
+import weakref
+from contextlib import contextmanager
+
+from config import DatabaseConfig
+
+
+class ThreadConnection:
+    """Подключение потока в threading.local; закрывается, когда поток завершается"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class ConnectionPool:
+    """Подключения к одной базе данных.
+
+    Каждый поток получает свое постоянное подключение (connection()), поэтому
+    подготовленные запросы переиспользуются из кэша sqlite3, а открытие
+    файла и настройка PRAGMA выполняются один раз на поток. Когда поток
+    завершается (например, поток запроса веб-сервера), его подключение
+    закрывается вместе с файлами WAL/SHM. Для выделенных
+    потоков (например, потока записи) connect() создает отдельное
+    подключение с теми же настройками.
+
+    В режиме WAL читатели не блокируют писателя и наоборот.
+    """
+
+    def __init__(self, db_path, db_config=None, row_factory=None, readonly=False):
+        self.db_path = db_path
+        self.db_config = db_config or DatabaseConfig()
+        self.row_factory = row_factory
+        self.readonly = readonly
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connect(self, synchronous=None):
+        """Новое подключение с настроенными PRAGMA (synchronous - вместо SYNCHRONOUS)"""
+        cfg = self.db_config
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=cfg.BUSY_TIMEOUT_MS / 1000.0,
+            cached_statements=cfg.STATEMENT_CACHE_SIZE,
+            check_same_thread=False
+        )
+        if self.row_factory:
+            conn.row_factory = self.row_factory
+
+        if not self.readonly:
+            # Режим журнала хранится в файле базы, менять его может только писатель
+            mode = conn.execute(f'PRAGMA journal_mode={cfg.JOURNAL_MODE}').fetchone()[0]
+            if mode.upper() != cfg.JOURNAL_MODE.upper():
+                logging.warning(f"SQLite journal_mode is {mode}, requested {cfg.JOURNAL_MODE}")
+        conn.execute(f'PRAGMA synchronous={synchronous or cfg.SYNCHRONOUS}')
+        conn.execute(f'PRAGMA busy_timeout={int(cfg.BUSY_TIMEOUT_MS)}')
+        conn.execute(f'PRAGMA cache_size={-int(cfg.CACHE_SIZE_KB)}')
+        conn.execute(f'PRAGMA mmap_size={int(cfg.MMAP_SIZE)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        if self.readonly:
+            conn.execute('PRAGMA query_only=1')
+
+        with self.lock:
+            self.connections.append(conn)
+        return conn
+
+    def connection(self):
+        """Постоянное подключение текущего потока"""
+        holder = getattr(self.local, 'holder', None)
+        if holder is None:
+            holder = ThreadConnection(self.connect())
+            # threading.local освобождает значения завершившегося потока,
+            # после чего подключение закрывается и удаляется из пула
+            weakref.finalize(holder, self.release, holder.conn)
+            self.local.holder = holder
+        return holder.conn
+
+    @contextmanager
+    def transaction(self):
+        """Подключение текущего потока внутри транзакции (commit/rollback)"""
+        conn = self.connection()
+        with conn:
+            yield conn
+
+    def release(self, conn):
+        """Закрытие подключения, полученного через connect()"""
+        with self.lock:
+            if conn in self.connections:
+                self.connections.remove(conn)
+        conn.close()
+
+    def close_all(self):
+        """Закрытие всех подключений пула (при остановке процесса)"""
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self.local = threading.local()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(db_path, db_config=None, row_factory=None, readonly=False):
+    """Общий пул для файла базы данных (один на процесс и набор параметров)"""
+    key = (os.path.abspath(db_path), row_factory, readonly)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(db_path, db_config, row_factory, readonly)
+            _pools[key] = pool
+        return pool
+
+
+def close_all_pools():
+    """Закрытие всех пулов процесса"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
@@ -0,0 +1,164 @@
+# db_writer.py - Фоновая запись показаний с групповым коммитом
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+
+class GroupCommitWriter:
+    """Единственный поток записи в базу данных.
+
+    Обработчики кладут пачки показаний в ограниченную очередь и получают
+    Future. Поток записи собирает из очереди до batch_size строк или ждет
+    не дольше flush_interval после первой пачки, записывает все одной
+    транзакцией и завершает Future всех участников коммита списком флагов
+    по показаниям пачки: True - данные зафиксированы на диске, False - не
+    записаны. Если общая транзакция не удалась, пачки повторяются по
+    отдельности (см. retry), и False получают только показания, которые
+    записать не удалось.
+    """
+
+    def __init__(self, db_manager, batch_size=5000, flush_interval=0.05, queue_size=100000,
+                 tick_interval=1.0):
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.tick_interval = tick_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.is_running = False
+        self.stop_requested = False
+
+        # Статистика работы
+        self.stats = {'commits': 0, 'rows': 0, 'failed_commits': 0, 'max_batch': 0}
+
+    def start(self):
+        """Запуск потока записи"""
+        if self.is_running:
+            return
+        self.is_running = True
+        self.stop_requested = False
+        self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+        self.thread.start()
+        logging.info(f"Group commit writer started (batch={self.batch_size}, "
+                     f"window={self.flush_interval * 1000:.0f} ms)")
+
+    def stop(self, timeout=10.0):
+        """Остановка потока после записи всего, что уже в очереди"""
+        if not self.is_running:
+            return
+        self.is_running = False
+        self.queue.put(None)
+        self.thread.join(timeout)
+        logging.info(f"Group commit writer stopped: {self.stats}")
+
+    def submit(self, readings, callback=None, block=True, timeout=None):
+        """Постановка пачки проверенных показаний в очередь записи.
+
+        Возвращает Future со списком флагов успеха. При переполненной очереди
+        блокируется (block=True) или выбрасывает queue.Full.
+        """
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        self.queue.put((readings, future), block=block, timeout=timeout)
+        return future
+
+    def pending(self):
+        """Количество пачек, ожидающих записи"""
+        return self.queue.qsize()
+
+    def collect_batch(self, first):
+        """Сбор пачек из очереди до заполнения группы или конца окна ожидания"""
+        batch = [first]
+        rows = len(first[0])
+        deadline = time.monotonic() + self.flush_interval
+
+        while rows < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    item = self.queue.get(timeout=remaining)
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Сигнал остановки: дописываем то, что осталось в очереди
+                self.stop_requested = True
+                continue
+            batch.append(item)
+            rows += len(item[0])
+
+        return batch, rows
+
+    def commit(self, conn, readings):
+        """Запись показаний одной транзакцией, True - транзакция зафиксирована"""
+        with self.db_manager.commit_lock:
+            try:
+                with conn:
+                    received_at, stored, duplicates = self.db_manager.write_readings(
+                        conn.cursor(), readings
+                    )
+            except Exception as e:
+                logging.error(f"Group commit of {len(readings)} readings failed: {e}")
+                self.stats['failed_commits'] += 1
+                return False
+            self.stats['commits'] += 1
+            self.stats['rows'] += len(readings)
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(readings))
+            self.db_manager.on_committed(stored, received_at, duplicates)
+        return True
+
+    def retry(self, conn, batch):
+        """Повтор после неудачного группового коммита.
+        
+        Каждая пачка пишется отдельной транзакцией, а пачка с ошибкой - по
+        одному показанию, поэтому ошибка одного показания не отклоняет
+        остальные показания ни своей, ни чужих пачек.
+        """
+        results = []
+        for items, _ in batch:
+            if len(batch) > 1 and self.commit(conn, items):
+                results.append([True] * len(items))
+            elif len(items) > 1:
+                results.append([self.commit(conn, [data]) for data in items])
+            else:
+                results.append([False])
+        return results
+
+    def run(self):
+        """Основной цикл потока записи"""
+        # Подтверждение означает запись на диск, поэтому коммиты потока
+        # записи ждут fsync (synchronous=FULL), а не только контрольной точки
+        conn = self.db_manager.pool.connect(self.db_manager.db_config.WRITER_SYNCHRONOUS)
+        try:
+            while True:
+                try:
+                    if self.stop_requested:
+                        first = self.queue.get_nowait()
+                    else:
+                        first = self.queue.get(timeout=self.tick_interval)
+                except queue.Empty:
+                    if self.stop_requested:
+                        break
+                    # Простой потока используется для фоновых задач менеджера
+                    self.db_manager.writer_tick(conn)
+                    continue
+                if first is None:
+                    self.stop_requested = True
+                    continue
+
+                batch, rows = self.collect_batch(first)
+                readings = [data for items, _ in batch for data in items]
+
+                if self.commit(conn, readings):
+                    results = [[True] * len(items) for items, _ in batch]
+                else:
+                    results = self.retry(conn, batch)
+                for (_, future), flags in zip(batch, results):
+                    future.set_result(flags)
+                self.db_manager.writer_tick(conn)
+        finally:
+            self.db_manager.pool.release(conn)
@@ -0,0 +1,88 @@
+# deadband.py - Отбрасывание почти не изменившихся показаний при приеме
+import threading
+
+from hot_tier import METRICS
+
+
+def changed(old, new, threshold):
+    """Изменилось ли значение метрики больше чем на threshold"""
+    if old is None or new is None:
+        return old is not new
+    try:
+        return abs(float(new) - float(old)) > threshold
+    except (TypeError, ValueError):
+        return old != new
+
+
+class DeadbandFilter:
+    """Зона нечувствительности по метрикам каждого устройства.
+
+    Показание записывается в таблицу, только если хотя бы одна метрика
+    отошла от последнего записанного значения устройства больше чем на
+    порог метрики, или с последней записанной строки устройства прошло
+    heartbeat секунд по времени показаний. Строки-пульс отличают ровный
+    сигнал от пропуска данных: пауза дольше heartbeat - это отсутствие
+    показаний. Показания старше последней записанной строки (опоздавшие)
+    записываются всегда.
+
+    Состояние меняется только после коммита (commit), внутри одной
+    транзакции решения учитывают строки этой же пачки через batch.
+    """
+
+    def __init__(self, thresholds, heartbeat_seconds=300.0, device_thresholds=None):
+        self.thresholds = dict(thresholds)
+        self.device_thresholds = device_thresholds or {}
+        self.heartbeat_ms = int(heartbeat_seconds * 1000)
+        self.last = {}
+        self.lock = threading.Lock()
+        self.readings = 0
+        self.stored = 0
+
+    def threshold(self, device_id, metric):
+        """Порог метрики устройства (0 - записывается любое изменение)"""
+        overrides = self.device_thresholds.get(device_id)
+        if overrides and metric in overrides:
+            return overrides[metric]
+        return self.thresholds.get(metric, 0.0)
+
+    def should_store(self, key, data, batch):
+        """Нужно ли записать показание; batch - записываемые строки текущей пачки"""
+        device_id, timestamp_ms = key
+        last = batch.get(device_id)
+        if last is None:
+            with self.lock:
+                last = self.last.get(device_id)
+        if last is not None and timestamp_ms < last[0]:
+            return True
+        store = (last is None
+                 or timestamp_ms - last[0] >= self.heartbeat_ms
+                 or any(changed(last[1][metric], data.get(metric), self.threshold(device_id, metric))
+                        for metric in METRICS))
+        if store:
+            batch[device_id] = (timestamp_ms, {metric: data.get(metric) for metric in METRICS})
+        return store
+
+    def commit(self, key, data):
+        """Учет записанной строки после коммита"""
+        device_id, timestamp_ms = key
+        with self.lock:
+            last = self.last.get(device_id)
+            if last is None or timestamp_ms >= last[0]:
+                self.last[device_id] = (timestamp_ms, {metric: data.get(metric) for metric in METRICS})
+
+    def record(self, readings, stored):
+        """Учет принятых и записанных показаний пачки"""
+        with self.lock:
+            self.readings += readings
+            self.stored += stored
+
+    def summary(self):
+        """Степень сокращения числа строк с момента запуска"""
+        with self.lock:
+            readings, stored = self.readings, self.stored
+        return {
+            'readings': readings,
+            'stored': stored,
+            'suppressed': readings - stored,
+            'reduction_ratio': round(1 - stored / readings, 4) if readings else 0.0
+        }
@@ -0,0 +1,65 @@
+# dedup.py - Кэш недавних ключей показаний для подавления повторов
+import threading
+from collections import OrderedDict
+
+
+class DedupCache:
+    """Недавние метки времени показаний по устройствам (LRU).
+
+    Устройство, не получившее подтверждение вовремя, повторяет отправку с той
+    же меткой времени. Ключ (device_id, timestamp) ищется здесь до вставки,
+    поэтому повтор отбрасывается без обращения к базе. Для каждого устройства
+    хранится не больше keys_per_device последних ключей, устройств - не
+    больше max_devices (давно молчащие вытесняются). Повторы, вышедшие за
+    пределы кэша, отсекает уникальный индекс (device_id, timestamp).
+    """
+
+    def __init__(self, keys_per_device=256, max_devices=100000):
+        self.keys_per_device = keys_per_device
+        self.max_devices = max_devices
+        self.devices = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def contains(self, device_id, timestamp):
+        """Был ли ключ уже сохранен"""
+        with self.lock:
+            keys = self.devices.get(device_id)
+            if keys is None or timestamp not in keys:
+                return False
+            keys.move_to_end(timestamp)
+            self.hits += 1
+            return True
+
+    def add(self, device_id, timestamp):
+        """Запоминание сохраненного ключа"""
+        with self.lock:
+            keys = self.devices.get(device_id)
+            if keys is None:
+                keys = self.devices[device_id] = OrderedDict()
+                if len(self.devices) > self.max_devices:
+                    self.devices.popitem(last=False)
+            else:
+                self.devices.move_to_end(device_id)
+            keys[timestamp] = None
+            keys.move_to_end(timestamp)
+            if len(keys) > self.keys_per_device:
+                keys.popitem(last=False)
+
+    def seed(self, conn, tables, since_ms):
+        """Заполнение кэша ключами показаний не старше since_ms"""
+        count = 0
+        for table in tables:
+            rows = conn.execute(
+                f'SELECT device_id, timestamp FROM {table} WHERE timestamp >= ? ORDER BY timestamp',
+                (since_ms,)
+            ).fetchall()
+            for device_id, timestamp in rows:
+                self.add(device_id, timestamp)
+            count += len(rows)
+        return count
+
+    def size(self):
+        """Число устройств и ключей в кэше"""
+        with self.lock:
+            return len(self.devices), sum(len(keys) for keys in self.devices.values())
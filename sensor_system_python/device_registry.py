@@ -0,0 +1,113 @@
+# device_registry.py - Реестр устройств в памяти
+import threading
+import time
+
+
+class DeviceRegistry:
+    """Сведения об устройствах (тип, место, first_seen, last_seen, число записей).
+
+    Загружается из таблицы devices при старте, обновляется за O(1) на каждое
+    показание и периодически сбрасывается в таблицу пакетным upsert только
+    для изменившихся устройств.
+    """
+
+    FIELDS = ('device_id', 'device_type', 'location', 'first_seen', 'last_seen', 'total_records')
+
+    def __init__(self):
+        self.devices = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.loaded_at = 0.0
+        self.last_flush = time.monotonic()
+        self.local_updates = 0
+
+    def load(self, conn):
+        """Загрузка реестра из таблицы devices"""
+        rows = conn.execute(
+            'SELECT device_id, device_type, location, first_seen, last_seen, total_records FROM devices'
+        ).fetchall()
+        with self.lock:
+            loaded = {row[0]: dict(zip(self.FIELDS, row)) for row in rows}
+            # Несброшенные изменения этого процесса важнее содержимого таблицы
+            for device_id in self.dirty:
+                loaded[device_id] = self.devices[device_id]
+            self.devices = loaded
+            self.loaded_at = time.monotonic()
+        return len(rows)
+
+    def record(self, device_id, device_type, location, seen_at, count=1):
+        """Учет новых показаний устройства"""
+        with self.lock:
+            device = self.devices.get(device_id)
+            if device is None:
+                device = {
+                    'device_id': device_id,
+                    'device_type': device_type,
+                    'location': location,
+                    'first_seen': seen_at,
+                    'last_seen': seen_at,
+                    'total_records': 0
+                }
+                self.devices[device_id] = device
+            device['device_type'] = device_type
+            device['location'] = location
+            device['last_seen'] = seen_at
+            device['total_records'] = (device['total_records'] or 0) + count
+            self.dirty.add(device_id)
+            self.local_updates += count
+
+    def flush(self, conn):
+        """Запись изменившихся устройств в таблицу devices (без commit)"""
+        with self.lock:
+            rows = [tuple(self.devices[device_id][field] for field in self.FIELDS)
+                    for device_id in self.dirty]
+            self.dirty = set()
+            self.last_flush = time.monotonic()
+
+        if rows:
+            conn.executemany('''
+                INSERT INTO devices
+                (device_id, device_type, location, first_seen, last_seen, total_records)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(device_id) DO UPDATE SET
+                    device_type = excluded.device_type,
+                    location = excluded.location,
+                    last_seen = excluded.last_seen,
+                    total_records = excluded.total_records
+            ''', rows)
+        return len(rows)
+
+    def restore_dirty(self, device_ids):
+        """Возврат устройств в список несброшенных после неудачной записи"""
+        with self.lock:
+            self.dirty.update(device_id for device_id in device_ids if device_id in self.devices)
+
+    def apply_drift(self, deltas):
+        """Исправление числа записей устройств на найденное расхождение"""
+        with self.lock:
+            for device_id, delta in deltas.items():
+                if not delta:
+                    continue
+                device = self.devices.setdefault(device_id, {
+                    'device_id': device_id,
+                    'device_type': None,
+                    'location': None,
+                    'first_seen': None,
+                    'last_seen': None,
+                    'total_records': 0
+                })
+                device['total_records'] = (device['total_records'] or 0) + delta
+                self.dirty.add(device_id)
+
+    def get(self, device_id):
+        """Сведения об одном устройстве"""
+        with self.lock:
+            device = self.devices.get(device_id)
+            return dict(device) if device else None
+
+    def snapshot(self):
+        """Все устройства, последние активные первыми"""
+        with self.lock:
+            devices = [dict(device) for device in self.devices.values()]
+        devices.sort(key=lambda device: device['last_seen'] or '', reverse=True)
+        return devices
@@ -0,0 +1,146 @@
+# downsample.py - Прореживание рядов для графиков (LTTB, минимум/максимум по интервалам)
+import numpy as np
+
+from hot_tier import METRICS, column_values
+from rollups import RESOLUTIONS
+from timeutil import to_epoch_ms, to_iso
+
+METHODS = ('lttb', 'minmax')
+MAX_POINTS = 5000
+# Сколько исходных значений еще прореживается напрямую, без агрегатов
+MAX_RAW_VALUES = 50000
+
+
+def lttb(x, y, threshold):
+    """Индексы точек, выбранных методом Largest-Triangle-Three-Buckets.
+
+    Первая и последняя точки сохраняются, остальные делятся на
+    threshold - 2 интервала; в каждом выбирается точка, образующая
+    наибольший треугольник с выбранной точкой предыдущего интервала и
+    средней точкой следующего. Средние всех интервалов считаются сразу
+    через накопленные суммы, площади внутри интервала - векторно.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    sum_x = np.concatenate(([0.0], np.cumsum(x)))
+    sum_y = np.concatenate(([0.0], np.cumsum(y)))
+    sizes = edges[1:] - edges[:-1]
+    # Средняя точка "следующего" интервала для каждого интервала; для последнего - последняя точка
+    next_x = np.append((sum_x[edges[1:]] - sum_x[edges[:-1]]) / sizes, x[-1])[1:]
+    next_y = np.append((sum_y[edges[1:]] - sum_y[edges[:-1]]) / sizes, y[-1])[1:]
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for bucket in range(threshold - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        area = np.abs((x[a] - next_x[bucket]) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (next_y[bucket] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
+
+
+def minmax(x, y, buckets):
+    """Индексы минимума и максимума в каждом из buckets равных по времени интервалов.
+
+    x упорядочен по возрастанию; результат - индексы по возрастанию, то
+    есть точки остаются в порядке времени.
+    """
+    n = len(x)
+    if n <= 2 * buckets:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.int64)
+    span = max(int(x[-1] - x[0]), 1)
+    bucket = np.minimum((x - x[0]) * buckets // span, buckets - 1)
+    order = np.lexsort((y, bucket))
+    sorted_buckets = bucket[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_buckets[1:] != sorted_buckets[:-1])))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate((order[starts], order[ends])))
+
+
+def rollup_chart(series, points, method):
+    """Ряд графика из агрегатов: среднее и границы min/max по интервалам"""
+    rows = series['points']
+    result = {
+        'source': f"rollup_{series['resolution']}",
+        'bucket_seconds': series['bucket_seconds'],
+        'input_points': len(rows)
+    }
+    if len(rows) > points:
+        x = np.array([to_epoch_ms(row['bucket']) for row in rows], dtype=np.int64)
+        y = np.array([row['avg'] for row in rows], dtype=np.float64)
+        index = lttb(x, y, points) if method == 'lttb' else minmax(x, y, points // 2)
+        rows = [rows[i] for i in index]
+    result['timestamp'] = [row['bucket'] for row in rows]
+    result['values'] = [row['avg'] for row in rows]
+    result['min'] = [row['min'] for row in rows]
+    result['max'] = [row['max'] for row in rows]
+    return result
+
+
+def raw_chart(storage, device_id, metric, start, end, points, method):
+    """Ряд графика из исходных показаний"""
+    chunks = list(storage.series_chunks(device_id, start, end, [metric]))
+    x = np.concatenate([timestamps for timestamps, _ in chunks] or [np.zeros(0, dtype=np.int64)])
+    y = np.concatenate([values[metric] for _, values in chunks] or [np.zeros(0)])
+    present = ~np.isnan(y)
+    x, y = x[present], y[present]
+    index = lttb(x, y, points) if method == 'lttb' else minmax(x, y, points // 2)
+    return {
+        'source': 'raw',
+        'input_points': len(x),
+        'timestamp': [to_iso(int(ts)) for ts in x[index]],
+        'values': column_values(y[index])
+    }
+
+
+def rollup_resolution(start_ms, end_ms, points):
+    """Самое грубое разрешение агрегатов, дающее в диапазоне не меньше points интервалов.
+
+    Если столько интервалов не дает ни одно разрешение - самое подробное.
+    """
+    span = max(end_ms - start_ms, 0) / 1000
+    widths = sorted(RESOLUTIONS.items(), key=lambda item: item[1])
+    for resolution, width in reversed(widths):
+        if span / width >= points:
+            return resolution
+    return widths[0][0]
+
+
+def chart_series(storage, device_id, metric, start, end, points=500, method='lttb'):
+    """Ряд метрики устройства за [start, end] не длиннее points точек.
+
+    Сначала читаются агрегаты RollupManager разрешения rollup_resolution():
+    их счетчики дают число исходных значений в диапазоне. Если значений не
+    больше MAX_RAW_VALUES или агрегатов меньше points, прореживаются сами
+    исходные показания методом method: 'lttb' сохраняет форму кривой,
+    'minmax' - пики (до двух точек на интервал). Иначе ряд строится по
+    агрегатам: в ответе среднее и границы min/max оставленных интервалов.
+    Хранилище без агрегатов всегда читает исходные показания.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+    if method not in METHODS:
+        raise ValueError(f"Unknown method: {method}")
+    if not 3 <= points <= MAX_POINTS:
+        raise ValueError(f"points must be between 3 and {MAX_POINTS}")
+    start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+    resolution = rollup_resolution(start_ms, end_ms, points)
+    try:
+        series = storage.rollup_series(device_id, metric, start_ms, end_ms, resolution=resolution)
+    except NotImplementedError:
+        series = None
+    if (series is None or len(series['points']) < points
+            or sum(row['count'] for row in series['points']) <= MAX_RAW_VALUES):
+        result = raw_chart(storage, device_id, metric, start_ms, end_ms, points, method)
+    else:
+        result = rollup_chart(series, points, method)
+    result.update({'device_id': device_id, 'metric': metric, 'method': method, 'count': len(result['values'])})
+    return result
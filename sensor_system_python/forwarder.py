@@ -0,0 +1,402 @@
+# forwarder.py - Пересылка показаний на центральный сервер
+import sys
+import json
+import gzip
+import time
+import random
+import socket
+import struct
+import logging
+import argparse
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scheduler import PeriodicTask
+
+
+class ForwardError(Exception):
+    """Пачка не принята сервером-получателем"""
+
+
+def encode_batch(lease, source):
+    """Тело пачки: JSON с показаниями и диапазоном id"""
+    return json.dumps({
+        'source': source,
+        'msg_id': lease['lease_id'],
+        'first_id': lease['first_id'],
+        'last_id': lease['last_id'],
+        'readings': lease['records']
+    }, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class HttpTransport:
+    """POST пачек по постоянному HTTP/1.1 соединению"""
+
+    def __init__(self, config):
+        self.config = config
+        self.conn = None
+
+    def send(self, body):
+        """Отправка тела, возвращает число байт на проводе"""
+        cfg = self.config
+        headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        if cfg.GZIP:
+            body = gzip.compress(body, cfg.GZIP_LEVEL)
+            headers['Content-Encoding'] = 'gzip'
+
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(cfg.UPSTREAM_HOST, cfg.UPSTREAM_PORT, timeout=cfg.TIMEOUT)
+        try:
+            self.conn.request('POST', cfg.UPSTREAM_PATH, body, headers)
+            response = self.conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            raise ForwardError(f"HTTP request failed: {e}")
+        if response.will_close:
+            self.close()
+        if not 200 <= response.status < 300:
+            raise ForwardError(f"Upstream returned HTTP {response.status}")
+        return len(body)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+class TcpTransport:
+    """Пачки по постоянному TCP соединению.
+
+    Без сжатия пачка отправляется строкой NDJSON, как принимает data_server.py
+    в потоковом режиме. Со сжатием - кадром: 4 байта длины (big-endian)
+    и gzip. В обоих случаях сервер отвечает строкой JSON со status.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.sock = None
+        self.reader = None
+
+    def send(self, body):
+        """Отправка тела и ожидание подтверждения, возвращает число байт"""
+        cfg = self.config
+        if cfg.GZIP:
+            compressed = gzip.compress(body, cfg.GZIP_LEVEL)
+            frame = struct.pack('>I', len(compressed)) + compressed
+        else:
+            frame = body + b'\n'
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection((cfg.UPSTREAM_HOST, cfg.UPSTREAM_PORT), timeout=cfg.TIMEOUT)
+                self.reader = self.sock.makefile('rb')
+            self.sock.sendall(frame)
+            line = self.reader.readline(65536)
+        except OSError as e:
+            self.close()
+            raise ForwardError(f"TCP send failed: {e}")
+        if not line:
+            self.close()
+            raise ForwardError("Upstream closed the connection")
+
+        try:
+            ack = json.loads(line)
+        except ValueError:
+            self.close()
+            raise ForwardError(f"Invalid acknowledgement: {line[:100]!r}")
+        # partial - часть строк отклонена как некорректная, повтор не поможет
+        if ack.get('status') not in ('success', 'partial'):
+            raise ForwardError(f"Upstream rejected batch: {ack.get('message', ack.get('status'))}")
+        return len(frame)
+
+    def close(self):
+        if self.sock:
+            try:
+                self.reader.close()
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+            self.reader = None
+
+
+TRANSPORTS = {'http': HttpTransport, 'tcp': TcpTransport}
+
+
+class UpstreamForwarder:
+    """Пересылка неотправленных показаний через аренду пачек outbox.
+
+    Каждый из MAX_IN_FLIGHT потоков держит свое постоянное соединение и не
+    более одной пачки в полете: арендует пачку, отправляет ее и подтверждает
+    (ack) после ответа сервера. При ошибке пачка возвращается в очередь,
+    а поток ждет с экспоненциальной задержкой и случайным разбросом.
+
+    Работает с одним файлом SQLite (DatabaseConfig.BACKEND='sqlite'):
+    шарды BACKEND='sharded' имеют независимые id и флаги sent, поэтому
+    с ними пересылка не запускается.
+    """
+
+    def __init__(self, db_manager, config):
+        self.db_manager = db_manager
+        self.config = config
+        self.consumer = f"{config.SOURCE_ID}:{socket.gethostname()}"
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.metrics_task = None
+        self.lock = threading.Lock()
+        self.metrics = {
+            'batches_sent': 0,
+            'rows_sent': 0,
+            'bytes_raw': 0,
+            'bytes_sent': 0,
+            'failures': 0,
+            'last_success': None,
+            'last_error': None
+        }
+        self.last_report = (time.monotonic(), 0)
+
+    def start(self):
+        """Запуск потоков пересылки"""
+        if self.config.PROTOCOL not in TRANSPORTS:
+            raise ValueError(f"Unknown forwarder protocol: {self.config.PROTOCOL}")
+        self.stop_event.clear()
+        for index in range(max(1, self.config.MAX_IN_FLIGHT)):
+            thread = threading.Thread(target=self.run, name=f'forwarder-{index}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        if self.config.METRICS_INTERVAL > 0:
+            self.metrics_task = PeriodicTask('forwarder-metrics', self.config.METRICS_INTERVAL, self.report_metrics)
+            self.metrics_task.start()
+        logging.info(f"Forwarding to {self.config.PROTOCOL}://{self.config.UPSTREAM_HOST}:"
+                     f"{self.config.UPSTREAM_PORT} with {len(self.threads)} batches in flight")
+
+    def stop(self, timeout=10.0):
+        """Остановка потоков (отправляемые пачки завершаются)"""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        if self.metrics_task:
+            self.metrics_task.stop()
+            self.metrics_task = None
+
+    def backoff_delay(self, failures):
+        """Экспоненциальная задержка с полным случайным разбросом"""
+        cfg = self.config
+        return random.uniform(0, min(cfg.BACKOFF_MAX, cfg.BACKOFF_INITIAL * (2 ** (failures - 1))))
+
+    def forward_once(self, transport):
+        """Аренда и отправка одной пачки, возвращает число строк (0 - очередь пуста)"""
+        cfg = self.config
+        lease = self.db_manager.claim_batch(self.consumer, cfg.BATCH_SIZE, cfg.LEASE_SECONDS)
+        if lease is None:
+            return 0
+
+        body = encode_batch(lease, cfg.SOURCE_ID)
+        try:
+            wire_bytes = transport.send(body)
+        except ForwardError:
+            self.db_manager.release_batch(lease)
+            raise
+        self.db_manager.ack_batch(lease)
+
+        with self.lock:
+            self.metrics['batches_sent'] += 1
+            self.metrics['rows_sent'] += len(lease['records'])
+            self.metrics['bytes_raw'] += len(body)
+            self.metrics['bytes_sent'] += wire_bytes
+            self.metrics['last_success'] = time.time()
+        return len(lease['records'])
+
+    def run(self):
+        """Основной цикл потока пересылки"""
+        transport = TRANSPORTS[self.config.PROTOCOL](self.config)
+        failures = 0
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    sent = self.forward_once(transport)
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    with self.lock:
+                        self.metrics['failures'] += 1
+                        self.metrics['last_error'] = str(e)
+                    delay = self.backoff_delay(failures)
+                    logging.warning(f"Forwarding failed ({e}), retry #{failures} in {delay:.1f}s")
+                    self.stop_event.wait(delay)
+                    continue
+                if not sent:
+                    self.stop_event.wait(self.config.IDLE_INTERVAL)
+        finally:
+            transport.close()
+
+    def get_metrics(self):
+        """Счетчики пересылки, скорость и отставание очереди"""
+        with self.lock:
+            metrics = dict(self.metrics)
+        now = time.monotonic()
+        since, rows_before = self.last_report
+        elapsed = now - since
+        metrics['rows_per_second'] = (metrics['rows_sent'] - rows_before) / elapsed if elapsed > 0 else 0.0
+        metrics['compression_ratio'] = (metrics['bytes_raw'] / metrics['bytes_sent']
+                                        if metrics['bytes_sent'] else None)
+        try:
+            outbox = self.db_manager.get_outbox_status()
+            metrics['queue_depth'] = outbox['depth']
+            metrics['lag_seconds'] = outbox['oldest_unsent_age_seconds']
+        except Exception as e:
+            logging.error(f"Error reading outbox status: {e}")
+        return metrics
+
+    def report_metrics(self):
+        """Периодический отчет о пересылке"""
+        metrics = self.get_metrics()
+        self.last_report = (time.monotonic(), metrics['rows_sent'])
+        logging.info(
+            f"Forwarder: {metrics['rows_sent']} rows in {metrics['batches_sent']} batches, "
+            f"{metrics['rows_per_second']:.0f} rows/s, queue {metrics.get('queue_depth')}, "
+            f"lag {metrics.get('lag_seconds', 0):.1f}s, failures {metrics['failures']}"
+        )
+
+
+class LocalCollector:
+    """Локальный заменитель центрального сервера для проверки пересылки.
+
+    Принимает пачки по HTTP или TCP (NDJSON и gzip кадры), считает принятые
+    строки и с вероятностью fail_rate отвечает ошибкой.
+    """
+
+    def __init__(self, host='localhost', port=9090, protocol='http', fail_rate=0.0):
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.fail_rate = fail_rate
+        self.batches = 0
+        self.rows = 0
+        self.ids = set()
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def accept(self, body):
+        """Учет пачки, False - имитация отказа"""
+        if self.fail_rate and random.random() < self.fail_rate:
+            return False
+        batch = json.loads(body)
+        with self.lock:
+            self.batches += 1
+            self.rows += len(batch['readings'])
+            self.ids.update(reading['id'] for reading in batch['readings'])
+        return True
+
+    def start(self):
+        """Запуск сервера в фоновом потоке"""
+        collector = self
+
+        class HttpHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                status = 200 if collector.accept(body) else 503
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        class TcpHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    first = self.rfile.peek(1)[:1]
+                    if not first:
+                        return
+                    if first == b'{':
+                        body = self.rfile.readline()
+                    else:
+                        header = self.rfile.read(4)
+                        if len(header) < 4:
+                            return
+                        body = gzip.decompress(self.rfile.read(struct.unpack('>I', header)[0]))
+                    if not body:
+                        return
+                    ok = collector.accept(body)
+                    ack = {'status': 'success'} if ok else {'status': 'error', 'message': 'Collector busy'}
+                    self.wfile.write(json.dumps(ack).encode('utf-8') + b'\n')
+
+        if self.protocol == 'http':
+            self.server = ThreadingHTTPServer((self.host, self.port), HttpHandler)
+        else:
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            self.server = socketserver.ThreadingTCPServer((self.host, self.port), TcpHandler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='collector', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Остановка сервера"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main():
+    """Командная строка: python forwarder.py [run|collector]"""
+    from config import Config
+    from database import DatabaseManager
+
+    cfg = Config.FORWARDER
+    parser = argparse.ArgumentParser(description='Sensor data upstream forwarder')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'collector'])
+    parser.add_argument('--db', default=Config.DATABASE.DB_PATH, help='database file')
+    parser.add_argument('--protocol', default=cfg.PROTOCOL, choices=sorted(TRANSPORTS))
+    parser.add_argument('--host', default=cfg.UPSTREAM_HOST)
+    parser.add_argument('--port', type=int, default=cfg.UPSTREAM_PORT)
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='collector: share of rejected batches')
+    args = parser.parse_args()
+
+    Config.setup_logging()
+    cfg.PROTOCOL, cfg.UPSTREAM_HOST, cfg.UPSTREAM_PORT = args.protocol, args.host, args.port
+
+    if args.command == 'collector':
+        collector = LocalCollector(args.host, args.port, args.protocol, args.fail_rate).start()
+        print(f"Collector listening on {args.protocol}://{args.host}:{collector.port} - forwarder.py:368")
+        try:
+            while True:
+                time.sleep(10)
+                print(f"Collector received {collector.rows} rows in {collector.batches} batches - forwarder.py:372")
+        except KeyboardInterrupt:
+            collector.stop()
+        return 0
+
+    if Config.DATABASE.BACKEND != 'sqlite':
+        # Файл DB_PATH не получает новых показаний, а шарды outbox не поддерживает
+        logging.error(f"The forwarder requires BACKEND='sqlite', configured: {Config.DATABASE.BACKEND}")
+        return 1
+
+    db_manager = DatabaseManager(args.db, Config.DATABASE)
+    forwarder = UpstreamForwarder(db_manager, cfg)
+    forwarder.start()
+    print("Press Ctrl+C to stop the forwarder - forwarder.py:380")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nStopping forwarder... - forwarder.py:385")
+    finally:
+        forwarder.stop()
+        db_manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+# hot_tier.py - Недавние показания устройств в столбцах NumPy
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from timeutil import now_ms
+
+METRICS = ('temperature', 'humidity', 'light_level', 'voltage')
+EMPTY_SUMMARY = {'count': 0, 'min': None, 'max': None, 'sum': 0.0}
+
+
+def to_float(value):
+    """Значение метрики в float, отсутствующее или нечисловое - NaN"""
+    try:
+        return math.nan if value is None else float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def column_values(values):
+    """Столбец NumPy в список для JSON: NaN заменяется на None"""
+    column = values.astype(object)
+    column[np.isnan(values)] = None
+    return column.tolist()
+
+
+def summarize(values):
+    """Число значений, минимум, максимум и сумма по массиву с NaN"""
+    present = values[~np.isnan(values)]
+    if not len(present):
+        return dict(EMPTY_SUMMARY)
+    return {'count': int(len(present)), 'min': float(present.min()),
+            'max': float(present.max()), 'sum': float(present.sum())}
+
+
+def merge_summaries(first, second):
+    """Объединение двух сводок summarize()"""
+    if not first['count']:
+        return dict(second)
+    if not second['count']:
+        return dict(first)
+    return {'count': first['count'] + second['count'],
+            'min': min(first['min'], second['min']),
+            'max': max(first['max'], second['max']),
+            'sum': first['sum'] + second['sum']}
+
+
+def finish_summaries(summaries):
+    """Сводки по метрикам для API: сумма заменяется средним"""
+    return {metric: {'count': summary['count'], 'min': summary['min'], 'max': summary['max'],
+                     'mean': summary['sum'] / summary['count'] if summary['count'] else None}
+            for metric, summary in summaries.items()}
+
+
+class DeviceWindow:
+    """Кольцевой буфер одного устройства: метки времени и столбцы метрик"""
+
+    __slots__ = ('timestamps', 'values', 'size', 'head', 'covered_from', 'newest')
+
+    def __init__(self, capacity, covered_from):
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.values = np.full((len(METRICS), capacity), np.nan)
+        self.size = 0
+        self.head = 0
+        # Все показания устройства с меткой не меньше covered_from есть в буфере
+        self.covered_from = covered_from
+        self.newest = covered_from
+
+    def append(self, timestamp_ms, row):
+        capacity = len(self.timestamps)
+        if self.size == capacity:
+            # Вытесняемое показание больше не в памяти
+            self.covered_from = max(self.covered_from, int(self.timestamps[self.head]) + 1)
+        else:
+            self.size += 1
+        self.timestamps[self.head] = timestamp_ms
+        self.values[:, self.head] = row
+        self.head = (self.head + 1) % capacity
+        self.newest = max(self.newest, timestamp_ms)
+
+    def select(self, start_ms, end_ms):
+        """Показания в [start_ms, end_ms] по возрастанию времени (копии)"""
+        timestamps = self.timestamps[:self.size]
+        index = np.flatnonzero((timestamps >= start_ms) & (timestamps <= end_ms))
+        index = index[np.argsort(timestamps[index], kind='stable')]
+        return timestamps[index], self.values[:, index]
+
+
+class HotTier:
+    """Скользящее окно недавних показаний в памяти (DatabaseConfig.HOT_TIER_*).
+
+    Для каждого устройства заранее выделяются столбцы на capacity показаний:
+    время (int64, мс epoch) и метрики METRICS (float64, NaN - нет значения).
+    Запросы за последние window секунд отбираются векторными операциями
+    без обращения к SQLite; более старая часть диапазона читается из базы.
+    Устройств - не больше max_devices, давно молчащие вытесняются. Память
+    ограничена max_devices * capacity * 40 байт.
+
+    Окно заполняется из базы при старте (warm), затем пополняется после
+    коммитов процесса приема (add). Процесс, который сам не пишет показания,
+    дочитывает новые строки по id (refresh).
+    """
+
+    def __init__(self, window_seconds=3600, capacity=3600, max_devices=1000):
+        self.window_ms = int(window_seconds * 1000)
+        self.capacity = capacity
+        self.max_devices = max_devices
+        self.devices = OrderedDict()
+        self.lock = threading.Lock()
+        self.ready = False
+        # Для новых устройств: раньше этой метки в памяти может не быть данных
+        self.complete_from = 0
+        self.last_id = 0
+        self.loaded_at = 0.0
+        self.local_updates = 0
+
+    def clear(self, complete_from):
+        """Сброс окна перед заполнением из базы"""
+        with self.lock:
+            self.devices = OrderedDict()
+            self.complete_from = complete_from
+            self.last_id = 0
+            self.ready = False
+
+    def add(self, device_id, timestamp_ms, data, local=True):
+        """Добавление сохраненного показания"""
+        row = [to_float(data.get(metric)) for metric in METRICS]
+        with self.lock:
+            window = self.devices.get(device_id)
+            if window is None:
+                window = self.devices[device_id] = DeviceWindow(self.capacity, self.complete_from)
+                if len(self.devices) > self.max_devices:
+                    _, evicted = self.devices.popitem(last=False)
+                    self.complete_from = max(self.complete_from, evicted.newest + 1)
+            else:
+                self.devices.move_to_end(device_id)
+            window.append(timestamp_ms, row)
+            if local:
+                self.local_updates += 1
+
+    def add_rows(self, rows):
+        """Добавление строк (id, device_id, timestamp, метрики...) из базы"""
+        last_id = 0
+        for row in rows:
+            self.add(row[1], row[2], dict(zip(METRICS, row[3:])), local=False)
+            last_id = max(last_id, row[0])
+        with self.lock:
+            self.last_id = max(self.last_id, last_id)
+
+    def coverage(self, device_id):
+        """Метка времени, начиная с которой окно устройства полно (None - нет в памяти)"""
+        with self.lock:
+            window = self.devices.get(device_id)
+            if not self.ready or window is None:
+                return None
+            return max(window.covered_from, now_ms() - self.window_ms)
+
+    def select(self, device_id, start_ms, end_ms):
+        """Время и столбцы метрик устройства за [start_ms, end_ms]"""
+        with self.lock:
+            window = self.devices.get(device_id)
+            if window is None:
+                return np.zeros(0, dtype=np.int64), np.zeros((len(METRICS), 0))
+            return window.select(start_ms, end_ms)
+
+    def size(self):
+        """Число устройств и показаний в окне"""
+        with self.lock:
+            return len(self.devices), sum(window.size for window in self.devices.values())
+
+    def mark_loaded(self, last_id=0):
+        """Окно заполнено из базы до строки last_id и может отвечать на запросы"""
+        with self.lock:
+            self.last_id = max(self.last_id, last_id or 0)
+            self.ready = True
+            self.loaded_at = time.monotonic()
@@ -0,0 +1,246 @@
+# ingest_stats.py - Счетчики записей, обновляемые при приеме данных
+import threading
+import time
+import logging
+from datetime import datetime
+
+
+class IngestStatistics:
+    """Статистика без сканирования sensor_data.
+
+    Общее число записей, записи по местоположениям и число записей по минутам
+    увеличиваются после каждого коммита и периодически сохраняются в небольшие
+    таблицы stats_counters и stats_minutes. Число записей по устройствам
+    хранит реестр устройств. Расхождения с фактическими данными исправляет
+    reconcile().
+    
+    Отброшенные повторы показаний считаются по устройствам (scope
+    'duplicate') и по минутам в памяти, чтобы были видны всплески повторных
+    отправок.
+    """
+
+    def __init__(self, minutes_retention=1440):
+        self.minutes_retention = minutes_retention
+        self.total_records = 0
+        self.locations = {}
+        self.minutes = {}
+        self.duplicates = {}
+        self.duplicate_minutes = {}
+        self.dirty_duplicates = set()
+        self.dirty_locations = set()
+        self.dirty_minutes = set()
+        self.total_dirty = False
+        self.initialized = False
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create_tables(cursor):
+        """Создание таблиц счетчиков"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (scope, key)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_minutes (
+                minute INTEGER PRIMARY KEY,  -- начало минуты, секунды epoch
+                count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+    def load(self, conn):
+        """Загрузка счетчиков из базы"""
+        counters = conn.execute('SELECT scope, key, value FROM stats_counters').fetchall()
+        minutes = conn.execute('SELECT minute, count FROM stats_minutes').fetchall()
+        with self.lock:
+            self.initialized = False
+            self.locations = {}
+            self.duplicates = {}
+            for scope, key, value in counters:
+                if scope == 'total':
+                    self.total_records = value
+                    self.initialized = True
+                elif scope == 'location':
+                    self.locations[key] = value
+                elif scope == 'duplicate':
+                    self.duplicates[key] = value
+            self.minutes = dict(minutes)
+            self.dirty_duplicates.clear()
+            self.dirty_locations.clear()
+            self.dirty_minutes.clear()
+            self.total_dirty = False
+            self.loaded_at = time.monotonic()
+
+    def record(self, readings, now=None):
+        """Учет записанных показаний"""
+        minute = int((now or time.time()) // 60 * 60)
+        with self.lock:
+            self.total_records += len(readings)
+            self.total_dirty = True
+            self.minutes[minute] = self.minutes.get(minute, 0) + len(readings)
+            self.dirty_minutes.add(minute)
+            for data in readings:
+                location = data.get('location') or ''
+                self.locations[location] = self.locations.get(location, 0) + 1
+                self.dirty_locations.add(location)
+
+    def record_duplicates(self, readings, now=None):
+        """Учет отброшенных повторов показаний"""
+        minute = int((now or time.time()) // 60 * 60)
+        with self.lock:
+            self.duplicate_minutes[minute] = self.duplicate_minutes.get(minute, 0) + len(readings)
+            for data in readings:
+                device_id = data['device_id']
+                self.duplicates[device_id] = self.duplicates.get(device_id, 0) + 1
+                self.dirty_duplicates.add(device_id)
+    
+    def has_changes(self):
+        """Есть ли несохраненные изменения"""
+        return (self.total_dirty or bool(self.dirty_locations) or bool(self.dirty_minutes)
+                or bool(self.dirty_duplicates))
+
+    def flush(self, conn):
+        """Сохранение изменившихся счетчиков (без commit)"""
+        with self.lock:
+            counters = [('location', location, self.locations[location])
+                        for location in self.dirty_locations]
+            counters.extend(('duplicate', device_id, self.duplicates[device_id])
+                            for device_id in self.dirty_duplicates)
+            if self.total_dirty:
+                counters.append(('total', '', self.total_records))
+            minutes = [(minute, self.minutes[minute]) for minute in self.dirty_minutes]
+            self.dirty_duplicates = set()
+            self.dirty_locations = set()
+            self.dirty_minutes = set()
+            self.total_dirty = False
+
+            # Старые минутные интервалы больше не нужны
+            oldest = int(time.time() // 60 * 60) - self.minutes_retention * 60
+            for minute in [minute for minute in self.minutes if minute < oldest]:
+                del self.minutes[minute]
+            for minute in [minute for minute in self.duplicate_minutes if minute < oldest]:
+                del self.duplicate_minutes[minute]
+
+        conn.executemany('''
+            INSERT INTO stats_counters (scope, key, value) VALUES (?, ?, ?)
+            ON CONFLICT(scope, key) DO UPDATE SET value = excluded.value
+        ''', counters)
+        conn.executemany('''
+            INSERT INTO stats_minutes (minute, count) VALUES (?, ?)
+            ON CONFLICT(minute) DO UPDATE SET count = excluded.count
+        ''', minutes)
+        conn.execute('DELETE FROM stats_minutes WHERE minute < ?', (oldest,))
+        return counters, minutes
+
+    def restore_dirty(self, counters, minutes):
+        """Возврат несохраненных счетчиков после неудачной записи"""
+        with self.lock:
+            for scope, key, _ in counters:
+                if scope == 'total':
+                    self.total_dirty = True
+                elif scope == 'duplicate':
+                    self.dirty_duplicates.add(key)
+                else:
+                    self.dirty_locations.add(key)
+            self.dirty_minutes.update(minute for minute, _ in minutes)
+
+    def snapshot(self):
+        """Копия текущих счетчиков"""
+        with self.lock:
+            return self.total_records, dict(self.locations)
+
+    def apply_drift(self, total_delta, location_deltas):
+        """Исправление счетчиков на найденное расхождение"""
+        with self.lock:
+            if total_delta:
+                self.total_records += total_delta
+                self.total_dirty = True
+            for location, delta in location_deltas.items():
+                if delta:
+                    self.locations[location] = self.locations.get(location, 0) + delta
+                    self.dirty_locations.add(location)
+            self.initialized = True
+
+    def records_per_minute(self, minutes=60):
+        """Число записей по минутам за последние minutes минут"""
+        current = int(time.time() // 60 * 60)
+        with self.lock:
+            return [
+                {'minute': datetime.fromtimestamp(minute).isoformat(),
+                 'count': self.minutes.get(minute, 0)}
+                for minute in range(current - (minutes - 1) * 60, current + 1, 60)
+            ]
+
+    def summary(self, devices):
+        """Сводка для API статистики"""
+        series = self.records_per_minute()
+        with self.lock:
+            return {
+                'total_records': self.total_records,
+                'device_count': len(devices),
+                'records_by_device': {device['device_id']: device['total_records'] for device in devices},
+                'records_by_location': {location or 'unknown': count
+                                        for location, count in self.locations.items()},
+                # Последняя полностью завершенная минута
+                'records_per_minute': series[-2]['count'] if len(series) > 1 else 0,
+                'records_per_minute_series': series,
+                'duplicates_suppressed': sum(self.duplicates.values()),
+                'duplicates_by_device': dict(self.duplicates),
+                'duplicates_per_minute': self.duplicate_minutes.get(int(time.time() // 60 * 60) - 60, 0),
+                'last_updated': datetime.now().isoformat()
+            }
+
+
+def reconcile(db_manager):
+    """Сверка счетчиков с фактическим содержимым sensor_data и ее разделов.
+
+    Снимок чтения WAL открывается под commit_lock вместе с копированием
+    счетчиков в памяти, поэтому сканирование идет без блокировки записи,
+    а найденное расхождение прибавляется к текущим значениям.
+    """
+    started = time.monotonic()
+    conn = db_manager.pool.connect()
+    try:
+        with db_manager.commit_lock:
+            conn.execute('BEGIN')
+            tables = db_manager.data_tables()
+            conn.execute(f'SELECT 1 FROM {tables[0]} LIMIT 1').fetchall() if tables else None
+            total_before, locations_before = db_manager.stats.snapshot()
+            devices_before = {device['device_id']: device['total_records'] or 0
+                              for device in db_manager.devices.snapshot()}
+
+        actual_locations = {}
+        actual_devices = {}
+        for table in tables:
+            for location, count in conn.execute(
+                    f'SELECT location, COUNT(*) FROM {table} GROUP BY location'):
+                actual_locations[location or ''] = actual_locations.get(location or '', 0) + count
+            for device_id, count in conn.execute(
+                    f'SELECT device_id, COUNT(*) FROM {table} GROUP BY device_id'):
+                actual_devices[device_id] = actual_devices.get(device_id, 0) + count
+        conn.execute('COMMIT')
+    finally:
+        db_manager.pool.release(conn)
+
+    total_delta = sum(actual_locations.values()) - total_before
+    location_deltas = {
+        location: actual_locations.get(location, 0) - locations_before.get(location, 0)
+        for location in set(actual_locations) | set(locations_before)
+    }
+    device_deltas = {
+        device_id: actual_devices.get(device_id, 0) - devices_before.get(device_id, 0)
+        for device_id in set(actual_devices) | set(devices_before)
+    }
+
+    db_manager.stats.apply_drift(total_delta, location_deltas)
+    db_manager.devices.apply_drift(device_deltas)
+    db_manager.flush_metadata(force=True)
+
+    drift = sum(abs(delta) for delta in device_deltas.values())
+    logging.info(f"Statistics reconciled in {time.monotonic() - started:.2f}s: "
+                 f"total drift {total_delta:+d}, device drift {drift}")
+    return total_delta
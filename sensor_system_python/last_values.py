@@ -0,0 +1,91 @@
+# last_values.py - Последние показания каждого устройства в памяти
+import threading
+import time
+
+from timeutil import to_iso
+
+# Поля показания в кэше (без id: при пакетной вставке он не известен)
+FIELDS = ('device_id', 'device_type', 'location', 'temperature', 'humidity',
+          'light_level', 'voltage', 'timestamp', 'received_at')
+
+
+def as_record(data, timestamp_ms, received_at):
+    """Показание в формате get(): поля FIELDS, метки времени в ISO-8601"""
+    record = {field: data.get(field) for field in FIELDS}
+    record['timestamp'] = to_iso(timestamp_ms)
+    record['received_at'] = to_iso(received_at)
+    return record
+
+
+class LastValueCache:
+    """Самое новое показание каждого устройства.
+
+    Обновляется после коммита каждой пачки, поэтому ответ "последние значения
+    всех устройств" собирается за O(устройств) без запросов к базе.
+    Показание с меткой времени старше уже сохраненного (опоздавшее или
+    повторно отправленное) кэш не меняет. При старте кэш заполняется
+    запросом по индексу (device_id, timestamp) - по одной строке на
+    устройство.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+        self.loaded_at = 0.0
+        self.local_updates = 0
+
+    def update(self, data, timestamp_ms, received_at):
+        """Учет сохраненного показания (метка времени в мс epoch)"""
+        device_id = data['device_id']
+        with self.lock:
+            current = self.values.get(device_id)
+            if current is not None and current[0] > timestamp_ms:
+                return
+            record = {field: data.get(field) for field in FIELDS}
+            record['timestamp'] = timestamp_ms
+            record['received_at'] = received_at
+            self.values[device_id] = (timestamp_ms, record)
+            self.local_updates += 1
+
+    def get(self, device_id=None):
+        """Последние показания всех устройств или одного, время в ISO-8601"""
+        with self.lock:
+            if device_id is not None:
+                entry = self.values.get(device_id)
+                records = [entry[1]] if entry else []
+            else:
+                records = [record for _, record in self.values.values()]
+        return [dict(record, timestamp=to_iso(record['timestamp']), received_at=to_iso(record['received_at']))
+                for record in records]
+
+    def warm(self, conn, tables, device_ids):
+        """Заполнение кэша: последняя строка каждого устройства.
+
+        Таблицы перебираются от новых к старым, устройство ищется только
+        до первой найденной строки. Метки времени в строках - мс epoch.
+        """
+        columns = ', '.join(FIELDS)
+        values = {}
+        missing = set(device_ids)
+        for table in tables:
+            if not missing:
+                break
+            for device_id in list(missing):
+                row = conn.execute(f'''
+                    SELECT {columns} FROM {table}
+                    WHERE device_id = ?
+                    ORDER BY timestamp DESC
+                    LIMIT 1
+                ''', (device_id,)).fetchone()
+                if row is not None:
+                    record = dict(zip(FIELDS, row))
+                    values[device_id] = (record['timestamp'], record)
+                    missing.discard(device_id)
+        with self.lock:
+            # Обновления, пришедшие во время запроса, новее результатов запроса
+            for device_id, entry in values.items():
+                current = self.values.get(device_id)
+                if current is None or current[0] < entry[0]:
+                    self.values[device_id] = entry
+            self.loaded_at = time.monotonic()
+        return len(values)
@@ -0,0 +1,275 @@
+# migrations.py - Версии схемы и перенос показаний в новую схему
+import time
+import logging
+
+from partitions import LEGACY_TABLE
+from rollups import parse_timestamp
+
+# Версия 2: timestamp и received_at - INTEGER, миллисекунды epoch
+# Версия 3: уникальный индекс (device_id, timestamp)
+SCHEMA_VERSION = 3
+
+# Таблица показаний в старой схеме, ожидающая переноса
+OLD_SUFFIX = '__v1'
+
+COLUMNS = ('id', 'device_id', 'device_type', 'location', 'temperature', 'humidity',
+           'light_level', 'voltage', 'timestamp', 'received_at', 'sent')
+
+# Значения показания: совпадение всех - копия повторной отправки
+VALUE_COLUMNS = COLUMNS[2:8]
+
+
+def table_columns(conn, name):
+    """Колонки таблицы и их объявленные типы"""
+    return {row[1]: (row[2] or '').upper() for row in conn.execute(f'PRAGMA table_info({name})')}
+
+
+def table_exists(conn, name):
+    """Есть ли таблица в базе"""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    ).fetchone() is not None
+
+
+def pending_tables(conn):
+    """Таблицы старой схемы, данные которых еще не перенесены"""
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"
+    ) if row[0].endswith(OLD_SUFFIX)]
+
+
+def prepare(conn, create_table):
+    """Перевод базы на текущую версию схемы без копирования данных.
+
+    Таблицы показаний со старыми TEXT метками времени переименовываются
+    в <имя>__v1, а на их месте создаются пустые таблицы новой схемы, поэтому
+    прием данных продолжается сразу. Последовательность id продолжается
+    после старых записей. Сами данные переносит migrate() в фоне.
+    
+    В таблицах версии 2 точные копии по (device_id, timestamp) удаляются,
+    остальные повторы разводятся по миллисекундам и создается уникальный
+    индекс. Возвращает список переименованных таблиц и число удаленных и
+    сдвинутых показаний.
+    """
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+        return [], 0
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Другой процесс мог выполнить перевод, пока мы ждали блокировку
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            conn.execute('COMMIT')
+            return [], 0
+
+        names = [LEGACY_TABLE] + [row[0] for row in conn.execute('SELECT name FROM sensor_partitions')]
+        renamed = []
+        for name in names:
+            columns = table_columns(conn, name)
+            if version >= 2 or not columns or columns.get('timestamp') == 'INTEGER':
+                continue
+            # Имена индексов освобождаются для таблицы новой схемы
+            indexes = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                (name,)
+            )]
+            for index in indexes:
+                conn.execute(f'DROP INDEX {index}')
+            conn.execute(f'ALTER TABLE {name} RENAME TO {name}{OLD_SUFFIX}')
+            create_table(conn.cursor(), name)
+            renamed.append(name)
+
+        if renamed:
+            last_ids = [conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {name}{OLD_SUFFIX}').fetchone()[0]
+                        for name in renamed]
+            sequence = conn.execute(
+                'SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name IN ({})'.format(
+                    ', '.join('?' * (len(renamed) + 1))),
+                [LEGACY_TABLE + OLD_SUFFIX] + renamed
+            ).fetchone()[0]
+            if table_exists(conn, LEGACY_TABLE):
+                conn.execute('DELETE FROM sqlite_sequence WHERE name = ?', (LEGACY_TABLE,))
+                conn.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+                             (LEGACY_TABLE, max(last_ids + [sequence])))
+
+        removed = spread = 0
+        for name in names:
+            if version < 3 and name not in renamed and table_exists(conn, name):
+                dropped, shifted = add_unique_key(conn, name, create_table)
+                removed += dropped
+                spread += shifted
+
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    if renamed:
+        logging.info(f"Schema upgraded to version {SCHEMA_VERSION}, "
+                     f"data migration pending for: {', '.join(renamed)}")
+    if removed or spread:
+        logging.info(f"Duplicate (device_id, timestamp): dropped {removed} identical copies, "
+                     f"moved {spread} differing readings to the next free millisecond")
+    return renamed, removed + spread
+
+
+def place_reading(conn, name, row_id, device_id, timestamp, values, taken=None):
+    """Метка времени для показания или None, если это копия уже записанного.
+
+    Пока пара (device_id, timestamp) занята другим показанием, метка
+    сдвигается на 1 мс. Показание с теми же значениями, что у занявшего
+    пару, - повтор отправки. taken - показания пачки, еще не записанные в таблицу.
+    """
+    while True:
+        occupant = taken.get((device_id, timestamp)) if taken else None
+        if occupant is None:
+            row = conn.execute(
+                f'SELECT {", ".join(VALUE_COLUMNS)} FROM {name} '
+                f'WHERE device_id = ? AND timestamp = ? AND id != ?',
+                (device_id, timestamp, row_id)
+            ).fetchone()
+            occupant = tuple(row) if row else None
+        if occupant is None:
+            return timestamp
+        if occupant == values:
+            return None
+        timestamp += 1
+
+
+def add_unique_key(conn, name, create_table):
+    """Удаление повторов (device_id, timestamp) и создание уникального индекса.
+
+    Точные копии (повторная отправка) удаляются, остается запись с
+    наименьшим id. Старые метки времени бывали с точностью до секунды,
+    поэтому совпадения с другими значениями - разные показания: они по
+    порядку id сдвигаются на ближайшую свободную миллисекунду.
+    Возвращает (удалено, сдвинуто).
+    """
+    removed = conn.execute(f'''
+        DELETE FROM {name} WHERE id NOT IN (
+            SELECT MIN(id) FROM {name} GROUP BY device_id, timestamp, {', '.join(VALUE_COLUMNS)}
+        )
+    ''').rowcount
+    duplicates = conn.execute(f'''
+        SELECT id, device_id, timestamp, {', '.join(VALUE_COLUMNS)} FROM {name} WHERE id NOT IN (
+            SELECT MIN(id) FROM {name} GROUP BY device_id, timestamp
+        )
+        ORDER BY id
+    ''').fetchall()
+    spread = 0
+    for row_id, device_id, timestamp, *values in duplicates:
+        timestamp = place_reading(conn, name, row_id, device_id, timestamp, tuple(values))
+        if timestamp is None:
+            # Копия показания, сдвинутого раньше
+            conn.execute(f'DELETE FROM {name} WHERE id = ?', (row_id,))
+            removed += 1
+        else:
+            conn.execute(f'UPDATE {name} SET timestamp = ? WHERE id = ?', (timestamp, row_id))
+            spread += 1
+    for _, index, unique, _, _ in conn.execute(f'PRAGMA index_list({name})').fetchall():
+        columns = [row[2] for row in conn.execute(f'PRAGMA index_info({index})')]
+        if not unique and columns == ['device_id', 'timestamp']:
+            conn.execute(f'DROP INDEX {index}')
+    create_table(conn.cursor(), name)
+    return removed, spread
+
+
+def convert_row(row):
+    """Строка старой схемы в строку новой: метки времени в мс epoch"""
+    row = list(row)
+    received_ms = parse_timestamp(row[9])
+    timestamp_ms = parse_timestamp(row[8])
+    row[8] = timestamp_ms if timestamp_ms is not None else (received_ms or 0)
+    row[9] = received_ms if received_ms is not None else row[8]
+    row[10] = row[10] or 0
+    return row
+
+
+def migrate_table(db_manager, conn, old, batch_size, should_stop=None):
+    """Перенос одной таблицы порциями по id в коротких транзакциях.
+
+    Перенесенные строки образуют префикс по id, поэтому после перезапуска
+    перенос продолжается с последнего перенесенного id. Показания с уже
+    занятой парой (device_id, timestamp) переносятся на ближайшую свободную
+    миллисекунду, как в add_unique_key. Возвращает число перенесенных строк
+    или None, если перенос прерван.
+    """
+    name = old[:-len(OLD_SUFFIX)]
+    if not table_exists(conn, name):
+        # Раздел уже удален по сроку хранения
+        with db_manager.commit_lock:
+            with conn:
+                conn.execute(f'DROP TABLE {old}')
+        return 0
+
+    columns = table_columns(conn, old)
+    select = ', '.join(column if column in columns else 'NULL' for column in COLUMNS)
+    last_old_id = conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {old}').fetchone()[0]
+    cursor_id = conn.execute(
+        f'SELECT COALESCE(MAX(id), 0) FROM {name} WHERE id <= ?', (last_old_id,)
+    ).fetchone()[0]
+
+    moved = removed = spread = 0
+    while True:
+        if should_stop and should_stop():
+            return None
+        rows = conn.execute(
+            f'SELECT {select} FROM {old} WHERE id > ? ORDER BY id LIMIT ?', (cursor_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        converted = [convert_row(row) for row in rows]
+        with db_manager.commit_lock:
+            with conn:
+                # Ключи проверяются под commit_lock: прием не займет их до вставки
+                taken = {}
+                kept = []
+                for row in converted:
+                    values = tuple(row[2:8])
+                    timestamp = place_reading(conn, name, row[0], row[1], row[8], values, taken)
+                    if timestamp is None:
+                        removed += 1
+                        continue
+                    spread += timestamp != row[8]
+                    row[8] = timestamp
+                    taken[(row[1], timestamp)] = values
+                    kept.append(row)
+                conn.executemany(f'''
+                    INSERT OR IGNORE INTO {name} ({', '.join(COLUMNS)})
+                    VALUES ({', '.join('?' * len(COLUMNS))})
+                ''', kept)
+        cursor_id = rows[-1][0]
+        moved += len(rows)
+    if removed or spread:
+        logging.info(f"{old}: duplicate (device_id, timestamp): dropped {removed} identical copies, "
+                     f"moved {spread} differing readings to the next free millisecond")
+
+    with db_manager.commit_lock:
+        with conn:
+            conn.execute(f'DROP TABLE {old}')
+    return moved
+
+
+def migrate(db_manager, batch_size=5000, should_stop=None):
+    """Перенос данных всех таблиц старой схемы.
+
+    Выполняется в фоне при работающем приеме данных. Пока перенос не
+    закончен, еще не перенесенные старые показания не видны в запросах.
+    """
+    conn = db_manager.pool.connect()
+    try:
+        tables = pending_tables(conn)
+        for old in tables:
+            started = time.monotonic()
+            moved = migrate_table(db_manager, conn, old, batch_size, should_stop)
+            if moved is None:
+                logging.info(f"Migration of {old} interrupted")
+                return False
+            logging.info(f"Migrated {moved} rows from {old} in {time.monotonic() - started:.1f}s")
+    finally:
+        db_manager.pool.release(conn)
+
+    if tables:
+        db_manager.on_migrated()
+    return True
@@ -0,0 +1,191 @@
+# npy_export.py - Выгрузка показаний в столбцы NumPy (.npy/.npz)
+import io
+import os
+import sys
+import shutil
+import zipfile
+import argparse
+import tempfile
+
+import numpy as np
+
+from hot_tier import METRICS
+
+DTYPES = {'float64': np.float64, 'float32': np.float32}
+DEVICES_FILE = 'devices.npy'
+
+
+def header(dtype, count):
+    """Заголовок .npy одномерного массива (длина не зависит от count)"""
+    output = io.BytesIO()
+    np.lib.format.write_array_header_1_0(output, {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False,
+        'shape': (count,)
+    })
+    return output.getvalue()
+
+
+class ColumnFileWriter:
+    """Одномерные массивы .npy, дописываемые пачками.
+
+    Файл начинается с заголовка нулевой длины. NumPy дополняет заголовок
+    пробелами под любое число элементов, поэтому после записи всех пачек
+    заголовок переписывается на месте с итоговой длиной.
+    """
+
+    def __init__(self, directory, dtypes):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.dtypes = dtypes
+        self.count = 0
+        self.files = {}
+        for name, dtype in dtypes.items():
+            f = open(os.path.join(directory, f'{name}.npy'), 'wb')
+            f.write(header(dtype, 0))
+            self.files[name] = f
+
+    def append(self, columns):
+        """Дописать пачку: столбцы одинаковой длины"""
+        length = None
+        for name, values in columns.items():
+            values = np.ascontiguousarray(values, dtype=self.dtypes[name])
+            length = len(values)
+            self.files[name].write(values.tobytes())
+        self.count += length or 0
+
+    def close(self):
+        for name, f in self.files.items():
+            data = header(self.dtypes[name], self.count)
+            f.seek(0)
+            if len(data) != len(header(self.dtypes[name], 0)):
+                raise RuntimeError(f"Cannot rewrite .npy header of {name}")
+            f.write(data)
+            f.close()
+        self.files = {}
+
+
+def export_columns(storage, directory, device_ids, start, end, metrics=None,
+                   dtype='float64', chunk_rows=100000):
+    """Показания устройств за [start, end] в файлы .npy каталога directory.
+
+    Столбцы: timestamp (int64, мс epoch), device (int32, номер устройства в
+    devices.npy) и метрики (float64 или float32, NaN - нет значения).
+    Строки упорядочены по устройству, внутри устройства - по времени.
+    В памяти одновременно только одна пачка из chunk_rows строк.
+    """
+    metrics = list(metrics or METRICS)
+    dtypes = {'timestamp': np.int64, 'device': np.int32}
+    dtypes.update((metric, DTYPES[dtype]) for metric in metrics)
+    writer = ColumnFileWriter(directory, dtypes)
+    try:
+        for index, device_id in enumerate(device_ids):
+            for timestamps, values in storage.series_chunks(device_id, start, end, metrics, chunk_rows):
+                columns = {'timestamp': timestamps, 'device': np.full(len(timestamps), index)}
+                columns.update(values)
+                writer.append(columns)
+    finally:
+        writer.close()
+    np.save(os.path.join(directory, DEVICES_FILE), np.array(list(device_ids), dtype=str))
+    return {'rows': writer.count, 'devices': list(device_ids), 'columns': list(dtypes)}
+
+
+def load_columns(directory, mmap=True):
+    """Столбцы выгрузки; при mmap=True файлы отображаются в память, а не читаются"""
+    columns = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.npy'):
+            columns[name[:-4]] = np.load(os.path.join(directory, name), mmap_mode='r' if mmap else None)
+    return columns
+
+
+class ChunkSink(io.RawIOBase):
+    """Файл только для записи, из которого записанное забирается частями"""
+
+    def __init__(self):
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def iter_npz(directory, piece_size=1 << 20):
+    """Файлы .npy каталога как поток архива .npz (без сжатия, np.load читает его)"""
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.npy'):
+                continue
+            with open(os.path.join(directory, name), 'rb') as source:
+                with archive.open(name, 'w', force_zip64=True) as member:
+                    while True:
+                        piece = source.read(piece_size)
+                        if not piece:
+                            break
+                        member.write(piece)
+                        yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+
+def stream_npz(storage, device_ids, start, end, metrics=None, dtype='float64', chunk_rows=100000):
+    """Выгрузка во временный каталог и отдача ее архивом .npz; каталог удаляется после отдачи"""
+    directory = tempfile.mkdtemp(prefix='npy_export_')
+    try:
+        export_columns(storage, directory, device_ids, start, end, metrics, dtype, chunk_rows)
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    def body():
+        try:
+            yield from iter_npz(directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return body()
+
+
+def main():
+    """Командная строка: python npy_export.py OUT_DIR --from ... --to ... [--device ...]"""
+    from config import Config
+    from storage import create_storage
+
+    parser = argparse.ArgumentParser(description='Export sensor readings as NumPy column files')
+    parser.add_argument('out', help='output directory (one .npy file per column)')
+    parser.add_argument('--from', dest='start', required=True, help='range start, ISO-8601')
+    parser.add_argument('--to', dest='end', required=True, help='range end, ISO-8601')
+    parser.add_argument('--device', action='append', help='device id (repeatable; default - all devices)')
+    parser.add_argument('--metrics', help='comma-separated metrics (default - all)')
+    parser.add_argument('--dtype', choices=list(DTYPES), default='float64', help='metric dtype')
+    parser.add_argument('--chunk', type=int, default=100000, help='rows read per query')
+    parser.add_argument('--npz', action='store_true', help='also pack the columns into OUT_DIR.npz')
+    args = parser.parse_args()
+
+    Config.setup_logging()
+    storage = create_storage(Config.DATABASE)
+    try:
+        device_ids = args.device or [device['device_id'] for device in storage.devices()]
+        result = export_columns(storage, args.out, device_ids, args.start, args.end,
+                                args.metrics.split(',') if args.metrics else None, args.dtype, args.chunk)
+        print(f"Exported {result['rows']} rows of {len(device_ids)} devices to {args.out} - npy_export.py:180")
+        if args.npz:
+            with open(args.out.rstrip('/\\') + '.npz', 'wb') as f:
+                for data in iter_npz(args.out):
+                    f.write(data)
+    finally:
+        storage.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
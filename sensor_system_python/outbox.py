@@ -0,0 +1,143 @@
+# outbox.py - Очередь неотправленных показаний с арендой пачек
+import uuid
+
+from timeutil import now_ms, to_iso
+
+
+class Outbox:
+    """Очередь на пересылку поверх колонки sent.
+
+    Пачка - непрерывный диапазон id неотправленных показаний. claim()
+    выдает пачку с арендой на lease_seconds и записывает ее в outbox_leases,
+    поэтому несколько пересылающих процессов не отправляют одни и те же
+    строки. ack() помечает отправленными только выданные в пачке строки,
+    release() возвращает пачку в очередь. Пачки с истекшей арендой снова
+    выдаются следующему claim().
+    """
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+
+    @staticmethod
+    def create_tables(cursor):
+        """Создание таблицы аренд"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox_leases (
+                lease_id TEXT PRIMARY KEY,
+                consumer TEXT,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                expires_at INTEGER NOT NULL  -- мс epoch
+            )
+        ''')
+
+    def select_unsent(self, conn, after_id, before_id, limit):
+        """Неотправленные показания с after_id < id < before_id по возрастанию id"""
+        columns = ', '.join(self.db_manager.RECORD_COLUMNS)
+        rows = []
+        for table in self.db_manager.data_tables(newest_first=False):
+            rows.extend(conn.execute(f'''
+                SELECT {columns} FROM {table}
+                WHERE sent = 0 AND id > ? AND id < ?
+                ORDER BY id
+                LIMIT ?
+            ''', (after_id, before_id, limit)).fetchall())
+        rows.sort(key=lambda row: row[0])
+        return rows[:limit]
+
+    def claim(self, consumer=None, limit=1000, lease_seconds=60):
+        """Аренда следующей пачки неотправленных показаний.
+
+        Возвращает словарь с lease_id, first_id, last_id, expires_at и
+        records или None, если очередь пуста.
+        """
+        conn = self.db_manager.pool.connection()
+        now = now_ms()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM outbox_leases WHERE expires_at <= ?', (now,))
+            leased = conn.execute(
+                'SELECT first_id, last_id FROM outbox_leases ORDER BY first_id'
+            ).fetchall()
+
+            # Пачка берется из первого промежутка между активными арендами,
+            # в котором есть неотправленные строки
+            rows, after_id = [], 0
+            for first_id, last_id in leased + [(float('inf'), None)]:
+                rows = self.select_unsent(conn, after_id, first_id, limit)
+                if rows or last_id is None:
+                    break
+                after_id = max(after_id, last_id)
+
+            if not rows:
+                conn.execute('COMMIT')
+                return None
+
+            lease = {
+                'lease_id': uuid.uuid4().hex,
+                'consumer': consumer,
+                'first_id': rows[0][0],
+                'last_id': rows[-1][0],
+                'expires_at': now + int(lease_seconds * 1000)
+            }
+            conn.execute('''
+                INSERT INTO outbox_leases (lease_id, consumer, first_id, last_id, expires_at)
+                VALUES (:lease_id, :consumer, :first_id, :last_id, :expires_at)
+            ''', lease)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        lease['records'] = [self.db_manager.record_from_row(row) for row in rows]
+        return lease
+
+    def ack(self, lease):
+        """Пометка отправленных строк пачки и снятие аренды.
+
+        Помечаются только id из records пачки: строки, появившиеся в ее
+        диапазоне позже (например, при переносе схемы) или выданные другой
+        пачке после истечения аренды, этим подтверждением не затрагиваются.
+        """
+        ids = [(record['id'],) for record in lease['records']]
+        marked = 0
+        with self.db_manager.pool.transaction() as conn:
+            for table in self.db_manager.data_tables(newest_first=False):
+                marked += conn.executemany(
+                    f'UPDATE {table} SET sent = 1 WHERE id = ? AND sent = 0', ids
+                ).rowcount
+            conn.execute('DELETE FROM outbox_leases WHERE lease_id = ?', (lease['lease_id'],))
+        return marked
+
+    def release(self, lease):
+        """Возврат пачки в очередь (например, после ошибки отправки)"""
+        with self.db_manager.pool.transaction() as conn:
+            conn.execute('DELETE FROM outbox_leases WHERE lease_id = ?', (lease['lease_id'],))
+
+    def status(self):
+        """Глубина очереди, возраст самой старой записи и активные аренды"""
+        conn = self.db_manager.pool.connection()
+        depth, oldest = 0, None
+        for table in self.db_manager.data_tables(newest_first=False):
+            count, oldest_id = conn.execute(
+                f'SELECT COUNT(*), MIN(id) FROM {table} WHERE sent = 0'
+            ).fetchone()
+            depth += count
+            if oldest_id is not None and (oldest is None or oldest_id < oldest[0]):
+                oldest = conn.execute(
+                    f'SELECT id, received_at FROM {table} WHERE id = ?', (oldest_id,)
+                ).fetchone()
+
+        now = now_ms()
+        leases, leased_rows = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(last_id - first_id + 1), 0) FROM outbox_leases WHERE expires_at > ?',
+            (now,)
+        ).fetchone()
+        return {
+            'depth': depth,
+            'oldest_unsent_id': oldest[0] if oldest else None,
+            'oldest_unsent_at': to_iso(oldest[1]) if oldest else None,
+            'oldest_unsent_age_seconds': (now - oldest[1]) / 1000.0 if oldest else 0.0,
+            'active_leases': leases,
+            'leased_id_span': leased_rows
+        }
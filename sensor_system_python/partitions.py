@@ -0,0 +1,158 @@
+# partitions.py - Разбиение sensor_data на таблицы по времени
+import threading
+import logging
+import time
+from datetime import datetime, timedelta
+
+LEGACY_TABLE = 'sensor_data'
+
+# Схема разбиения -> длина раздела
+SCHEMES = {'daily': timedelta(days=1), 'weekly': timedelta(days=7)}
+
+
+class PartitionManager:
+    """Каталог разделов показаний.
+
+    В режиме 'none' все данные лежат в одной таблице sensor_data. В режимах
+    'daily' и 'weekly' новые показания пишутся в таблицы sensor_data_YYYYMMDD
+    по времени показания, а sensor_data остается разделом со старыми данными.
+    Границы разделов хранятся в таблице sensor_partitions, что позволяет
+    запросам по диапазону времени обращаться только к нужным таблицам,
+    а хранение ограничивать удалением самых старых разделов. Процесс,
+    который сам не создает и не удаляет разделы, узнает об изменениях
+    каталога, перечитывая его (refresh).
+    """
+
+    def __init__(self, scheme='none', retention=0):
+        if scheme not in SCHEMES and scheme != 'none':
+            raise ValueError(f"Unknown partitioning scheme: {scheme}")
+        self.scheme = scheme
+        self.retention = retention
+        self.partitions = {}  # имя -> (начало, конец) в мс epoch, конец не включается
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.loaded_at = 0.0          # time.monotonic() последнего чтения каталога
+        self.local_updates = False    # каталог меняет этот процесс
+        self.stale = False            # запрос обратился к удаленному разделу
+
+    @property
+    def enabled(self):
+        return self.scheme != 'none'
+
+    @staticmethod
+    def create_catalog(cursor):
+        """Создание таблицы каталога разделов"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sensor_partitions (
+                name TEXT PRIMARY KEY,
+                start_ts INTEGER NOT NULL,  -- мс epoch, включительно
+                end_ts INTEGER NOT NULL     -- мс epoch, не включительно
+            )
+        ''')
+
+    def load(self, conn, legacy_bounds):
+        """Загрузка каталога и следующего свободного id.
+
+        legacy_bounds - (мин, макс) время в таблице sensor_data или None.
+        """
+        partitions = {name: (start, end) for name, start, end in
+                      conn.execute('SELECT name, start_ts, end_ts FROM sensor_partitions')}
+        if legacy_bounds:
+            partitions[LEGACY_TABLE] = (legacy_bounds[0], legacy_bounds[1] + 1)
+
+        last_ids = [conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {name}').fetchone()[0]
+                    for name in partitions]
+        sequence = conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = ?", (LEGACY_TABLE,)
+        ).fetchone()
+        with self.lock:
+            self.partitions = partitions
+            self.next_id = max(last_ids + [sequence[0] if sequence else 0]) + 1
+            self.loaded_at = time.monotonic()
+            self.stale = False
+
+    def refresh(self, conn):
+        """Перечитывание каталога без пересчета id (для процессов, которые не пишут)"""
+        partitions = {name: (start, end) for name, start, end in
+                      conn.execute('SELECT name, start_ts, end_ts FROM sensor_partitions')}
+        with self.lock:
+            if LEGACY_TABLE in self.partitions:
+                partitions[LEGACY_TABLE] = self.partitions[LEGACY_TABLE]
+            self.partitions = partitions
+            self.loaded_at = time.monotonic()
+            self.stale = False
+
+    def invalidate(self):
+        """Пометка каталога устаревшим: он будет перечитан при следующем запросе"""
+        self.stale = True
+
+    def needs_refresh(self, end_ms, max_age):
+        """Нужно ли перечитать каталог перед запросом до end_ms"""
+        if not self.enabled:
+            return False
+        if self.stale:
+            return True
+        if self.local_updates:
+            return False
+        if time.monotonic() - self.loaded_at > max_age:
+            return True
+        with self.lock:
+            newest = max((end for _, end in self.partitions.values()), default=None)
+        return end_ms is not None and (newest is None or end_ms >= newest)
+
+    def bounds_for(self, ts_ms):
+        """Имя и границы раздела, в который попадает время"""
+        moment = datetime.fromtimestamp(ts_ms / 1000)
+        start = datetime(moment.year, moment.month, moment.day)
+        if self.scheme == 'weekly':
+            start -= timedelta(days=start.weekday())
+        end = start + SCHEMES[self.scheme]
+        return (f'{LEGACY_TABLE}_{start:%Y%m%d}',
+                int(start.timestamp() * 1000), int(end.timestamp() * 1000))
+
+    def ensure(self, cursor, ts_ms, create_table):
+        """Раздел для времени показания, создается при первом обращении"""
+        name, start, end = self.bounds_for(ts_ms)
+        if name not in self.partitions:
+            create_table(cursor, name)
+            cursor.execute('INSERT OR IGNORE INTO sensor_partitions (name, start_ts, end_ts) VALUES (?, ?, ?)',
+                           (name, start, end))
+            with self.lock:
+                self.partitions[name] = (start, end)
+                self.local_updates = True
+            logging.info(f"Created partition {name}")
+        return name
+
+    def allocate_ids(self, count):
+        """Диапазон сквозных id для вставки в разделы"""
+        with self.lock:
+            first = self.next_id
+            self.next_id += count
+        return first
+
+    def tables(self, start_ms=None, end_ms=None, newest_first=True):
+        """Таблицы, пересекающиеся с диапазоном времени [start_ms, end_ms]"""
+        if not self.enabled:
+            return [LEGACY_TABLE]
+        with self.lock:
+            items = list(self.partitions.items())
+        selected = [
+            (bounds, name) for name, bounds in items
+            if (start_ms is None or bounds[1] > start_ms) and (end_ms is None or bounds[0] <= end_ms)
+        ]
+        selected.sort(reverse=newest_first)
+        return [name for _, name in selected]
+
+    def expired(self):
+        """Самые старые разделы сверх лимита хранения"""
+        if not self.enabled or self.retention <= 0:
+            return []
+        tables = self.tables(newest_first=True)
+        return tables[self.retention:][::-1]
+
+    def forget(self, cursor, name):
+        """Удаление раздела из каталога"""
+        cursor.execute('DELETE FROM sensor_partitions WHERE name = ?', (name,))
+        with self.lock:
+            self.partitions.pop(name, None)
+            self.local_updates = True
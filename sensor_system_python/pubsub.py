@@ -0,0 +1,149 @@
+# pubsub.py - Рассылка сохраненных показаний подписчикам внутри процесса
+import logging
+import threading
+import time
+from datetime import datetime
+
+ALL = 'all'
+
+
+def topics(record):
+    """Темы показания: все устройства, устройство и его место установки"""
+    result = [ALL, f"device:{record['device_id']}"]
+    if record.get('location'):
+        result.append(f"location:{record['location']}")
+    return result
+
+
+class EventBus:
+    """Канал сохраненных показаний от приема к подписчикам того же процесса.
+
+    Хранилище публикует показания после коммита (publish), подписчики
+    получают список записей в формате latest(): поля показания и метки
+    времени в ISO-8601. Обработчики вызываются в потоке записи, поэтому
+    должны только запоминать показания и сразу возвращаться.
+    """
+
+    def __init__(self):
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        """Есть ли подписчики (без них записи для публикации не собираются)"""
+        return bool(self.subscribers)
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers = self.subscribers + [callback]
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [item for item in self.subscribers if item is not callback]
+
+    def publish(self, records):
+        if not records:
+            return
+        for callback in self.subscribers:
+            try:
+                callback(records)
+            except Exception as e:
+                logging.error(f"Event subscriber failed: {e}")
+
+
+class RoomBroadcaster:
+    """Рассылка показаний по комнатам Socket.IO с объединением и ограничением частоты.
+
+    Комната - тема (all, device:<id>, location:<место>) и интервал
+    рассылки из intervals: клиент выбирает интервал при подписке, медленным
+    клиентам достаточно выбрать больший. Между рассылками в комнате
+    копится только последнее показание каждого устройства, поэтому очередь
+    не растет при любой частоте приема. Сообщение собирается один раз на
+    комнату и отправляется одним emit всем ее участникам. Показания по
+    темам без подписчиков не запоминаются.
+    """
+
+    def __init__(self, emit, intervals=(0.5, 1.0, 5.0), event='data_update'):
+        self.emit = emit
+        self.intervals = tuple(sorted(intervals))
+        self.event = event
+        self.members = {}
+        self.clients = {}
+        self.pending = {}
+        self.sent_at = {}
+        self.lock = threading.Lock()
+        self.stats = {'published': 0, 'messages': 0}
+
+    def room(self, topic, interval):
+        return f'{topic}@{interval:g}'
+
+    def interval(self, requested=None):
+        """Ближайший допустимый интервал не меньше запрошенного"""
+        if requested is None:
+            return self.intervals[0]
+        for interval in self.intervals:
+            if interval >= requested:
+                return interval
+        return self.intervals[-1]
+
+    def subscribe(self, client, topic_list, interval=None):
+        """Подписка клиента; возвращает (комнаты для входа, комнаты для выхода)"""
+        interval = self.interval(interval)
+        rooms = {self.room(topic, interval): (topic, interval) for topic in topic_list}
+        with self.lock:
+            old = self.clients.get(client, {})
+            for name in old.keys() - rooms.keys():
+                self.leave(client, name)
+            for name, key in rooms.items():
+                self.members.setdefault(key, set()).add(client)
+            self.clients[client] = rooms
+        return list(rooms.keys() - old.keys()), list(old.keys() - rooms.keys())
+
+    def unsubscribe(self, client):
+        """Отключение клиента; возвращает комнаты, из которых он вышел"""
+        with self.lock:
+            rooms = self.clients.pop(client, {})
+            for name in rooms:
+                self.leave(client, name, rooms)
+        return list(rooms)
+
+    def leave(self, client, name, rooms=None):
+        key = (rooms or self.clients[client])[name]
+        members = self.members.get(key)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self.members[key]
+                self.pending.pop(key, None)
+
+    def publish(self, records):
+        """Обработчик EventBus: запоминание показаний для комнат с подписчиками"""
+        with self.lock:
+            if not self.members:
+                return
+            for record in records:
+                record_topics = topics(record)
+                for key in self.members:
+                    if key[0] in record_topics:
+                        self.pending.setdefault(key, {})[record['device_id']] = record
+            self.stats['published'] += len(records)
+
+    def flush(self, now=None):
+        """Рассылка накопленного в комнатах, у которых подошел интервал"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            due = [key for key in self.pending
+                   if now - self.sent_at.get(key, 0.0) >= key[1]]
+            batches = [(key, self.pending.pop(key)) for key in due]
+            for key in due:
+                self.sent_at[key] = now
+        timestamp = datetime.now().isoformat()
+        for (topic, interval), records in batches:
+            payload = {'data': list(records.values()), 'topic': topic, 'timestamp': timestamp}
+            try:
+                self.emit(self.event, payload, self.room(topic, interval))
+                self.stats['messages'] += 1
+            except Exception as e:
+                logging.error(f"Error broadcasting to {topic}: {e}")
+        return len(batches)
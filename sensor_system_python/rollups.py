@@ -0,0 +1,231 @@
+# rollups.py - Агрегаты показаний по минутам, часам и дням
+import sys
+import time
+import logging
+import argparse
+
+from timeutil import to_epoch_ms, to_iso
+
+# Разрешение -> длина интервала в секундах
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+METRICS = ('temperature', 'humidity', 'light_level', 'voltage')
+
+
+def rollup_table(resolution):
+    """Имя таблицы агрегатов для разрешения"""
+    return f'sensor_rollup_{resolution}'
+
+
+class RollupManager:
+    """Агрегаты (count, min, max, sum, last) по устройству, метрике и интервалу.
+
+    Обновляются в той же транзакции, что и вставка показаний, поэтому всегда
+    согласованы с sensor_data. Интервал определяется по времени показания
+    на устройстве (timestamp), а не по времени приема.
+    """
+
+    @staticmethod
+    def create_tables(cursor):
+        """Создание таблиц агрегатов"""
+        for resolution in RESOLUTIONS:
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {rollup_table(resolution)} (
+                    device_id TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,  -- начало интервала, секунды epoch
+                    count INTEGER NOT NULL,
+                    min REAL,
+                    max REAL,
+                    sum REAL,
+                    last REAL,
+                    last_ts INTEGER,          -- время последнего значения, мс epoch
+                    PRIMARY KEY (device_id, metric, bucket)
+                ) WITHOUT ROWID
+            ''')
+
+    @staticmethod
+    def aggregate(readings):
+        """Свертка показаний по интервалам в памяти.
+
+        readings - пары (показание, время в мс); показания без распознанного
+        времени пропускаются.
+        """
+        buckets = {resolution: {} for resolution in RESOLUTIONS}
+        for data, ts_ms in readings:
+            if ts_ms is None:
+                continue
+            seconds = ts_ms // 1000
+            for metric in METRICS:
+                value = data.get(metric)
+                if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                for resolution, width in RESOLUTIONS.items():
+                    key = (data['device_id'], metric, seconds - seconds % width)
+                    agg = buckets[resolution].get(key)
+                    if agg is None:
+                        buckets[resolution][key] = [1, value, value, value, value, ts_ms]
+                        continue
+                    agg[0] += 1
+                    if value < agg[1]:
+                        agg[1] = value
+                    if value > agg[2]:
+                        agg[2] = value
+                    agg[3] += value
+                    if ts_ms >= agg[5]:
+                        agg[4] = value
+                        agg[5] = ts_ms
+        return buckets
+
+    def write(self, cursor, readings):
+        """Добавление показаний к агрегатам (внутри транзакции вставки)"""
+        for resolution, buckets in self.aggregate(readings).items():
+            if not buckets:
+                continue
+            cursor.executemany(f'''
+                INSERT INTO {rollup_table(resolution)}
+                (device_id, metric, bucket, count, min, max, sum, last, last_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(device_id, metric, bucket) DO UPDATE SET
+                    count = count + excluded.count,
+                    min = MIN(min, excluded.min),
+                    max = MAX(max, excluded.max),
+                    sum = sum + excluded.sum,
+                    last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last ELSE last END,
+                    last_ts = MAX(last_ts, excluded.last_ts)
+            ''', [key + tuple(agg) for key, agg in buckets.items()])
+
+    @staticmethod
+    def choose_resolution(start_ms, end_ms, max_points):
+        """Разрешение для диапазона и бюджета точек.
+
+        Выбирается самое подробное разрешение, при котором число интервалов
+        в диапазоне не превышает max_points; если не подходит ни одно -
+        самое грубое.
+        """
+        span = max(end_ms - start_ms, 0) / 1000
+        for resolution, width in sorted(RESOLUTIONS.items(), key=lambda item: item[1]):
+            if span / width <= max_points:
+                return resolution
+        return max(RESOLUTIONS, key=RESOLUTIONS.get)
+
+    def query(self, conn, device_id, metric, start_ms, end_ms, max_points=500, resolution=None):
+        """Ряд агрегатов устройства по метрике за диапазон времени"""
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        resolution = resolution or self.choose_resolution(start_ms, end_ms, max_points)
+        width = RESOLUTIONS[resolution]
+        rows = conn.execute(f'''
+            SELECT bucket, count, min, max, sum, last
+            FROM {rollup_table(resolution)}
+            WHERE device_id = ? AND metric = ? AND bucket >= ? AND bucket <= ?
+            ORDER BY bucket
+        ''', (device_id, metric, start_ms // 1000 - (start_ms // 1000) % width, end_ms // 1000)).fetchall()
+        return {
+            'device_id': device_id,
+            'metric': metric,
+            'resolution': resolution,
+            'bucket_seconds': width,
+            'points': [
+                {
+                    'bucket': to_iso(bucket * 1000),
+                    'count': count,
+                    'min': min_value,
+                    'max': max_value,
+                    'avg': total / count if count else None,
+                    'last': last
+                }
+                for bucket, count, min_value, max_value, total, last in rows
+            ]
+        }
+
+
+def parse_timestamp(value):
+    """Время показания в мс или None, если его не удалось разобрать"""
+    try:
+        return to_epoch_ms(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def backfill(db_manager, chunk_size=10000):
+    """Пересчет агрегатов по уже сохраненным данным.
+
+    Таблицы агрегатов очищаются и запоминается последний id показаний в
+    одной транзакции BEGIN IMMEDIATE под commit_lock: более новые строки
+    учтет прием данных, более старые пересчитываются здесь порциями по id
+    в коротких транзакциях.
+
+    Пересчет идет только по строкам sensor_data. Показания, отброшенные
+    зоной нечувствительности (DEADBAND_ENABLED), в таблицу не попали,
+    поэтому после пересчета агрегаты за время ее работы их не учитывают.
+    """
+    started = time.monotonic()
+    manager = db_manager.rollups
+    if db_manager.deadband:
+        logging.warning("Deadband is enabled: rebuilt rollups will not include suppressed readings")
+    conn = db_manager.pool.connect()
+    try:
+        with db_manager.commit_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                tables = db_manager.data_tables(newest_first=False)
+                last_id = max([conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+                               for table in tables] + [0])
+                for resolution in RESOLUTIONS:
+                    conn.execute(f'DELETE FROM {rollup_table(resolution)}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+        columns = ('device_id',) + METRICS
+        total = 0
+        for table in tables:
+            cursor_id = 0
+            while cursor_id < last_id:
+                rows = conn.execute(f'''
+                    SELECT id, timestamp, {', '.join(columns)} FROM {table}
+                    WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+                ''', (cursor_id, last_id, chunk_size)).fetchall()
+                if not rows:
+                    break
+                readings = [(dict(zip(columns, row[2:])), parse_timestamp(row[1])) for row in rows]
+                with db_manager.commit_lock:
+                    with conn:
+                        manager.write(conn.cursor(), readings)
+                cursor_id = rows[-1][0]
+                total += len(rows)
+    finally:
+        db_manager.pool.release(conn)
+
+    logging.info(f"Rollups backfilled from {total} rows in {time.monotonic() - started:.1f}s")
+    return total
+
+
+def main():
+    """Командная строка: python rollups.py backfill"""
+    from config import Config
+    from database import DatabaseManager
+
+    parser = argparse.ArgumentParser(
+        description='Sensor data rollups',
+        epilog='backfill rebuilds rollups from stored rows only: readings suppressed by the deadband '
+               'filter are not in sensor_data and drop out of the rebuilt rollups'
+    )
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--db', default=Config.DATABASE.DB_PATH, help='database file')
+    parser.add_argument('--chunk', type=int, default=10000, help='rows per transaction')
+    args = parser.parse_args()
+
+    Config.setup_logging()
+    db_manager = DatabaseManager(args.db, Config.DATABASE)
+    try:
+        count = backfill(db_manager, args.chunk)
+        print(f"Backfilled rollups from {count} rows - rollups.py:204")
+    finally:
+        db_manager.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,6 +21,11 @@ def run_web_interface():
     print("Starting web interface... - run_system.py:21")
     os.system('python web_interface.py')
 
+def run_forwarder():
+    """Запуск пересылки данных на центральный сервер"""
+    print("Starting upstream forwarder... - run_system.py:26")
+    os.system('python forwarder.py')
+
 def main():
     """Основная функция запуска системы"""
     config = Config()
@@ -35,9 +40,10 @@ def main():
     print("3. Web Interface (localhost:5000)  monitoring dashboard - run_system.py:35")
     print("= - run_system.py:36" * 60)
     
-    # Запускаем сервер в отдельном потоке
-    server_thread = threading.Thread(target=run_server, daemon=True)
-    server_thread.start()
+    # Запускаем сервер в отдельном потоке (или внутри веб-интерфейса, WEB.EMBED_SERVER)
+    if not config.WEB.EMBED_SERVER:
+        server_thread = threading.Thread(target=run_server, daemon=True)
+        server_thread.start()
     
     # Даем серверу время на запуск
     time.sleep(2)
@@ -46,6 +52,11 @@ def main():
     emulator_thread = threading.Thread(target=run_emulator, daemon=True)
     emulator_thread.start()
     
+    # Пересылка на центральный сервер, если включена
+    if config.FORWARDER.ENABLED:
+        forwarder_thread = threading.Thread(target=run_forwarder, daemon=True)
+        forwarder_thread.start()
+    
     # Запускаем веб-интерфейс (блокирующий вызов)
     print("\n🌐 Web interface will be available at: http://localhost:5000 - run_system.py:50")
     print("📡 Data server is listening on: localhost:8080 - run_system.py:51")
@@ -0,0 +1,51 @@
+# scheduler.py - Периодические фоновые задачи
+import threading
+import time
+import logging
+
+
+class PeriodicTask:
+    """Фоновый поток, вызывающий функцию с заданным интервалом"""
+
+    def __init__(self, name, interval, func, run_immediately=False):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.run_immediately = run_immediately
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_run = None
+        self.last_error = None
+
+    def start(self):
+        """Запуск потока задачи"""
+        if self.thread and self.thread.is_alive():
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        """Остановка потока задачи"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout)
+
+    def run_once(self):
+        """Однократный запуск задачи с перехватом ошибок"""
+        started = time.monotonic()
+        try:
+            self.func()
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            logging.error(f"Periodic task {self.name} failed: {e}")
+        self.last_run = time.time()
+        return time.monotonic() - started
+
+    def run(self):
+        """Основной цикл потока"""
+        if self.run_immediately:
+            self.run_once()
+        while not self.stop_event.wait(self.interval):
+            self.run_once()
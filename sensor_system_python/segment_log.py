@@ -0,0 +1,398 @@
+# segment_log.py - Журнал сегментов как буфер приема перед SQLite
+import os
+import json
+import queue
+import sqlite3
+import struct
+import zlib
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+from timeutil import now_ms
+
+# Заголовок записи: длина данных и crc32 данных (big-endian)
+HEADER = struct.Struct('>II')
+SEGMENT_PREFIX = 'segment_'
+SEGMENT_SUFFIX = '.log'
+# Показания, которые нельзя записать в базу (JSON по строке на показание)
+QUARANTINE_FILE = 'quarantine.jsonl'
+# Последний выданный номер сегмента: имена не повторяются и после удаления всех сегментов
+SEQUENCE_FILE = 'sequence'
+
+
+def segment_name(seq):
+    """Имя файла сегмента по номеру"""
+    return f'{SEGMENT_PREFIX}{seq:012d}{SEGMENT_SUFFIX}'
+
+
+def segment_seq(name):
+    """Номер сегмента по имени файла (None - не файл сегмента)"""
+    if not (name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)):
+        return None
+    try:
+        return int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+    except ValueError:
+        return None
+
+
+def read_records(path, offset=0):
+    """Записи сегмента начиная со смещения: пары (данные, смещение конца).
+
+    Чтение останавливается на неполной записи или несовпадении crc -
+    хвосте, недописанном до сбоя.
+    """
+    with open(path, 'rb') as segment:
+        segment.seek(offset)
+        while True:
+            header = segment.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, crc = HEADER.unpack(header)
+            data = segment.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                logging.warning(f"Segment {path}: torn record at offset {offset}, ignoring the tail")
+                return
+            offset += HEADER.size + length
+            yield json.loads(data), offset
+
+
+class SegmentLogWriter:
+    """Прием показаний через журнал сегментов (DatabaseConfig.INGEST_MODE).
+
+    Пачка показаний дописывается в текущий файл сегмента записью с длиной и
+    crc32; Future завершается после общего fsync, который выполняется не
+    чаще раза в fsync_interval для всех накопившихся записей. Сегмент
+    закрывается по размеру или возрасту, после чего фоновый компактор
+    применяет его к SQLite большими транзакциями. Смещение примененной части
+    сегмента хранится в таблице ingest_segments в той же транзакции, что и
+    данные, поэтому после перезапуска неприменные записи применяются ровно
+    один раз. Пока база занята, прием продолжается в журнал. Показания,
+    которые база отклоняет не из-за занятости, переносятся в файл
+    карантина QUARANTINE_FILE, и применение сегмента продолжается.
+
+    Интерфейс совпадает с GroupCommitWriter: submit(), pending(), stop().
+    """
+
+    def __init__(self, db_manager, directory, segment_bytes=64 * 1024 * 1024, segment_age=1.0,
+                 fsync_interval=0.01, apply_rows=50000, max_backlog_bytes=1024 * 1024 * 1024,
+                 tick_interval=1.0):
+        self.db_manager = db_manager
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.fsync_interval = fsync_interval
+        self.apply_rows = apply_rows
+        self.max_backlog_bytes = max_backlog_bytes
+        self.tick_interval = tick_interval
+
+        self.lock = threading.Condition()
+        self.file = None
+        self.seq = 0
+        self.size = 0
+        self.opened_at = 0.0
+        self.unsynced = []        # (Future, число показаний) записей, ожидающих fsync
+        self.backlog_bytes = 0    # записано, но еще не применено к базе
+        self.closed_segments = []
+        self.is_running = False
+        self.stop_event = threading.Event()
+        self.flusher = None
+        self.compactor = None
+
+        # Статистика работы
+        self.stats = {'records': 0, 'rows': 0, 'fsyncs': 0, 'segments_applied': 0,
+                      'rows_applied': 0, 'apply_errors': 0, 'quarantined': 0}
+
+    @staticmethod
+    def create_tables(cursor):
+        """Создание таблицы примененных смещений сегментов"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_segments (
+                name TEXT PRIMARY KEY,
+                applied_offset INTEGER NOT NULL
+            )
+        ''')
+
+    def start(self):
+        """Восстановление сегментов с прошлого запуска и запуск потоков"""
+        if self.is_running:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        existing = sorted(name for name in os.listdir(self.directory) if segment_seq(name) is not None)
+        self.closed_segments = [os.path.join(self.directory, name) for name in existing]
+        self.backlog_bytes = sum(os.path.getsize(path) for path in self.closed_segments)
+        if existing:
+            logging.info(f"Recovering {len(existing)} unapplied segments ({self.backlog_bytes} bytes)")
+
+        # Отметки сегментов, файлы которых уже удалены, остались от сбоя
+        # между последней транзакцией и удалением файла
+        conn = self.db_manager.pool.connection()
+        marked = [row[0] for row in conn.execute('SELECT name FROM ingest_segments')]
+        stale = [name for name in marked if name not in existing]
+        if stale:
+            with conn:
+                conn.executemany('DELETE FROM ingest_segments WHERE name = ?', [(name,) for name in stale])
+            logging.info(f"Dropped {len(stale)} offsets of already applied segments")
+        self.seq = max([self.load_sequence()] + [segment_seq(name) or 0 for name in existing + marked])
+        self.open_segment()
+
+        self.is_running = True
+        self.stop_event.clear()
+        self.flusher = threading.Thread(target=self.run_flusher, name='segment-fsync', daemon=True)
+        self.compactor = threading.Thread(target=self.run_compactor, name='segment-compactor', daemon=True)
+        self.flusher.start()
+        self.compactor.start()
+        logging.info(f"Segment log ingest started in {self.directory}")
+
+    def stop(self, timeout=30.0):
+        """Остановка: сброс текущего сегмента и применение всех сегментов"""
+        if not self.is_running:
+            return
+        with self.lock:
+            self.is_running = False
+            self.close_segment()
+            self.lock.notify_all()
+        self.stop_event.set()
+        self.flusher.join(timeout)
+        self.compactor.join(timeout)
+        logging.info(f"Segment log ingest stopped: {self.stats}")
+
+    def load_sequence(self):
+        """Последний выданный номер сегмента из SEQUENCE_FILE (0 - файла нет)"""
+        try:
+            with open(os.path.join(self.directory, SEQUENCE_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def save_sequence(self):
+        """Сохранение номера текущего сегмента: запись во временный файл и замена"""
+        path = os.path.join(self.directory, SEQUENCE_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(self.seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def open_segment(self):
+        """Новый текущий сегмент (вызывается под lock или до запуска)"""
+        self.seq += 1
+        self.save_sequence()
+        self.file = open(os.path.join(self.directory, segment_name(self.seq)), 'ab')
+        self.size = 0
+        self.opened_at = time.monotonic()
+
+    def close_segment(self):
+        """fsync и закрытие текущего сегмента, передача его компактору (под lock)"""
+        self.sync()
+        path = self.file.name
+        self.file.close()
+        self.file = None
+        if self.size:
+            self.closed_segments.append(path)
+        else:
+            os.remove(path)
+
+    def sync(self):
+        """Сброс текущего сегмента на диск и завершение ожидающих Future (под lock)"""
+        if not self.unsynced:
+            return
+        futures, self.unsynced = self.unsynced, []
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.stats['fsyncs'] += 1
+            success = True
+        except OSError as e:
+            logging.error(f"Segment fsync failed: {e}")
+            success = False
+        for future, count in futures:
+            future.set_result([success] * count)
+
+    def submit(self, readings, callback=None, block=True, timeout=None):
+        """Запись пачки проверенных показаний в журнал.
+
+        Возвращает Future со списком флагов успеха после fsync. Если объем
+        неприменных сегментов превышает max_backlog_bytes, ждет компактор
+        (block=True) или выбрасывает queue.Full.
+        """
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        data = json.dumps({'received_at': now_ms(), 'readings': readings},
+                          separators=(',', ':')).encode('utf-8')
+        record = HEADER.pack(len(data), zlib.crc32(data)) + data
+
+        with self.lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self.is_running and self.backlog_bytes > self.max_backlog_bytes:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Full()
+                self.lock.wait(remaining)
+            if not self.is_running:
+                raise RuntimeError("Segment log is stopped")
+
+            self.file.write(record)
+            self.size += len(record)
+            self.backlog_bytes += len(record)
+            self.unsynced.append((future, len(readings)))
+            self.stats['records'] += 1
+            self.stats['rows'] += len(readings)
+            if self.size >= self.segment_bytes:
+                self.close_segment()
+                self.open_segment()
+        return future
+
+    def pending(self):
+        """Объем записанных, но еще не примененных к базе данных в байтах"""
+        return self.backlog_bytes
+
+    def run_flusher(self):
+        """Поток общего fsync и закрытия сегментов по возрасту"""
+        while not self.stop_event.wait(self.fsync_interval):
+            with self.lock:
+                if not self.is_running:
+                    break
+                self.sync()
+                if self.size and time.monotonic() - self.opened_at >= self.segment_age:
+                    self.close_segment()
+                    self.open_segment()
+
+    def run_compactor(self):
+        """Поток применения закрытых сегментов к базе данных"""
+        conn = self.db_manager.pool.connect()
+        failures = 0
+        try:
+            while True:
+                with self.lock:
+                    segments = list(self.closed_segments)
+                    stopping = not self.is_running
+                if not segments:
+                    if stopping:
+                        break
+                    self.db_manager.writer_tick(conn)
+                    self.stop_event.wait(min(self.segment_age, self.tick_interval) / 2)
+                    continue
+                try:
+                    for path in segments:
+                        self.apply_segment(conn, path)
+                    failures = 0
+                except Exception as e:
+                    # База занята или недоступна: сегменты остаются на диске
+                    failures += 1
+                    self.stats['apply_errors'] += 1
+                    delay = min(30.0, 0.1 * 2 ** failures)
+                    logging.error(f"Applying segments failed: {e}, retry in {delay:.1f}s")
+                    if stopping and failures > 5:
+                        break
+                    time.sleep(delay)
+                self.db_manager.writer_tick(conn)
+        finally:
+            self.db_manager.pool.release(conn)
+
+    def apply_segment(self, conn, path):
+        """Применение сегмента транзакциями до apply_rows показаний"""
+        name = os.path.basename(path)
+        row = conn.execute('SELECT applied_offset FROM ingest_segments WHERE name = ?', (name,)).fetchone()
+        offset = row[0] if row else 0
+        started = time.monotonic()
+
+        readings, received = [], []
+        applied = 0
+        start = offset
+        for record, end_offset in read_records(path, offset):
+            readings.extend(record['readings'])
+            received.extend([record['received_at']] * len(record['readings']))
+            offset = end_offset
+            if len(readings) >= self.apply_rows:
+                applied += self.apply_records(conn, name, readings, received, start, offset)
+                readings, received = [], []
+                start = offset
+        # Последняя транзакция сегмента удаляет его отметку, файл удаляется
+        # после нее. При сбое между ними сегмент применяется заново с начала,
+        # и уже записанные показания отсекаются как повторы
+        if readings:
+            applied += self.apply_records(conn, name, readings, received, start, None)
+        else:
+            with conn:
+                self.mark_applied(conn, name, None)
+        size = os.path.getsize(path)
+        os.remove(path)
+        with self.lock:
+            self.closed_segments.remove(path)
+            self.backlog_bytes = max(0, self.backlog_bytes - size)
+            self.lock.notify_all()
+        self.stats['segments_applied'] += 1
+        logging.debug(f"Applied {applied} readings from {name} in {time.monotonic() - started:.2f}s")
+
+    def apply_records(self, conn, name, readings, received, start, end):
+        """Применение показаний сегмента между смещениями start и end.
+        
+        Если пачку отклоняет сама база (а не ее занятость), показания
+        применяются по одному, а непроходящие проверку или не записанные
+        переносятся в карантин. Смещение end отмечается после всех
+        показаний; при сбое посередине они применяются повторно и
+        отсекаются как повторы. end=None - конец сегмента (отметка удаляется).
+        """
+        valid = [self.db_manager.is_valid_reading(data) for data in readings]
+        if all(valid):
+            try:
+                return self.apply_batch(conn, name, readings, received, end)
+            except sqlite3.OperationalError:
+                raise
+            except Exception as e:
+                logging.error(f"Segment {name}: batch of {len(readings)} readings failed: {e}, "
+                              f"applying one by one")
+
+        applied = 0
+        for data, received_at, ok in zip(readings, received, valid):
+            if not ok:
+                self.quarantine(name, data, received_at, 'invalid reading')
+                continue
+            try:
+                applied += self.apply_batch(conn, name, [data], [received_at], start)
+            except sqlite3.OperationalError:
+                raise
+            except Exception as e:
+                self.quarantine(name, data, received_at, str(e))
+        with conn:
+            self.mark_applied(conn, name, end)
+        return applied
+
+    def apply_batch(self, conn, name, readings, received, offset):
+        """Одна транзакция: показания и смещение примененной части сегмента"""
+        with self.db_manager.commit_lock:
+            with conn:
+                received_at, stored, duplicates = self.db_manager.write_readings(
+                    conn.cursor(), readings, received
+                )
+                self.mark_applied(conn, name, offset)
+            self.db_manager.on_committed(stored, received_at, duplicates)
+        self.stats['rows_applied'] += len(readings)
+        return len(readings)
+
+    def mark_applied(self, conn, name, offset):
+        """Запись смещения примененной части сегмента (внутри транзакции).
+
+        offset=None - сегмент применен полностью, отметка удаляется.
+        """
+        if offset is None:
+            conn.execute('DELETE FROM ingest_segments WHERE name = ?', (name,))
+            return
+        conn.execute('''
+            INSERT INTO ingest_segments (name, applied_offset) VALUES (?, ?)
+            ON CONFLICT(name) DO UPDATE SET applied_offset = excluded.applied_offset
+        ''', (name, offset))
+
+    def quarantine(self, name, data, received_at, error):
+        """Перенос показания, которое нельзя записать, в файл карантина"""
+        line = json.dumps({'segment': name, 'received_at': received_at, 'error': error,
+                           'reading': data}, separators=(',', ':'), default=str)
+        with open(os.path.join(self.directory, QUARANTINE_FILE), 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats['quarantined'] += 1
+        logging.warning(f"Segment {name}: reading quarantined ({error})")
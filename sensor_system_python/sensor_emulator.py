@@ -9,6 +9,8 @@ class SensorEmulator:
     def __init__(self, config: Config):
         self.config = config
         self.devices = self.generate_devices()
+        self.stream_socket = None
+        self.stream_reader = None
         
     def generate_devices(self):
         """Generate list of emulated devices"""
@@ -82,6 +84,67 @@ class SensorEmulator:
             print(f"Error sending data: {e} - sensor_emulator.py:82")
             return False
     
+    def connect_stream(self):
+        """Open persistent NDJSON connection to server"""
+        sock = socket.create_connection(
+            (self.config.SERVER.HOST, self.config.SERVER.PORT), timeout=5
+        )
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream_socket = sock
+        self.stream_reader = sock.makefile('rb')
+    
+    def close_stream(self):
+        """Close persistent connection"""
+        for resource in (self.stream_reader, self.stream_socket):
+            try:
+                if resource:
+                    resource.close()
+            except OSError:
+                pass
+        self.stream_socket = None
+        self.stream_reader = None
+    
+    def send_data_stream(self, readings):
+        """Send readings over persistent connection, one JSON per line.
+        
+        All lines are written at once (pipelined) and then one ack per line
+        is read back. Returns list of success flags in the same order.
+        """
+        for attempt in range(2):
+            try:
+                if self.stream_socket is None:
+                    self.connect_stream()
+                
+                payload = ''.join(json.dumps(reading) + '\n' for reading in readings)
+                self.stream_socket.sendall(payload.encode('utf-8'))
+                
+                results = []
+                for _ in readings:
+                    line = self.stream_reader.readline()
+                    if not line:
+                        raise ConnectionError("Server closed connection")
+                    results.append(json.loads(line).get('status') == 'success')
+                return results
+                
+            except (OSError, ConnectionError, ValueError) as e:
+                # Reconnect once, the server may have dropped an idle connection
+                self.close_stream()
+                if attempt:
+                    print(f"Error sending data: {e} - sensor_emulator.py:133")
+        
+        return [False] * len(readings)
+    
+    def report_result(self, device, sensor_data, success):
+        """Print send result for one reading"""
+        if success:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] {device['device_id']}: - sensor_emulator.py:140"
+                  f"Temp: {sensor_data['temperature']}C, "
+                  f"Humidity: {sensor_data['humidity']}%, "
+                  f"Light: {sensor_data['light_level']}")
+        else:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] {device['device_id']}: - sensor_emulator.py:145"
+                  f"Send error")
+    
     def start_emulation(self):
         """Start microcontroller emulation"""
         print("Starting microcontroller emulation... - sensor_emulator.py:87")
@@ -91,27 +154,28 @@ class SensorEmulator:
         
         try:
             while True:
-                for device in self.devices:
-                    # Generate data
-                    sensor_data = self.generate_sensor_data(device)
-                    
-                    # Send to server
-                    success = self.send_data_to_server(sensor_data)
-                    
-                    if success:
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] {device['device_id']}: - sensor_emulator.py:102"
-                              f"Temp: {sensor_data['temperature']}C, "
-                              f"Humidity: {sensor_data['humidity']}%, "
-                              f"Light: {sensor_data['light_level']}")
-                    else:
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] {device['device_id']}: - sensor_emulator.py:107"
-                              f"Send error")
+                if self.config.EMULATOR.PERSISTENT_CONNECTION:
+                    # One pipelined write for all devices over a single socket
+                    readings = [self.generate_sensor_data(device) for device in self.devices]
+                    results = self.send_data_stream(readings)
+                    for device, sensor_data, success in zip(self.devices, readings, results):
+                        self.report_result(device, sensor_data, success)
+                else:
+                    for device in self.devices:
+                        # Generate data
+                        sensor_data = self.generate_sensor_data(device)
+                        
+                        # Send to server
+                        success = self.send_data_to_server(sensor_data)
+                        self.report_result(device, sensor_data, success)
                 
                 # Wait before next send
                 time.sleep(self.config.EMULATOR.SEND_INTERVAL)
                 
         except KeyboardInterrupt:
             print("\nEmulation stopped by user - sensor_emulator.py:114")
+        finally:
+            self.close_stream()
 
 def main():
     """Main emulator startup function"""
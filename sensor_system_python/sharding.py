@@ -0,0 +1,379 @@
+# sharding.py - Показания в нескольких файлах SQLite по хэшу device_id
+import os
+import json
+import math
+import time
+import heapq
+import zlib
+import logging
+import threading
+import itertools
+import dataclasses
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+
+from database import DatabaseManager
+from pubsub import EventBus
+from storage import SQLiteBackend, StorageBackend
+from timeutil import to_epoch_ms
+
+LAYOUT_FILE = 'shards.json'
+
+
+def shard_index(device_id, count):
+    """Номер шарда устройства (crc32 не зависит от PYTHONHASHSEED)"""
+    return zlib.crc32(device_id.encode('utf-8')) % count
+
+
+def shard_name(index, count):
+    """Имя файла шарда; число шардов в имени разделяет старую и новую раскладку"""
+    return f'shard_{index:03d}_of_{count:03d}.db'
+
+
+def merge_statistics(parts):
+    """Объединение сводок статистики шардов"""
+    merged = {
+        'total_records': 0,
+        'device_count': 0,
+        'records_by_device': {},
+        'records_by_location': {},
+        'records_per_minute': 0,
+        'records_per_minute_series': [],
+        'duplicates_suppressed': 0,
+        'duplicates_by_device': {},
+        'duplicates_per_minute': 0,
+        'last_updated': datetime.now().isoformat()
+    }
+    minutes = {}
+    for part in parts:
+        for field in ('total_records', 'device_count', 'records_per_minute',
+                      'duplicates_suppressed', 'duplicates_per_minute'):
+            merged[field] += part.get(field, 0)
+        # Устройство всегда в одном шарде, поэтому счетчики по устройствам не пересекаются
+        merged['records_by_device'].update(part.get('records_by_device', {}))
+        merged['duplicates_by_device'].update(part.get('duplicates_by_device', {}))
+        for location, count in part.get('records_by_location', {}).items():
+            merged['records_by_location'][location] = merged['records_by_location'].get(location, 0) + count
+        for point in part.get('records_per_minute_series', []):
+            minutes[point['minute']] = minutes.get(point['minute'], 0) + point['count']
+        if 'deadband' in part:
+            deadband = merged.setdefault('deadband', {'readings': 0, 'stored': 0, 'suppressed': 0})
+            for field in ('readings', 'stored', 'suppressed'):
+                deadband[field] += part['deadband'][field]
+    merged['records_per_minute_series'] = [{'minute': minute, 'count': count}
+                                           for minute, count in sorted(minutes.items())]
+    if 'deadband' in merged:
+        deadband = merged['deadband']
+        deadband['reduction_ratio'] = (round(1 - deadband['stored'] / deadband['readings'], 4)
+                                       if deadband['readings'] else 0.0)
+    return merged
+
+
+class ShardedBackend(StorageBackend):
+    """Показания в DatabaseConfig.SHARDS файлах SQLite (BACKEND='sharded').
+
+    Показание попадает в шард crc32(device_id) % SHARDS, у каждого шарда
+    свой DatabaseManager, поток записи и фоновые задачи, поэтому шарды
+    пишутся параллельно, не ожидая общей блокировки базы. Запросы по одному
+    устройству идут в его шард, остальные выполняются во всех шардах
+    параллельно и объединяются.
+
+    Текущая раскладка хранится в SHARD_DIR/shards.json. Если SHARDS в
+    конфигурации изменилось, при запуске приема (start) данные
+    перераспределяются по новым файлам (SHARD_RESHARD_ON_START); прерванное
+    перераспределение безопасно повторяется - повторы отсекает уникальный
+    ключ (device_id, timestamp).
+    """
+
+    name = 'sharded'
+    # Ключ страницы history: (время в мс, id, номер шарда)
+    cursor_length = 3
+
+    def __init__(self, db_config):
+        self.db_config = db_config
+        self.directory = db_config.SHARD_DIR
+        os.makedirs(self.directory, exist_ok=True)
+        layout = self.read_layout()
+        self.initial = layout is None
+        self.count = db_config.SHARDS if layout is None else layout['count']
+        # Общий канал: шарды публикуют сохраненные показания в него
+        self.events = EventBus()
+        self.shards = self.open_shards(self.count)
+        self.executor = ThreadPoolExecutor(max_workers=max(self.count, db_config.SHARDS),
+                                           thread_name_prefix='shard-query')
+
+    def read_layout(self):
+        """Раскладка шардов из SHARD_DIR/shards.json (None - еще не создана)"""
+        path = os.path.join(self.directory, LAYOUT_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_layout(self, count):
+        """Атомарная запись раскладки шардов"""
+        path = os.path.join(self.directory, LAYOUT_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'count': count, 'updated_at': datetime.now().isoformat()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def shard_config(self, index, count):
+        """Настройки шарда: свой файл, каталоги копий и журнала сегментов"""
+        cfg = self.db_config
+        suffix = f'shard_{index:03d}'
+        return dataclasses.replace(
+            cfg,
+            DB_PATH=os.path.join(self.directory, shard_name(index, count)),
+            BACKUP_DIR=os.path.join(cfg.BACKUP_DIR, suffix),
+            SEGMENT_DIR=os.path.join(cfg.SEGMENT_DIR, suffix),
+            HOT_TIER_MAX_DEVICES=math.ceil(cfg.HOT_TIER_MAX_DEVICES / count)
+        )
+
+    def open_shards(self, count):
+        shards = [SQLiteBackend(self.shard_config(index, count)) for index in range(count)]
+        for shard in shards:
+            shard.db_manager.events = self.events
+        return shards
+
+    def shard(self, device_id):
+        """Шард устройства"""
+        return self.shards[shard_index(device_id, self.count)]
+
+    def fan_out(self, call):
+        """Параллельный вызов call(шард) во всех шардах"""
+        return list(self.executor.map(call, self.shards))
+
+    def start(self):
+        if self.db_config.SHARDS != self.count:
+            if self.db_config.SHARD_RESHARD_ON_START:
+                self.reshard(self.db_config.SHARDS)
+            else:
+                logging.warning(f"DatabaseConfig.SHARDS={self.db_config.SHARDS}, but {self.directory} "
+                                f"has {self.count} shards; keeping the existing layout")
+        if self.initial:
+            # Раскладка записывается после импорта: прерванный импорт повторится
+            if os.path.exists(self.db_config.DB_PATH):
+                self.import_database(self.db_config.DB_PATH)
+            self.write_layout(self.count)
+            self.initial = False
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        self.fan_out(lambda shard: shard.stop())
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.executor.shutdown(wait=True)
+
+    @property
+    def async_writes(self):
+        return all(shard.async_writes for shard in self.shards)
+
+    def write_batch(self, readings, callback=None, block=True):
+        result = Future()
+        if callback:
+            result.add_done_callback(callback)
+        statuses = [False] * len(readings)
+        groups = {}
+        for position, data in enumerate(readings):
+            if DatabaseManager.is_valid_reading(data):
+                groups.setdefault(shard_index(data['device_id'], self.count), []).append(position)
+        if not groups:
+            result.set_result(statuses)
+            return result
+
+        remaining = [len(groups)]
+        lock = threading.Lock()
+
+        # Вызывается потоками записи разных шардов
+        def done(positions, future):
+            try:
+                flags = future.result()
+            except Exception as e:
+                # Ошибка шарда отклоняет только его показания, общий результат завершается
+                logging.error(f"Shard write failed: {e}")
+                flags = [False] * len(positions)
+            with lock:
+                for position, ok in zip(positions, flags):
+                    statuses[position] = ok
+                remaining[0] -= 1
+                finished = not remaining[0]
+            if finished:
+                result.set_result(statuses)
+
+        for index, positions in groups.items():
+            self.shards[index].write_batch(
+                [readings[position] for position in positions],
+                callback=lambda future, positions=positions: done(positions, future),
+                block=block
+            )
+        return result
+
+    def query_range(self, start, end, device_id=None, limit=10000):
+        if device_id:
+            return self.shard(device_id).query_range(start, end, device_id, limit)
+        parts = self.fan_out(lambda shard: shard.query_range(start, end, None, limit))
+        merged = heapq.merge(*parts, key=lambda record: to_epoch_ms(record['timestamp']))
+        return list(itertools.islice(merged, limit))
+
+    def recent(self, device_id=None, limit=50):
+        if device_id:
+            return self.shard(device_id).recent(device_id, limit)
+        parts = self.fan_out(lambda shard: shard.recent(None, limit))
+        merged = heapq.merge(*parts, key=lambda record: to_epoch_ms(record['timestamp']), reverse=True)
+        return list(itertools.islice(merged, limit))
+
+    def history(self, start, end, device_id=None, location=None, columns=None, after=None, limit=1000):
+        """Страница показаний; ключ страницы - (время в мс, id, номер шарда).
+
+        Строки всех шардов упорядочены по (время, номер шарда, id), поэтому
+        каждому шарду передается свой ключ: шарды до шарда последней строки
+        начинают со следующей миллисекунды, шарды после него - с той же.
+        """
+        columns = DatabaseManager.check_columns(columns)
+        if after and not 0 <= after[2] < self.count:
+            # Курсор выдан при другом числе шардов
+            raise ValueError('malformed cursor')
+        if device_id:
+            index = shard_index(device_id, self.count)
+            shards = [index]
+        else:
+            shards = range(self.count)
+
+        def page(index):
+            shard_after = None
+            if after:
+                timestamp_ms, row_id, position = after
+                if index < position:
+                    shard_after = (timestamp_ms + 1, 0)
+                elif index == position:
+                    shard_after = (timestamp_ms, row_id)
+                else:
+                    shard_after = (timestamp_ms, 0)
+            rows = self.shards[index].db_manager.get_history_rows(
+                start, end, device_id, location, shard_after, limit + 1
+            )
+            return [(row[8], index, row[0], row) for row in rows]
+
+        merged = list(itertools.islice(heapq.merge(*self.executor.map(page, shards)), limit + 1))
+        next_key = None
+        if len(merged) > limit:
+            merged = merged[:limit]
+            timestamp_ms, index, row_id, _ = merged[-1]
+            next_key = (timestamp_ms, row_id, index)
+        return {'data': [DatabaseManager.project(item[3], columns) for item in merged], 'next': next_key}
+
+    def latest(self, device_id=None):
+        if device_id:
+            return self.shard(device_id).latest(device_id)
+        return [record for part in self.fan_out(lambda shard: shard.latest()) for record in part]
+
+    def series(self, device_id, start, end, metrics=None, limit=10000):
+        return self.shard(device_id).series(device_id, start, end, metrics, limit)
+
+    def aggregates(self, device_id, start, end, metrics=None):
+        return self.shard(device_id).aggregates(device_id, start, end, metrics)
+
+    def series_chunks(self, device_id, start, end, metrics=None, chunk_rows=100000):
+        return self.shard(device_id).series_chunks(device_id, start, end, metrics, chunk_rows)
+
+    def rollup_series(self, device_id, metric, start, end, max_points=500, resolution=None):
+        return self.shard(device_id).rollup_series(device_id, metric, start, end, max_points, resolution)
+
+    def devices(self):
+        devices = [device for part in self.fan_out(lambda shard: shard.devices()) for device in part]
+        devices.sort(key=lambda device: device['last_seen'] or '', reverse=True)
+        return devices
+
+    def statistics(self):
+        summary = merge_statistics(self.fan_out(lambda shard: shard.statistics()))
+        summary['shards'] = self.health()['shards']
+        return summary
+
+    def health(self):
+        shards = self.fan_out(lambda shard: shard.health())
+        for index, shard in enumerate(shards):
+            shard['shard'] = index
+        return {
+            'backend': self.name,
+            'healthy': all(shard['healthy'] for shard in shards),
+            'shard_count': self.count,
+            'configured_shards': self.db_config.SHARDS,
+            'shards': shards
+        }
+
+    def copy_readings(self, source, targets):
+        """Перенос всех показаний базы source в шарды targets по device_id"""
+        columns = ', '.join(DatabaseManager.RECORD_COLUMNS)
+        batch_size = self.db_config.SHARD_RESHARD_BATCH
+        copied = 0
+        conn = source.pool.connect()
+        try:
+            for table in source.data_tables(newest_first=False):
+                last_id = 0
+                while True:
+                    rows = conn.execute(f'''
+                        SELECT {columns} FROM {table}
+                        WHERE id > ?
+                        ORDER BY id
+                        LIMIT ?
+                    ''', (last_id, batch_size)).fetchall()
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+                    groups = {}
+                    for row in rows:
+                        record = dict(zip(DatabaseManager.RECORD_COLUMNS, row))
+                        received = record.pop('received_at')
+                        record.pop('id')
+                        group = groups.setdefault(shard_index(record['device_id'], len(targets)), ([], []))
+                        group[0].append(record)
+                        group[1].append(received)
+                    for index, (readings, received) in groups.items():
+                        target = targets[index].db_manager
+                        with target.commit_lock:
+                            with target.pool.transaction() as target_conn:
+                                received_at, stored, duplicates = target.write_readings(
+                                    target_conn.cursor(), readings, received, deadband=False
+                                )
+                            target.on_committed(stored, received_at, duplicates)
+                    copied += len(rows)
+        finally:
+            source.pool.release(conn)
+        for target in targets:
+            target.db_manager.flush_metadata(force=True)
+        return copied
+
+    def reshard(self, count):
+        """Перераспределение показаний по count новым шардам"""
+        started = time.monotonic()
+        logging.info(f"Resharding {self.directory}: {self.count} -> {count} shards")
+        targets = self.open_shards(count)
+        copied = sum(self.copy_readings(shard.db_manager, targets) for shard in self.shards)
+
+        old_paths = [shard.db_manager.db_path for shard in self.shards]
+        for shard in self.shards:
+            shard.close()
+        # Новая раскладка фиксируется до удаления старых файлов
+        self.write_layout(count)
+        for path in old_paths:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        self.shards, self.count = targets, count
+        logging.info(f"Resharded {copied} readings in {time.monotonic() - started:.1f}s")
+
+    def import_database(self, db_path):
+        """Первичное заполнение шардов из несегментированной базы (файл не меняется)"""
+        source = DatabaseManager(db_path, self.db_config)
+        try:
+            if source.migration_pending:
+                source.migrate_schema()
+            copied = self.copy_readings(source, self.shards)
+        finally:
+            source.close()
+        logging.info(f"Imported {copied} readings from {db_path} into {self.count} shards")
@@ -0,0 +1,348 @@
+# storage.py - Хранилища показаний: общий интерфейс, SQLite и кольцевой буфер в памяти
+import os
+import heapq
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from database import DatabaseManager
+from dedup import DedupCache
+from hot_tier import METRICS, finish_summaries, summarize, to_float
+from device_registry import DeviceRegistry
+from ingest_stats import IngestStatistics
+from last_values import LastValueCache, as_record
+from pubsub import EventBus
+from rollups import parse_timestamp
+from timeutil import now_ms, to_epoch_ms, to_iso
+
+
+class StorageBackend:
+    """Хранилище показаний для сервера данных и веб-интерфейса.
+
+    Показания возвращаются словарями с полями DatabaseManager.RECORD_COLUMNS
+    и метками времени в ISO-8601. Реализация выбирается
+    DatabaseConfig.BACKEND (см. create_storage).
+    """
+
+    name = None
+    # EventBus сохраненных показаний (None - хранилище не публикует показания)
+    events = None
+    # Число частей ключа страницы history: (время в мс, id)
+    cursor_length = 2
+
+    def start(self):
+        """Запуск фоновой записи и обслуживания (для процесса, принимающего данные)"""
+
+    def stop(self):
+        """Дозапись принятых показаний и остановка фоновых задач"""
+
+    def close(self):
+        """Освобождение ресурсов"""
+        self.stop()
+
+    @property
+    def async_writes(self):
+        """write_batch ставит показания в очередь и не блокирует вызывающий поток"""
+        return False
+
+    def write_batch(self, readings, callback=None, block=True):
+        """Сохранение пачки показаний, Future со списком флагов успеха"""
+        raise NotImplementedError
+
+    def query_range(self, start, end, device_id=None, limit=10000):
+        """Показания за [start, end] по возрастанию времени"""
+        raise NotImplementedError
+
+    def recent(self, device_id=None, limit=50):
+        """Последние показания, новые первыми"""
+        raise NotImplementedError
+
+    def history(self, start, end, device_id=None, location=None, columns=None, after=None, limit=1000):
+        """Страница показаний за [start, end]: {'data', 'next' - ключ следующей страницы или None}"""
+        raise NotImplementedError
+
+    def latest(self, device_id=None):
+        """Последнее показание каждого устройства (или одного устройства)"""
+        raise NotImplementedError
+
+    def series(self, device_id, start, end, metrics=None, limit=10000):
+        """Значения метрик устройства за [start, end] по возрастанию времени"""
+        raise NotImplementedError
+
+    def aggregates(self, device_id, start, end, metrics=None):
+        """Число значений, минимум, максимум и среднее метрик устройства"""
+        raise NotImplementedError
+
+    def series_chunks(self, device_id, start, end, metrics=None, chunk_rows=100000):
+        """Пачки (метки времени int64, {метрика: float64}) устройства за [start, end]"""
+        raise NotImplementedError
+
+    def devices(self):
+        """Список устройств"""
+        raise NotImplementedError
+
+    def statistics(self):
+        """Сводка для API статистики"""
+        raise NotImplementedError
+
+    def rollup_series(self, device_id, metric, start, end, max_points=500, resolution=None):
+        """Ряд агрегатов по минутам/часам/дням"""
+        raise NotImplementedError(f"Rollups are not supported by the {self.name} backend")
+
+    def health(self):
+        """Состояние хранилища"""
+        return {'backend': self.name, 'healthy': True}
+
+
+class SQLiteBackend(StorageBackend):
+    """Хранилище в SQLite через DatabaseManager"""
+
+    name = 'sqlite'
+
+    def __init__(self, db_config, db_path=None):
+        self.db_config = db_config
+        self.db_manager = DatabaseManager(db_path or db_config.DB_PATH, db_config)
+
+    def start(self):
+        if self.db_config.WRITE_BEHIND:
+            self.db_manager.start_writer()
+        self.db_manager.start_maintenance()
+
+    def stop(self):
+        self.db_manager.stop_maintenance()
+        self.db_manager.stop_writer()
+
+    def close(self):
+        self.db_manager.close()
+
+    @property
+    def events(self):
+        return self.db_manager.events
+
+    @property
+    def async_writes(self):
+        return self.db_manager.writer is not None
+
+    def write_batch(self, readings, callback=None, block=True):
+        return self.db_manager.save_sensor_data_batch_async(readings, callback=callback, block=block)
+
+    def query_range(self, start, end, device_id=None, limit=10000):
+        return self.db_manager.get_sensor_data_range(start, end, device_id, limit)
+
+    def recent(self, device_id=None, limit=50):
+        return self.db_manager.get_recent_sensor_data(device_id, limit)
+
+    def history(self, start, end, device_id=None, location=None, columns=None, after=None, limit=1000):
+        return self.db_manager.get_history(start, end, device_id, location, columns, after, limit)
+
+    def latest(self, device_id=None):
+        return self.db_manager.get_latest_readings(device_id)
+
+    def series(self, device_id, start, end, metrics=None, limit=10000):
+        return self.db_manager.get_series(device_id, start, end, metrics, limit)
+
+    def aggregates(self, device_id, start, end, metrics=None):
+        return self.db_manager.get_aggregates(device_id, start, end, metrics)
+
+    def series_chunks(self, device_id, start, end, metrics=None, chunk_rows=100000):
+        return self.db_manager.iter_series_chunks(device_id, start, end, metrics, chunk_rows)
+
+    def devices(self):
+        return self.db_manager.get_devices()
+
+    def statistics(self):
+        return self.db_manager.get_statistics()
+
+    def rollup_series(self, device_id, metric, start, end, max_points=500, resolution=None):
+        return self.db_manager.get_rollup_series(device_id, metric, start, end, max_points, resolution)
+
+    def health(self):
+        """Доступность базы, размер файла и состояние потока записи"""
+        path = self.db_manager.db_path
+        health = {
+            'backend': self.name,
+            'path': path,
+            'size_bytes': sum(os.path.getsize(path + suffix) for suffix in ('', '-wal')
+                              if os.path.exists(path + suffix)),
+            'pending_writes': self.db_manager.writer.pending() if self.db_manager.writer else 0,
+            'writer': dict(self.db_manager.writer.stats) if self.db_manager.writer else None
+        }
+        try:
+            self.db_manager.pool.connection().execute('SELECT 1').fetchone()
+            health['healthy'] = True
+        except Exception as e:
+            health['healthy'] = False
+            health['error'] = str(e)
+        return health
+
+
+class MemoryRingBackend(StorageBackend):
+    """Хранилище в памяти процесса без обращений к диску.
+
+    Для каждого устройства хранится не больше ring_size последних принятых
+    показаний (кольцевой буфер), старые вытесняются. Подходит для нагрузочных
+    тестов пути приема и для устройств без места на диске. Данные видны
+    только внутри процесса и теряются при перезапуске, поэтому веб-интерфейс
+    должен получать этот объект от сервера (WebInterface(config, storage)).
+    """
+
+    name = 'memory'
+
+    def __init__(self, db_config, ring_size=None):
+        self.db_config = db_config
+        self.ring_size = ring_size or db_config.MEMORY_RING_SIZE
+        self.rings = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.registry = DeviceRegistry()
+        self.stats = IngestStatistics()
+        self.last_values = LastValueCache()
+        self.events = EventBus()
+        self.dedup = DedupCache(db_config.DEDUP_KEYS_PER_DEVICE, db_config.DEDUP_MAX_DEVICES)
+
+    @property
+    def async_writes(self):
+        # Запись в память не блокирует event loop
+        return True
+
+    def write_batch(self, readings, callback=None, block=True):
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        statuses = [DatabaseManager.is_valid_reading(data) for data in readings]
+        received_ms = now_ms()
+        stored, duplicates = [], []
+        with self.lock:
+            for data, ok in zip(readings, statuses):
+                if not ok:
+                    continue
+                ts_ms = parse_timestamp(data['timestamp'])
+                key = (data['device_id'], ts_ms if ts_ms is not None else received_ms)
+                if self.db_config.DEDUP_ENABLED and self.dedup.contains(*key):
+                    duplicates.append(data)
+                    continue
+                ring = self.rings.get(key[0])
+                if ring is None:
+                    ring = self.rings[key[0]] = deque(maxlen=self.ring_size)
+                ring.append((
+                    self.next_id,
+                    key[0],
+                    data.get('device_type'),
+                    data.get('location'),
+                    data.get('temperature'),
+                    data.get('humidity'),
+                    data.get('light_level'),
+                    data.get('voltage'),
+                    key[1],
+                    received_ms
+                ))
+                self.next_id += 1
+                self.dedup.add(*key)
+                stored.append((data, key[1]))
+
+        received_at = to_iso(received_ms)
+        for data, ts_ms in stored:
+            self.registry.record(data['device_id'], data.get('device_type'), data.get('location'), received_at)
+            self.last_values.update(data, ts_ms, received_at)
+        self.stats.record([data for data, _ in stored])
+        if duplicates:
+            self.stats.record_duplicates(duplicates)
+        if self.events.active:
+            self.events.publish([as_record(data, ts_ms, received_at) for data, ts_ms in stored])
+        future.set_result(statuses)
+        return future
+
+    def rows(self, device_id=None):
+        """Копия хранимых строк (всех устройств или одного)"""
+        with self.lock:
+            if device_id:
+                return list(self.rings.get(device_id, ()))
+            return [row for ring in self.rings.values() for row in ring]
+
+    def query_range(self, start, end, device_id=None, limit=10000):
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        rows = [row for row in self.rows(device_id) if start_ms <= row[8] <= end_ms]
+        rows = heapq.nsmallest(limit, rows, key=lambda row: (row[8], row[0]))
+        return [DatabaseManager.record_from_row(row) for row in rows]
+
+    def recent(self, device_id=None, limit=50):
+        rows = heapq.nlargest(limit, self.rows(device_id), key=lambda row: (row[8], row[0]))
+        return [DatabaseManager.record_from_row(row) for row in rows]
+
+    def history(self, start, end, device_id=None, location=None, columns=None, after=None, limit=1000):
+        columns = DatabaseManager.check_columns(columns)
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        after = tuple(after) if after else (start_ms, 0)
+        rows = [row for row in self.rows(device_id)
+                if start_ms <= row[8] <= end_ms and (row[8], row[0]) > after
+                and (not location or row[3] == location)]
+        rows = heapq.nsmallest(limit + 1, rows, key=lambda row: (row[8], row[0]))
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (rows[-1][8], rows[-1][0])
+        return {'data': [DatabaseManager.project(row, columns) for row in rows], 'next': next_key}
+
+    def latest(self, device_id=None):
+        return self.last_values.get(device_id)
+
+    def range_rows(self, device_id, start, end):
+        """Строки устройства за [start, end] по возрастанию времени"""
+        start_ms, end_ms = to_epoch_ms(start), to_epoch_ms(end)
+        rows = [row for row in self.rows(device_id) if start_ms <= row[8] <= end_ms]
+        rows.sort(key=lambda row: (row[8], row[0]))
+        return rows
+
+    def series(self, device_id, start, end, metrics=None, limit=10000):
+        metrics = DatabaseManager.check_metrics(metrics)
+        rows = self.range_rows(device_id, start, end)[:limit]
+        return {
+            'device_id': device_id,
+            'count': len(rows),
+            'source': 'memory',
+            'timestamp': [to_iso(row[8]) for row in rows],
+            'values': {metric: [row[4 + METRICS.index(metric)] for row in rows] for metric in metrics}
+        }
+
+    def aggregates(self, device_id, start, end, metrics=None):
+        metrics = DatabaseManager.check_metrics(metrics)
+        rows = self.range_rows(device_id, start, end)
+        summaries = {
+            metric: summarize(np.array([to_float(row[4 + METRICS.index(metric)]) for row in rows], dtype=float))
+            for metric in metrics
+        }
+        return {'device_id': device_id, 'source': 'memory', 'metrics': finish_summaries(summaries)}
+
+    def series_chunks(self, device_id, start, end, metrics=None, chunk_rows=100000):
+        metrics = DatabaseManager.check_metrics(metrics)
+        rows = self.range_rows(device_id, start, end)
+        for offset in range(0, len(rows), chunk_rows):
+            chunk = rows[offset:offset + chunk_rows]
+            yield np.array([row[8] for row in chunk], dtype=np.int64), {
+                metric: np.array([to_float(row[4 + METRICS.index(metric)]) for row in chunk], dtype=float)
+                for metric in metrics
+            }
+
+    def devices(self):
+        return self.registry.snapshot()
+
+    def statistics(self):
+        summary = self.stats.summary(self.registry.snapshot())
+        with self.lock:
+            summary['retained_records'] = sum(len(ring) for ring in self.rings.values())
+        return summary
+
+
+def create_storage(db_config, db_path=None):
+    """Хранилище, заданное DatabaseConfig.BACKEND ('sqlite', 'memory' или 'sharded')"""
+    backend = getattr(db_config, 'BACKEND', SQLiteBackend.name)
+    if backend == SQLiteBackend.name:
+        return SQLiteBackend(db_config, db_path)
+    if backend == MemoryRingBackend.name:
+        return MemoryRingBackend(db_config)
+    if backend == 'sharded':
+        from sharding import ShardedBackend
+        return ShardedBackend(db_config)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,42 @@
+# timeutil.py - Преобразование меток времени
+import time
+from datetime import datetime
+
+# Числа меньше этого считаются секундами epoch, а не миллисекундами
+_SECONDS_LIMIT = 100000000000
+
+
+def now_ms():
+    """Текущее время в миллисекундах epoch"""
+    return int(time.time() * 1000)
+
+
+def to_epoch_ms(value):
+    """Метка времени (ISO-8601 строка, datetime или число epoch) в миллисекунды.
+
+    Время без часового пояса считается локальным, как его формирует
+    datetime.now().isoformat() на устройствах. ValueError - значение не
+    распознано.
+    """
+    if isinstance(value, bool) or value is None:
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    if isinstance(value, (int, float)):
+        return int(value * 1000) if abs(value) < _SECONDS_LIMIT else int(value)
+    if isinstance(value, datetime):
+        return int(value.timestamp() * 1000)
+    if isinstance(value, str):
+        text = value.strip()
+        if text.lstrip('-').isdigit():
+            return to_epoch_ms(int(text))
+        return int(datetime.fromisoformat(text).timestamp() * 1000)
+    raise ValueError(f"Invalid timestamp: {value!r}")
+
+
+def to_iso(ms):
+    """Миллисекунды epoch в локальную ISO-8601 строку.
+
+    Строки (метки времени старой схемы) возвращаются без изменений.
+    """
+    if ms is None or isinstance(ms, str):
+        return ms
+    return datetime.fromtimestamp(ms / 1000).isoformat()
@@ -1,24 +1,107 @@
 # web_interface.py - Веб-интерфейс для мониторинга данных
 from flask import Flask, render_template, jsonify, request
-from flask_socketio import SocketIO
-import sqlite3
+from flask_socketio import SocketIO, emit, join_room, leave_room
+import csv
 import json
+import base64
+import itertools
+import zlib
+from io import StringIO
 from datetime import datetime, timedelta
 import threading
-import time
 from config import Config
+from data_server import create_server
+from downsample import chart_series
+from npy_export import DTYPES, stream_npz
+from pubsub import ALL, RoomBroadcaster, topics
+from storage import create_storage
 import logging
 import os
 
+HISTORY_MAX_LIMIT = 10000
+# Формат экспорта: (MIME-тип, расширение файла)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'json': ('application/json', 'json'),
+    'npz': ('application/octet-stream', 'npz')
+}
+# Столбцы CSV без проекции и их заголовки
+CSV_COLUMNS = (('id', 'ID'), ('device_id', 'Device ID'), ('temperature', 'Temperature'),
+               ('humidity', 'Humidity'), ('light_level', 'Light Level'), ('voltage', 'Voltage'),
+               ('timestamp', 'Timestamp'))
+
+
+def encode_cursor(key):
+    """Ключ страницы истории в непрозрачную строку для клиента"""
+    if key is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, length=None):
+    """Строка курсора в ключ страницы из length частей (ValueError - курсор поврежден)"""
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('malformed cursor')
+    if not isinstance(key, list) or not all(isinstance(part, int) for part in key):
+        raise ValueError('malformed cursor')
+    if length is not None and len(key) != length:
+        raise ValueError('malformed cursor')
+    return tuple(key)
+
+
+def parse_subscription(message):
+    """Темы и интервал из сообщения subscribe (ValueError - сообщение неверно)"""
+    if not isinstance(message, dict):
+        raise ValueError('subscribe message must be an object')
+    devices = message.get('devices') or []
+    locations = message.get('locations') or []
+    if not isinstance(devices, list) or not isinstance(locations, list):
+        raise ValueError('devices and locations must be lists')
+    topic_list = ([f'device:{device_id}' for device_id in devices] +
+                  [f'location:{location}' for location in locations]) or [ALL]
+
+    interval = message.get('interval')
+    if interval is not None:
+        try:
+            interval = float(interval)
+        except (TypeError, ValueError):
+            raise ValueError('interval must be a number of seconds')
+        # NaN и бесконечность тоже отклоняются
+        if not 0 < interval < float('inf'):
+            raise ValueError('interval must be a positive number of seconds')
+    return topic_list, interval
+
+
 class WebInterface:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, storage=None):
         self.config = config
         self.app = Flask(__name__)
         self.app.config['SECRET_KEY'] = 'sensor_system_secret_key'
         self.socketio = SocketIO(self.app, cors_allowed_origins="*")
+        # Хранилище можно передать из процесса сервера (обязательно для BACKEND='memory')
+        self.storage = storage or self.create_storage()
+        self.broadcaster = RoomBroadcaster(
+            lambda event, payload, room: self.socketio.emit(event, payload, to=room),
+            config.WEB.REALTIME_INTERVALS
+        )
+        # Встроенный сервер данных (WEB.EMBED_SERVER)
+        self.server = None
         self.setup_routes()
         self.setup_logging()
         
+    def create_storage(self):
+        """Хранилище показаний, заданное DatabaseConfig.BACKEND"""
+        try:
+            return create_storage(self.config.DATABASE)
+        except Exception as e:
+            logging.error(f"Storage unavailable: {e}")
+            return None
+        
     def setup_logging(self):
         """Настройка логирования"""
         logging.basicConfig(level=logging.INFO)
@@ -76,6 +159,140 @@ class WebInterface:
                     'message': str(e)
                 }), 500
         
+        @self.app.route('/api/data/history')
+        def get_history():
+            """API для постраничного чтения истории показаний (курсор next_cursor)"""
+            try:
+                if not self.storage:
+                    raise RuntimeError('Storage is not available')
+                end = request.args.get('to') or datetime.now().isoformat()
+                start = request.args.get('from') or (datetime.now() - timedelta(days=1)).isoformat()
+                limit = min(int(request.args.get('limit', 1000)), HISTORY_MAX_LIMIT)
+                if limit <= 0:
+                    raise ValueError('limit must be positive')
+                columns = request.args.get('columns')
+                page = self.storage.history(
+                    start, end,
+                    device_id=request.args.get('device_id'),
+                    location=request.args.get('location'),
+                    columns=columns.split(',') if columns else None,
+                    after=decode_cursor(request.args.get('cursor'), self.storage.cursor_length),
+                    limit=limit
+                )
+                return jsonify({
+                    'status': 'success',
+                    'data': page['data'],
+                    'count': len(page['data']),
+                    'next_cursor': encode_cursor(page['next'])
+                })
+            except ValueError as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'Invalid request: {e}'
+                }), 400
+            except NotImplementedError as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 501
+            except Exception as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 500
+        
+        @self.app.route('/api/data/latest')
+        def get_latest_data():
+            """API для получения последнего показания каждого устройства"""
+            try:
+                data = self.get_latest_sensor_data(request.args.get('device_id'))
+                return jsonify({
+                    'status': 'success',
+                    'data': data,
+                    'count': len(data)
+                })
+            except Exception as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 500
+        
+        @self.app.route('/api/data/series')
+        def get_series():
+            """API для получения значений метрик устройства за диапазон (по умолчанию за час)"""
+            return self.window_query(lambda device_id, start, end, metrics: self.storage.series(
+                device_id, start, end, metrics, limit=int(request.args.get('limit', 10000))
+            ))
+        
+        @self.app.route('/api/data/aggregates')
+        def get_aggregates():
+            """API для получения минимума/максимума/среднего метрик устройства"""
+            return self.window_query(lambda *args: self.storage.aggregates(*args))
+        
+        @self.app.route('/api/data/rollups')
+        def get_rollups():
+            """API для получения агрегатов по минутам/часам/дням"""
+            try:
+                if not self.storage:
+                    raise RuntimeError('Storage is not available')
+                device_id = request.args['device_id']
+                metric = request.args.get('metric', 'temperature')
+                end = request.args.get('to') or datetime.now().isoformat()
+                start = request.args.get('from') or (datetime.now() - timedelta(days=1)).isoformat()
+                series = self.storage.rollup_series(
+                    device_id, metric, start, end,
+                    max_points=int(request.args.get('points', 500)),
+                    resolution=request.args.get('resolution')
+                )
+                return jsonify({
+                    'status': 'success',
+                    'series': series
+                })
+            except (KeyError, ValueError) as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'Invalid request: {e}'
+                }), 400
+            except NotImplementedError as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 501
+            except Exception as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 500
+        
+        @self.app.route('/api/chart/series')
+        def get_chart_series():
+            """API для ряда графика: не больше points точек за диапазон (lttb или minmax)"""
+            try:
+                if not self.storage:
+                    raise RuntimeError('Storage is not available')
+                end = request.args.get('to') or datetime.now().isoformat()
+                start = request.args.get('from') or (datetime.now() - timedelta(hours=1)).isoformat()
+                series = chart_series(
+                    self.storage, request.args['device_id'],
+                    request.args.get('metric', 'temperature'), start, end,
+                    points=int(request.args.get('points', 500)),
+                    method=request.args.get('method', 'lttb')
+                )
+                return jsonify({
+                    'status': 'success',
+                    'series': series
+                })
+            except (KeyError, ValueError) as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'Invalid request: {e}'
+                }), 400
+            except Exception as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 500
+        
         @self.app.route('/api/statistics')
         def get_statistics():
             """API для получения статистики"""
@@ -91,21 +308,58 @@ class WebInterface:
                     'message': str(e)
                 }), 500
         
+        @self.app.route('/api/storage/health')
+        def get_storage_health():
+            """API для получения состояния хранилища (и каждого шарда)"""
+            try:
+                if not self.storage:
+                    raise RuntimeError('Storage is not available')
+                health = self.storage.health()
+                return jsonify({
+                    'status': 'success',
+                    'health': health
+                }), 200 if health['healthy'] else 503
+            except Exception as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 500
+        
         @self.app.route('/api/data/export')
         def export_data():
-            """API для экспорта данных"""
+            """API для потокового экспорта показаний за диапазон (csv, ndjson, json, npz; gzip=1)"""
             try:
+                if not self.storage:
+                    raise RuntimeError('Storage is not available')
                 format_type = request.args.get('format', 'json')
-                data = self.get_recent_sensor_data(limit=1000)
-                
-                if format_type == 'csv':
-                    return self.export_to_csv(data)
-                else:
-                    return jsonify({
-                        'status': 'success',
-                        'data': data,
-                        'exported_at': datetime.now().isoformat()
-                    })
+                if format_type not in EXPORT_FORMATS:
+                    raise ValueError(f'unknown format {format_type}')
+                end = request.args.get('to') or datetime.now().isoformat()
+                start = request.args.get('from') or (datetime.now() - timedelta(days=1)).isoformat()
+                if format_type == 'npz':
+                    return self.export_npz(start, end)
+                columns = request.args.get('columns')
+                pages = self.export_pages(
+                    start, end,
+                    device_id=request.args.get('device_id'),
+                    location=request.args.get('location'),
+                    columns=columns.split(',') if columns else None
+                )
+                # Первая страница читается до ответа: ошибки параметров - код 400
+                first = next(pages)
+                return self.stream_export(format_type, itertools.chain([first], pages),
+                                          columns.split(',') if columns else None,
+                                          request.args.get('gzip') in ('1', 'true'))
+            except ValueError as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': f'Invalid request: {e}'
+                }), 400
+            except NotImplementedError as e:
+                return jsonify({
+                    'status': 'error',
+                    'message': str(e)
+                }), 501
             except Exception as e:
                 return jsonify({
                     'status': 'error',
@@ -116,12 +370,72 @@ class WebInterface:
         def handle_connect():
             """Обработчик подключения WebSocket"""
             logging.info('WebSocket client connected - web_interface.py:118')
+            # По умолчанию клиент получает все устройства с наименьшим интервалом
+            joined, _ = self.broadcaster.subscribe(request.sid, [ALL])
+            for room in joined:
+                join_room(room)
             self.socketio.emit('connected', {'message': 'Connected to sensor data stream'})
         
+        @self.socketio.on('subscribe')
+        def handle_subscribe(message):
+            """Подписка на устройства и места установки: {devices, locations, interval}"""
+            try:
+                topic_list, interval = parse_subscription(message or {})
+            except ValueError as e:
+                emit('error', {
+                    'status': 'error',
+                    'message': str(e),
+                    'timestamp': datetime.now().isoformat()
+                })
+                return
+            joined, left = self.broadcaster.subscribe(request.sid, topic_list, interval)
+            for room in left:
+                leave_room(room)
+            for room in joined:
+                join_room(room)
+            # Текущие значения сразу, дальше приходят только изменения
+            emit('data_update', {
+                'data': [record for record in self.get_latest_sensor_data()
+                         if set(topics(record)) & set(topic_list)],
+                'topic': 'snapshot',
+                'timestamp': datetime.now().isoformat()
+            })
+        
         @self.socketio.on('disconnect')
         def handle_disconnect():
             """Обработчик отключения WebSocket"""
             logging.info('WebSocket client disconnected - web_interface.py:124')
+            self.broadcaster.unsubscribe(request.sid)
+    
+    def window_query(self, query):
+        """Общий разбор параметров device_id, from, to, metrics и ответ API"""
+        try:
+            if not self.storage:
+                raise RuntimeError('Storage is not available')
+            device_id = request.args['device_id']
+            end = request.args.get('to') or datetime.now().isoformat()
+            start = request.args.get('from') or (datetime.now() - timedelta(hours=1)).isoformat()
+            metrics = request.args.get('metrics')
+            result = query(device_id, start, end, metrics.split(',') if metrics else None)
+            return jsonify({
+                'status': 'success',
+                'result': result
+            })
+        except (KeyError, ValueError) as e:
+            return jsonify({
+                'status': 'error',
+                'message': f'Invalid request: {e}'
+            }), 400
+        except NotImplementedError as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 501
+        except Exception as e:
+            return jsonify({
+                'status': 'error',
+                'message': str(e)
+            }), 500
     
     def create_default_template(self, filepath):
         """Создание шаблона по умолчанию"""
@@ -373,167 +687,192 @@ class WebInterface:
             f.write(html_content)
         logging.info(f"Created default template at {filepath} - web_interface.py:374")
     
-    def get_db_connection(self):
-        """Создание подключения к базе данных"""
-        conn = sqlite3.connect(self.config.DATABASE.DB_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
-    
     def get_devices_from_db(self):
-        """Получение списка устройств из базы данных"""
+        """Получение списка устройств из хранилища"""
+        if not self.storage:
+            return []
         try:
-            conn = self.get_db_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT 
-                    device_id,
-                    device_type,
-                    location,
-                    first_seen,
-                    last_seen,
-                    total_records
-                FROM devices 
-                ORDER BY last_seen DESC
-            ''')
-            
-            devices = []
-            for row in cursor.fetchall():
-                devices.append({
-                    'device_id': row['device_id'],
-                    'device_type': row['device_type'],
-                    'location': row['location'],
-                    'first_seen': row['first_seen'],
-                    'last_seen': row['last_seen'],
-                    'total_records': row['total_records']
-                })
-            
-            conn.close()
-            return devices
-            
+            return self.storage.devices()
         except Exception as e:
             logging.error(f"Error getting devices: {e}")
             return []
     
     def get_recent_sensor_data(self, device_id=None, limit=50):
         """Получение последних данных сенсоров"""
+        if not self.storage:
+            return []
         try:
-            conn = self.get_db_connection()
-            cursor = conn.cursor()
-            
-            if device_id:
-                cursor.execute('''
-                    SELECT * FROM sensor_data 
-                    WHERE device_id = ? 
-                    ORDER BY timestamp DESC 
-                    LIMIT ?
-                ''', (device_id, limit))
-            else:
-                cursor.execute('''
-                    SELECT * FROM sensor_data 
-                    ORDER BY timestamp DESC 
-                    LIMIT ?
-                ''', (limit,))
-            
-            data = []
-            for row in cursor.fetchall():
-                data.append({
-                    'id': row['id'],
-                    'device_id': row['device_id'],
-                    'temperature': row['temperature'],
-                    'humidity': row['humidity'],
-                    'light_level': row['light_level'],
-                    'voltage': row['voltage'],
-                    'timestamp': row['timestamp'],
-                    'received_at': row['received_at']
-                })
-            
-            conn.close()
-            return data
-            
+            return self.storage.recent(device_id, limit)
         except Exception as e:
             logging.error(f"Error getting sensor data: {e}")
             return []
     
+    def get_latest_sensor_data(self, device_id=None):
+        """Последнее показание каждого устройства из кэша хранилища"""
+        if not self.storage:
+            return []
+        try:
+            return self.storage.latest(device_id)
+        except Exception as e:
+            logging.error(f"Error getting latest sensor data: {e}")
+            return []
+    
     def get_system_statistics(self):
         """Получение системной статистики"""
+        if not self.storage:
+            return {}
         try:
-            conn = self.get_db_connection()
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT COUNT(*) as total_records FROM sensor_data')
-            total_records = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(DISTINCT device_id) as device_count FROM sensor_data')
-            device_count = cursor.fetchone()[0]
-            
-            conn.close()
-            
-            return {
-                'total_records': total_records,
-                'device_count': device_count,
-                'last_updated': datetime.now().isoformat()
-            }
-            
+            return self.storage.statistics()
         except Exception as e:
             logging.error(f"Error getting statistics: {e}")
             return {}
     
-    def export_to_csv(self, data):
-        """Экспорт данных в CSV формат"""
-        import csv
-        from io import StringIO
+    def export_pages(self, start, end, device_id=None, location=None, columns=None):
+        """Показания за диапазон страницами по WEB.EXPORT_CHUNK_ROWS строк.
         
-        if not data:
-            return "No data to export", 400
+        Страницы читаются по ключу (время, id) как /api/data/history: в
+        памяти одна страница, а транзакция чтения не удерживается на все
+        время загрузки.
+        """
+        after = None
+        while True:
+            page = self.storage.history(start, end, device_id, location, columns, after,
+                                        self.config.WEB.EXPORT_CHUNK_ROWS)
+            yield page['data']
+            after = page['next']
+            if after is None:
+                break
+    
+    def export_npz(self, start, end):
+        """Ответ с архивом .npz столбцов NumPy (device_id - список через запятую, metrics, dtype)"""
+        from flask import Response
         
-        output = StringIO()
-        writer = csv.writer(output)
+        dtype = request.args.get('dtype', 'float64')
+        if dtype not in DTYPES:
+            raise ValueError(f'unknown dtype {dtype}')
+        device_ids = request.args.get('device_id')
+        device_ids = (device_ids.split(',') if device_ids
+                      else [device['device_id'] for device in self.storage.devices()])
+        metrics = request.args.get('metrics')
+        body = stream_npz(self.storage, device_ids, start, end,
+                          metrics.split(',') if metrics else None, dtype,
+                          self.config.WEB.EXPORT_CHUNK_ROWS)
+        return Response(
+            body,
+            mimetype=EXPORT_FORMATS['npz'][0],
+            headers={'Content-Disposition': 'attachment; filename=sensor_data_export.npz'}
+        )
+    
+    def stream_export(self, format_type, pages, columns=None, compress=False):
+        """Потоковый ответ с показаниями в формате csv, ndjson или json"""
+        from flask import Response
         
-        writer.writerow(['ID', 'Device ID', 'Temperature', 'Humidity', 'Light Level', 'Voltage', 'Timestamp'])
+        def csv_chunks():
+            output = StringIO()
+            writer = csv.writer(output)
+            if columns:
+                writer.writerow(columns)
+            else:
+                writer.writerow([header for _, header in CSV_COLUMNS])
+            for records in pages:
+                for record in records:
+                    if columns:
+                        writer.writerow([record[column] for column in columns])
+                    else:
+                        writer.writerow([record[column] for column, _ in CSV_COLUMNS])
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
         
-        for row in data:
-            writer.writerow([
-                row['id'],
-                row['device_id'],
-                row['temperature'],
-                row['humidity'],
-                row['light_level'],
-                row['voltage'],
-                row['timestamp']
-            ])
+        def ndjson_chunks():
+            for records in pages:
+                if records:
+                    yield ''.join(json.dumps(record) + '\n' for record in records)
         
-        from flask import Response
-        response = Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': 'attachment; filename=sensor_data_export.csv'}
-        )
+        def json_chunks():
+            yield '{"status": "success", "data": ['
+            separator = ''
+            for records in pages:
+                if records:
+                    yield separator + ', '.join(json.dumps(record) for record in records)
+                    separator = ', '
+            yield f'], "exported_at": {json.dumps(datetime.now().isoformat())}}}'
         
-        return response
+        chunks = {'csv': csv_chunks, 'ndjson': ndjson_chunks, 'json': json_chunks}[format_type]()
+        mimetype, extension = EXPORT_FORMATS[format_type]
+        filename = f'sensor_data_export.{extension}'
+        body = (chunk.encode('utf-8') for chunk in chunks)
+        if compress:
+            body = self.gzip_chunks(body)
+            mimetype, filename = 'application/gzip', filename + '.gz'
+        return Response(
+            body,
+            mimetype=mimetype,
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
+    
+    @staticmethod
+    def gzip_chunks(chunks):
+        """Сжатие потока байтов в формат gzip по мере чтения"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
     
     def start_realtime_updates(self):
-        """Запуск потока для обновления данных в реальном времени"""
-        def update_loop():
-            while True:
-                try:
-                    recent_data = self.get_recent_sensor_data(limit=10)
-                    self.socketio.emit('data_update', {
-                        'data': recent_data,
-                        'timestamp': datetime.now().isoformat()
-                    })
-                except Exception as e:
-                    logging.error(f"Error in update loop: {e}")
-                time.sleep(5)
+        """Рассылка показаний клиентам по мере сохранения.
         
-        update_thread = threading.Thread(target=update_loop, daemon=True)
-        update_thread.start()
+        Если показания принимаются в этом процессе (WEB.EMBED_SERVER, по
+        умолчанию), хранилище публикует их после коммита и рассылка идет
+        без обращений к базе. Запасной вариант для сервера данных в другом
+        процессе: раз в WEB.REALTIME_POLL секунд из базы читаются последние
+        значения устройств и рассылаются изменившиеся (задержка до
+        REALTIME_POLL + LAST_VALUES_REFRESH секунд).
+        """
+        events = self.storage.events if self.storage else None
+        if self.server and events is not None:
+            events.subscribe(self.broadcaster.publish)
+        else:
+            self.socketio.start_background_task(self.poll_latest)
+        self.socketio.start_background_task(self.flush_loop)
+    
+    def flush_loop(self):
+        """Периодическая рассылка накопленных показаний по комнатам"""
+        while True:
+            try:
+                self.broadcaster.flush()
+            except Exception as e:
+                logging.error(f"Error in update loop: {e}")
+            self.socketio.sleep(self.broadcaster.intervals[0] / 5)
+    
+    def poll_latest(self):
+        """Публикация изменившихся последних значений (сервер данных в другом процессе)"""
+        seen = {}
+        while True:
+            changed = [record for record in self.get_latest_sensor_data()
+                       if seen.get(record['device_id']) != record['timestamp']]
+            for record in changed:
+                seen[record['device_id']] = record['timestamp']
+            self.broadcaster.publish(changed)
+            self.socketio.sleep(self.config.WEB.REALTIME_POLL)
+    
+    def start_embedded_server(self):
+        """Сервер данных в потоке веб-процесса с общим хранилищем"""
+        self.server = create_server(self.config, self.storage)
+        server_thread = threading.Thread(target=self.server.start_server, daemon=True)
+        server_thread.start()
     
     def run(self, host='localhost', port=5000, debug=False):
         """Запуск веб-сервера"""
+        if self.config.WEB.EMBED_SERVER and self.storage:
+            self.start_embedded_server()
         self.start_realtime_updates()
         logging.info(f"Starting web interface on http://{host}:{port}")
-        self.socketio.run(self.app, host=host, port=port, debug=debug, allow_unsafe_werkzeug=True)
+        # Перезапускающий процесс отладчика тоже запустил бы сервер данных на том же порту
+        self.socketio.run(self.app, host=host, port=port, debug=debug, allow_unsafe_werkzeug=True,
+                          use_reloader=debug and self.server is None)
 
 def main():
     """Основная функция запуска веб-интерфейса"""